@@ -0,0 +1,204 @@
+from config import config
+import os
+import gzip
+import heapq
+import tempfile
+import numpy as np
+import pandas as pd
+from itertools import islice
+from bgzf import BGZFWriter
+from timings import span
+
+config = config
+
+# lines that are not intervals
+HEADER_PREFIXES = ("#", "track", "browser")
+
+# lines parsed or written at a time
+CHUNK_LINES = 100000
+
+BED_COLUMNS = ["chrom", "start", "end"]
+
+
+def bed_key(line):
+    # same order as giggle/scripts/sort_bed: chrom, then start and end numerically
+    fields = line.split("\t", 3)
+    return fields[0], int(fields[1]), int(fields[2])
+
+
+def lines_frame(lines):
+    """ parses bed lines into chrom, start and end columns, the line itself is
+    kept in "line" so extra columns are written back unchanged. Headers and
+    malformed lines are dropped
+    """
+    lines = pd.Series(lines, dtype=object)
+    lines = lines[~lines.str.startswith(HEADER_PREFIXES)]
+    fields = lines.str.split("\t", n=3, expand=True)
+    if len(lines) == 0 or fields.shape[1] < 3:
+        return pd.DataFrame(columns=BED_COLUMNS + ["line"])
+    starts = pd.to_numeric(fields[1], errors="coerce")
+    ends = pd.to_numeric(fields[2], errors="coerce")
+    valid = (starts.notna() & ends.notna()).to_numpy()
+    lines = lines[valid]
+    return pd.DataFrame({"chrom": fields[0][valid].to_numpy(dtype=object),
+                         "start": starts[valid].to_numpy(dtype=np.int64),
+                         "end": ends[valid].to_numpy(dtype=np.int64),
+                         "line": lines.where(lines.str.endswith("\n"), lines + "\n").to_numpy(dtype=object)})
+
+
+def bed_frames(path, chunk_lines=CHUNK_LINES):
+    """ yields the intervals of a bed(.gz) file as frames of chunk_lines lines """
+    f = gzip.open(path, "rt") if path.endswith(".gz") else open(path, "r")
+    with f:
+        for lines in iter(lambda: list(islice(f, chunk_lines)), []):
+            yield lines_frame(lines)
+
+
+def sorted_name(path):
+    # a.bed and a.bed.gz are both written as a.bed.gz
+    name = os.path.basename(path)
+    return (name[:-3] if name.endswith(".gz") else name) + ".gz"
+
+##############
+# BED WRITER #
+##############
+
+def sort_frame(frame):
+    """ sorts intervals by chromosome then start and end, chromosomes in string order like bed_key """
+    codes, _ = pd.factorize(frame["chrom"].to_numpy(dtype=object), sort=True)
+    order = np.lexsort((frame["end"].to_numpy(), frame["start"].to_numpy(), codes))
+    return frame.iloc[order]
+
+
+def frame_text(frame):
+    if "line" in frame.columns:
+        return "".join(frame["line"].to_numpy())
+    return frame[BED_COLUMNS].to_csv(sep="\t", header=False, index=False, lineterminator="\n")
+
+
+def frame_extents(frame, extents=None):
+    """ adds the {chrom: [min start, max end, interval count]} of frame to extents """
+    extents = {} if extents is None else extents
+    if len(frame) == 0:
+        return extents
+    summary = frame.groupby("chrom", sort=False).agg(minstart=("start", "min"), maxend=("end", "max"), intervals=("start", "size"))
+    for chrom, minstart, maxend, intervals in summary.itertuples(name=None):
+        if chrom in extents:
+            extent = extents[chrom]
+            extent[0] = min(extent[0], int(minstart))
+            extent[1] = max(extent[1], int(maxend))
+            extent[2] = extent[2] + int(intervals)
+        else:
+            extents[chrom] = [int(minstart), int(maxend), int(intervals)]
+    return extents
+
+
+def write_sorted_bed(intervals, sorted_path, level=6):
+    """ sorts intervals and writes them as a bgzip bed file in one pass
+    Parameters
+    ----------
+    intervals: DataFrame or dict
+        chrom, start and end columns (pandas or numpy), an optional "line"
+        column holding the full bed line to write instead
+    sorted_path: string
+        output .bed.gz path
+    Returns
+    -------
+    extents: dict
+        {chrom: [min start, max end, interval count]}
+    """
+    frame = sort_frame(pd.DataFrame(intervals))
+    with BGZFWriter(sorted_path, level) as out:
+        for i in range(0, len(frame), CHUNK_LINES):
+            out.write(frame_text(frame.iloc[i:i + CHUNK_LINES]))
+    return frame_extents(frame)
+
+###############
+# BED SORTING #
+###############
+
+def sort_bed_file(path, sorted_path, memory_MB=config.SORT_MEMORY_MB):
+    """ sorts a bed file by chromosome and start into a bgzip file, runs of
+    memory_MB are sorted in memory and spilled to disk then merged
+    Parameters
+    ----------
+    path: string
+        bed or bed.gz file
+    sorted_path: string
+        output .bed.gz path
+    memory_MB: float
+        memory budget for intervals held before spilling a sorted run
+    Returns
+    -------
+    extents: dict
+        {chrom: [min start, max end, interval count]}
+    """
+    return sort_bed_frames(bed_frames(path), sorted_path, memory_MB)
+
+
+def sort_bed_frames(frames, sorted_path, memory_MB=config.SORT_MEMORY_MB):
+    """ sorts interval frames from any iterable into a bgzip file, see sort_bed_file """
+    budget = memory_MB*1000*1000
+    run_folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(sorted_path)))
+    runs = []
+    extents = {}
+    try:
+        held = []
+        size = 0
+        for frame in frames:
+            frame_extents(frame, extents)
+            held.append(frame)
+            size = size + frame.memory_usage(deep=True).sum()
+            if size > budget:
+                runs.append(spill_run(pd.concat(held), run_folder, len(runs)))
+                held = []
+                size = 0
+        frame = pd.concat(held) if len(held) > 0 else pd.DataFrame(columns=BED_COLUMNS)
+
+        if len(runs) == 0:
+            write_sorted_bed(frame, sorted_path)
+        else:
+            run_files = [open(run, "r") for run in runs]
+            try:
+                lines = frame_text(sort_frame(frame)).splitlines(True)
+                merged = heapq.merge(lines, *run_files, key=bed_key)
+                with BGZFWriter(sorted_path) as out:
+                    while True:
+                        batch = "".join(islice(merged, CHUNK_LINES))
+                        if batch == "":
+                            break
+                        out.write(batch)
+            finally:
+                for f in run_files:
+                    f.close()
+    finally:
+        for run in runs:
+            os.remove(run)
+        os.rmdir(run_folder)
+    return extents
+
+
+def spill_run(frame, run_folder, number):
+    run = os.path.join(run_folder, "run_{}".format(number))
+    with open(run, "w") as f:
+        f.write(frame_text(sort_frame(frame)))
+    return run
+
+
+def sort_into_folder(sorted_folder, path):
+    """ sorts path into sorted_folder, for use with the worker pool
+    Returns
+    -------
+    sorted: tuple
+        (file name without .bed.gz, extents), None if the file could not be sorted
+    """
+    try:
+        name = sorted_name(path)
+        with span("sort", name.replace(".bed.gz", "")) as counts:
+            extents = sort_bed_file(path, os.path.join(sorted_folder, name))
+            counts["bytes"] = os.path.getsize(os.path.join(sorted_folder, name))
+            counts["intervals"] = sum([extent[2] for extent in extents.values()])
+        return name.replace(".bed.gz", ""), extents
+    except Exception as e:
+        print("Could not sort", path, e)
+        return None
@@ -0,0 +1,257 @@
+from config import config
+import os
+import json
+import time
+import shutil
+import resource
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import date, datetime
+from clize import run
+import catalog
+from bed_sort import write_sorted_bed
+from query_cache import bump_index_version
+from worker_pool import close_pool
+
+config = config
+
+BENCHMARK_GENOME = "bench"
+
+#################
+# SYNTHETIC BED #
+#################
+
+def chrom_weights(chrom_count, distribution="uniform"):
+    """ share of intervals on each chromosome
+    Parameters
+    ----------
+    distribution: string
+        uniform: every chromosome alike, skewed: chromosome n holds 1/n as
+        many intervals as chr1, like genomes with few large chromosomes
+    """
+    if distribution == "uniform":
+        weights = np.ones(chrom_count)
+    elif distribution == "skewed":
+        weights = 1/np.arange(1, chrom_count + 1)
+    else:
+        raise ValueError("Chromosome distribution {} not supported, use uniform or skewed".format(distribution))
+    return weights/weights.sum()
+
+
+def synthetic_intervals(rng, intervals, chrom_count=22, distribution="uniform", chrom_length=10**8, width=1000):
+    """ random intervals as chrom, start and end columns, widths are exponential around width """
+    chroms = np.array(["chr{}".format(i) for i in range(1, chrom_count + 1)])
+    starts = rng.integers(0, chrom_length, intervals)
+    return {"chrom": chroms[rng.choice(chrom_count, intervals, p=chrom_weights(chrom_count, distribution))],
+            "start": starts,
+            "end": starts + 1 + rng.exponential(width, intervals).astype(np.int64)}
+
+
+def synthetic_bed(path, rng, intervals, chrom_count=22, distribution="uniform", chrom_length=10**8, width=1000):
+    """ writes a sorted bgzip bed file of random intervals
+    Returns
+    -------
+    extents: dict
+        {chrom: [min start, max end, interval count]}
+    """
+    return write_sorted_bed(synthetic_intervals(rng, intervals, chrom_count, distribution, chrom_length, width), path)
+
+##################
+# INDEX BUILDING #
+##################
+
+def build_indices(conn, rng, files, intervals, files_per_index, chrom_count=22, distribution="uniform", chrom_length=10**8, width=1000):
+    """ writes synthetic files and indexes them through giggle_move_index, the
+    same path setup_indices.py takes, into the catalog of conn
+    Returns
+    -------
+    built: dict
+        indices, files and intervals built and the seconds taken
+    """
+    # imported here so the catalog and index folders of the working directory are used
+    from setup_indices import giggle_move_index, record_extents
+
+    started = time.time()
+    os.makedirs("data", exist_ok=True)
+    os.makedirs("indices", exist_ok=True)
+    project_id = "benchmark"
+    conn.execute("INSERT INTO PROJECTS (PROJECTID, OSOURCE, DSOURCE, SHORTNAME, LONGNAME, INFO) VALUES (?, ?, ?, ?, ?, ?)",
+                 (project_id, "benchmark", "benchmark", "benchmark", "synthetic benchmark files", ""))
+    built = []
+    for number, first in enumerate(range(0, files, files_per_index)):
+        index_name = "{}_{}".format(project_id, number + 1)
+        folder = "data/{}_sorted".format(index_name)
+        os.makedirs(folder, exist_ok=True)
+        names = ["file_{}".format(i) for i in range(first, min(files, first + files_per_index))]
+        file_extents = {name: synthetic_bed("{}/{}.bed.gz".format(folder, name), rng, intervals, chrom_count, distribution, chrom_length, width) for name in names}
+        output = giggle_move_index(folder, [index_name, names, file_extents])
+        if output == "error":
+            raise RuntimeError("Could not build index {}".format(index_name))
+        conn.execute("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (index_name, number + 1, date.today(), "benchmark", project_id, BENCHMARK_GENOME, True, intervals*len(names)))
+        conn.executemany("INSERT INTO FILES (FILEID, SIZE, GENOME, PROJECTID, INDEXID) VALUES (?, ?, ?, ?, ?)",
+                         [(name, intervals, BENCHMARK_GENOME, project_id, index_name) for name in names])
+        built.append(output)
+    record_extents(conn, built)
+    conn.execute("INSERT INTO GENOMES (GENOME) VALUES (?)", (BENCHMARK_GENOME,))
+    bump_index_version(conn)
+    conn.commit()
+    return {"indices": len(built), "files": files, "intervals": files*intervals, "seconds": time.time() - started}
+
+#############
+# WORKLOADS #
+#############
+
+def latency_summary(latencies, seconds):
+    """ p50, p95 and p99 latency in seconds and queries per second """
+    latencies = np.asarray(latencies, dtype=float)
+    if len(latencies) == 0:
+        return {"queries": 0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {"queries": len(latencies),
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+            "mean": float(latencies.mean()),
+            "max": float(latencies.max()),
+            "throughput": len(latencies)/seconds if seconds > 0 else 0}
+
+
+def timed_queries(query, arguments):
+    latencies = []
+    started = time.time()
+    for argument in arguments:
+        query_started = time.time()
+        query(argument)
+        latencies.append(time.time() - query_started)
+    return latency_summary(latencies, time.time() - started)
+
+
+def interval_workload(rng, queries, chrom_count=22, distribution="uniform", chrom_length=10**8, width=1000):
+    """ 'Chr:#-#' intervals drawn like the indexed intervals """
+    intervals = synthetic_intervals(rng, queries, chrom_count, distribution, chrom_length, width)
+    return ["{}:{}-{}".format(c, s, e) for c, s, e in zip(intervals["chrom"], intervals["start"], intervals["end"])]
+
+
+def file_workload(rng, queries, intervals, chrom_count=22, distribution="uniform", chrom_length=10**8, width=1000):
+    """ writes query files of intervals each and returns their paths """
+    os.makedirs("queries", exist_ok=True)
+    paths = ["queries/query_{}.bed.gz".format(i) for i in range(queries)]
+    for path in paths:
+        synthetic_bed(path, rng, intervals, chrom_count, distribution, chrom_length, width)
+    return paths
+
+
+def peak_rss():
+    # ru_maxrss is in KB on linux, the children are the worker pool
+    return {"process_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1000,
+            "workers_MB": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1000}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#################
+# BENCHMARK CLI #
+#################
+
+def BENCHMARK(*, files=20, intervals=10000, files_per_index=10, chroms=22, distribution="uniform", width=1000,
+              interval_queries=200, file_queries=20, file_query_intervals=1000, seed=1, cache=False, engine="", keep=False, output_path=""):
+    """ builds synthetic indices in BENCHMARK_FOLDER and times QUERY_INTERVAL and QUERY_FILE
+
+    :param files: synthetic files to index
+    :param intervals: intervals per file
+    :param files_per_index: files in each giggle index
+    :param chroms: number of chromosomes
+    :param distribution: uniform or skewed share of intervals per chromosome
+    :param width: mean interval width
+    :param interval_queries: QUERY_INTERVAL calls to time
+    :param file_queries: QUERY_FILE calls to time
+    :param file_query_intervals: intervals in each query file
+    :param seed: random seed, the same seed builds the same files and queries
+    :param cache: leave the query result cache on
+    :param engine: giggle or numpy, defaults to INDEX_ENGINE
+    :param keep: keep the indices built in BENCHMARK_FOLDER/work
+    :param output_path: results json, defaults to BENCHMARK_FOLDER/<commit>_<time>.json
+    """
+    results_folder = os.path.abspath(config.BENCHMARK_FOLDER)
+    work_folder = os.path.join(results_folder, "work")
+    shutil.rmtree(work_folder, ignore_errors=True)
+    os.makedirs(work_folder)
+    if output_path == "":
+        output_path = os.path.join(results_folder, "{}_{}.json".format(git_commit() or "nocommit", datetime.now().strftime("%Y%m%d%H%M%S")))
+    output_path = os.path.abspath(output_path)
+    engine = engine or config.INDEX_ENGINE
+    parameters = {"files": files, "intervals": intervals, "files_per_index": files_per_index, "chroms": chroms, "distribution": distribution,
+                  "width": width, "interval_queries": interval_queries, "file_queries": file_queries,
+                  "file_query_intervals": file_query_intervals, "seed": seed, "cache": cache, "engine": engine}
+
+    # the benchmark runs on its own catalog and index folders
+    cwd = os.getcwd()
+    db = config.DB
+    query_cache = config.QUERY_CACHE
+    index_engine = config.INDEX_ENGINE
+    os.chdir(work_folder)
+    config.DB = "Indexing.db"
+    config.QUERY_CACHE = cache
+    config.INDEX_ENGINE = engine
+    try:
+        conn = catalog.connect(config.DB)
+        rng = np.random.default_rng(seed)
+        build = build_indices(conn, rng, files, intervals, files_per_index, chroms, distribution, width=width)
+        conn.close()
+
+        import query_indices
+        query_indices.conn = catalog.connect(config.DB)
+        query_output = os.path.join(work_folder, "out.csv")
+        interval_args = interval_workload(rng, interval_queries, chroms, distribution, width=width)
+        file_args = file_workload(rng, file_queries, file_query_intervals, chroms, distribution, width=width)
+        workloads = {"interval": timed_queries(lambda interval: query_indices.QUERY_INTERVAL(interval, BENCHMARK_GENOME, query_output), interval_args),
+                     "file": timed_queries(lambda path: query_indices.QUERY_FILE(path, BENCHMARK_GENOME, query_output), file_args)}
+        # workers are counted in the children's peak RSS once they exit
+        close_pool()
+    finally:
+        os.chdir(cwd)
+        config.DB = db
+        config.QUERY_CACHE = query_cache
+        config.INDEX_ENGINE = index_engine
+        if not keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    results = {"commit": git_commit(), "date": datetime.now().isoformat(), "parameters": parameters,
+               "build": build, "workloads": workloads, "peak_rss": peak_rss()}
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(pd.DataFrame(workloads).T.to_string())
+    print("Results saved to", output_path)
+
+
+def COMPARE(baseline, candidate):
+    """ prints the latency and throughput of two benchmark results side by side, ratios above 1 are slower for latency
+
+    :param baseline: results json of the earlier commit
+    :param candidate: results json to compare
+    """
+    with open(baseline) as f:
+        old = json.load(f)
+    with open(candidate) as f:
+        new = json.load(f)
+    if old["parameters"] != new["parameters"]:
+        print("WARNING: benchmarks were run with different parameters")
+    rows = []
+    for workload in new["workloads"]:
+        for metric in ["p50", "p95", "p99", "throughput"]:
+            before = old["workloads"].get(workload, {}).get(metric)
+            after = new["workloads"][workload].get(metric)
+            rows.append({"workload": workload, "metric": metric, "baseline": before, "candidate": after,
+                         "ratio": after/before if before else None})
+    print("baseline {} ({}), candidate {} ({})".format(old["commit"], old["date"], new["commit"], new["date"]))
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+    run(BENCHMARK, alt={"compare": COMPARE})
@@ -0,0 +1,67 @@
+from config import config
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+config = config
+
+# largest uncompressed block, leaves room for incompressible data within the 64 KB block limit
+BLOCK_SIZE = 0xff00
+
+# empty block that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, level=6):
+    """ compresses up to BLOCK_SIZE bytes into one BGZF block, a gzip member
+    whose BC extra field holds the size of the block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BGZFWriter:
+    """ Writes a bgzip compressed file, readable by gzip and tabix/giggle, without
+    calling the bgzip binary. Blocks are compressed by threads, zlib releases
+    the GIL, and written in order
+    """
+    def __init__(self, path, level=6, threads=config.BGZF_THREADS):
+        self.f = open(path, "wb")
+        self.level = level
+        self.buffer = bytearray()
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        # blocks gathered before they are handed to the threads together
+        self.batch_size = BLOCK_SIZE*max(1, threads)*4
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_blocks(self, size):
+        blocks = [bytes(self.buffer[i:i + BLOCK_SIZE]) for i in range(0, size, BLOCK_SIZE)]
+        del self.buffer[:size]
+        if self.executor is None:
+            compressed = [compress_block(block, self.level) for block in blocks]
+        else:
+            compressed = self.executor.map(compress_block, blocks, [self.level]*len(blocks))
+        self.f.writelines(compressed)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.batch_size:
+            self.write_blocks(len(self.buffer) - len(self.buffer) % BLOCK_SIZE)
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.write_blocks(len(self.buffer))
+        self.f.write(EOF_BLOCK)
+        self.f.close()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,141 @@
+from config import config
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+config = config
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class BlobCache:
+    """ Content addressed store of downloaded and converted files, shared by every
+    project and kept between runs. Each file is stored once under its sha256 and
+    found through the source it came from (a URL or a database track), the least
+    recently used files are evicted once the store passes max_MB. A source can be
+    stored with a version (the ETag or Last-Modified of a URL), its copy is only
+    used while the source still has that version
+    """
+    def __init__(self, folder=config.BLOB_CACHE_FOLDER, max_MB=config.BLOB_CACHE_MAX_MB):
+        self.folder = folder
+        self.max_size = max_MB*1000*1000
+        os.makedirs(os.path.join(folder, "blobs"), exist_ok=True)
+        # the pipeline threads of a process share the connection, one statement at a time
+        self.conn = sqlite3.connect(os.path.join(folder, "blobs.db"), timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS SOURCES (SOURCE TEXT PRIMARY KEY, HASH TEXT NOT NULL, VERSION TEXT)")
+        try:
+            self.conn.execute("ALTER TABLE SOURCES ADD COLUMN VERSION TEXT")
+        except sqlite3.OperationalError:  # stores created before VERSION existed lack the column
+            pass
+        self.conn.execute("CREATE TABLE IF NOT EXISTS BLOBS (HASH TEXT PRIMARY KEY, SIZE INT NOT NULL, ACCESSED REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS SOURCES_HASH ON SOURCES (HASH)")
+        self.conn.commit()
+
+    def blob_path(self, blob_hash):
+        return os.path.join(self.folder, "blobs", blob_hash[:2], blob_hash)
+
+    def get(self, source, path, version=None):
+        """ places the cached copy of source at path, a copy stored with another
+        version than the one given is stale and not used
+        Returns
+        -------
+        found: bool
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT HASH, VERSION from SOURCES WHERE SOURCE=?", (source,)).fetchone()
+        if row is None or (version is not None and row[1] != version):
+            return False
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            try:  # blobs are never written in place, a hard link is safe and free
+                os.link(self.blob_path(row[0]), path)
+            except OSError:
+                shutil.copyfile(self.blob_path(row[0]), path)
+        except (OSError, IOError):  # evicted by another process
+            return False
+        with self.lock:
+            self.conn.execute("UPDATE BLOBS SET ACCESSED=? WHERE HASH=?", (time.time(), row[0]))
+            self.conn.commit()
+        return True
+
+    def put(self, source, path, version=None):
+        """ stores the file at path as the content of source at version """
+        blob_hash = file_hash(path)
+        blob_path = self.blob_path(blob_hash)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+            os.close(handle)
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, blob_path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO BLOBS (HASH, SIZE, ACCESSED) VALUES (?, ?, ?)", (blob_hash, os.path.getsize(blob_path), time.time()))
+            self.conn.execute("INSERT OR REPLACE INTO SOURCES (SOURCE, HASH, VERSION) VALUES (?, ?, ?)", (source, blob_hash, version))
+            self.conn.commit()
+        self.evict()
+        return blob_hash
+
+    def evict(self):
+        """ removes least recently used blobs until the store fits max_MB """
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(SIZE), 0) from BLOBS").fetchone()[0]
+            if total <= self.max_size:
+                return
+            for blob_hash, size in self.conn.execute("SELECT HASH, SIZE from BLOBS ORDER BY ACCESSED").fetchall():
+                if total <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM SOURCES WHERE HASH=?", (blob_hash,))
+                self.conn.execute("DELETE FROM BLOBS WHERE HASH=?", (blob_hash,))
+                if os.path.exists(self.blob_path(blob_hash)):
+                    os.remove(self.blob_path(blob_hash))
+                total = total - size
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            blobs, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(SIZE), 0) from BLOBS").fetchone()
+            sources = self.conn.execute("SELECT COUNT(*) from SOURCES").fetchone()[0]
+        return {"blobs": blobs, "sources": sources, "MB": size/1000/1000, "max_MB": self.max_size/1000/1000}
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM SOURCES")
+            self.conn.execute("DELETE FROM BLOBS")
+            self.conn.commit()
+        shutil.rmtree(os.path.join(self.folder, "blobs"), ignore_errors=True)
+        os.makedirs(os.path.join(self.folder, "blobs"), exist_ok=True)
+
+
+# one cache connection per process, shared by its threads, worker processes open their own
+caches = {}
+caches_lock = threading.Lock()
+
+
+def blob_cache():
+    """ returns the BlobCache of this process, None when BLOB_CACHE is off """
+    if not config.BLOB_CACHE:
+        return None
+    with caches_lock:
+        if os.getpid() not in caches:
+            caches[os.getpid()] = BlobCache()
+        return caches[os.getpid()]
+
+
+def source_version(headers):
+    """ the version of a remote file from its HTTP headers, the ETag or else Last-Modified, None when unknown """
+    if headers is None:
+        return None
+    return headers["etag"] or headers["modified"]
@@ -0,0 +1,135 @@
+from config import config
+import os
+import fcntl
+import sqlite3
+from contextlib import contextmanager
+
+config = config
+
+# catalog tables, created by models.py and added to older databases on connect
+TABLES = {
+    "GENOMES": '''(GENOME     TEXT    NOT NULL,
+          SCINAME    TEXT,
+          COMMONNAME TEXT,
+          DESCRIPTION TEXT)''',
+    "PROJECTS": '''(PROJECTID    TEXT    NOT NULL,
+          OSOURCE    TEXT    NOT NULL,
+          DSOURCE    TEXT    NOT NULL,
+          SHORTNAME  TEXT    NOT NULL,
+          LONGNAME   TEXT    NOT NULL,
+          INFO       TEXT    NOT NULL)''',
+    "INDICES": '''(INDEXID   TEXT    NOT NULL,
+          ITER      INT     NOT NULL,
+          DATE      NUMERIC NOT NULL,
+          PROJECTID TEXT    NOT NULL,
+          DSOURCE   TEXT    NOT NULL,
+          GENOME    TEXT    NOT NULL,
+          FULL      BOOL    NOT NULL,
+          SIZE      INT     NOT NULL)''',
+    "FILES": '''(FILEID    TEXT     NOT NULL,
+          SIZE      INT      NOT NULL,
+          GENOME    TEXT     NOT NULL,
+          PROJECTID TEXT     NOT NULL,
+          INDEXID   TEXT     NOT NULL,
+          SHORTNAME TEXT,
+          LONGNAME  TEXT,
+          SHORTINFO TEXT,
+          LONGINFO  TEXT)''',
+    "EXTENTS": '''(INDEXID   TEXT    NOT NULL,
+          CHROM     TEXT    NOT NULL,
+          MINSTART  INT     NOT NULL,
+          MAXEND    INT     NOT NULL,
+          INTERVALS INT     NOT NULL)''',
+    "VERSION": '''(VERSION   TEXT    NOT NULL)''',
+    "DELTAS": '''(INDEXID   TEXT    NOT NULL,
+          PROJECTID TEXT    NOT NULL)''',
+    "MANIFEST": '''(PROJECTID  TEXT    NOT NULL,
+          FILEID     TEXT    NOT NULL,
+          SOURCE     TEXT    NOT NULL,
+          REMOTESIZE INT,
+          ETAG       TEXT,
+          MODIFIED   TEXT,
+          MTIME      REAL,
+          HASH       TEXT)''',
+    "TOMBSTONES": '''(INDEXID   TEXT    NOT NULL,
+          FILEID    TEXT    NOT NULL)''',
+    "RUNS": '''(RUNID     TEXT    NOT NULL,
+          COMMAND   TEXT    NOT NULL,
+          STARTED   REAL    NOT NULL,
+          FINISHED  REAL)''',
+    "STAGE_TIMINGS": '''(RUNID     TEXT    NOT NULL,
+          STAGE     TEXT    NOT NULL,
+          NAME      TEXT,
+          PID       INT,
+          STARTED   REAL    NOT NULL,
+          SECONDS   REAL    NOT NULL,
+          BYTES     INT,
+          INTERVALS INT,
+          FAILED    BOOL    NOT NULL)''',
+}
+
+# secondary indexes for the lookups done by query_indices.py and update_indices.py
+INDEXES = {
+    "FILES_GENOME_FILEID": "FILES (GENOME, FILEID)",
+    "FILES_PROJECTID": "FILES (PROJECTID)",
+    "FILES_INDEXID": "FILES (INDEXID)",
+    "INDICES_GENOME": "INDICES (GENOME)",
+    "INDICES_PROJECTID_FULL": "INDICES (PROJECTID, FULL)",
+    "EXTENTS_INDEXID": "EXTENTS (INDEXID)",
+    "DELTAS_PROJECTID": "DELTAS (PROJECTID)",
+    "MANIFEST_PROJECTID_FILEID": "MANIFEST (PROJECTID, FILEID)",
+    "TOMBSTONES_INDEXID": "TOMBSTONES (INDEXID)",
+    "STAGE_TIMINGS_RUNID_STAGE": "STAGE_TIMINGS (RUNID, STAGE)",
+}
+
+
+def create_tables(conn, drop=False):
+    for table, columns in TABLES.items():
+        if drop:
+            conn.execute("DROP TABLE IF EXISTS {};".format(table))
+        conn.execute("CREATE TABLE IF NOT EXISTS {} {};".format(table, columns))
+    for index, columns in INDEXES.items():
+        conn.execute("CREATE INDEX IF NOT EXISTS {} ON {};".format(index, columns))
+
+
+def connect(db=config.DB, create=True):
+    """ opens the catalog in WAL mode so queries can keep reading while
+    setup_indices.py or update_indices.py write
+    Parameters
+    ----------
+    db: string
+        path to the sqlite database
+    create: bool
+        create missing tables and indexes
+    Returns
+    -------
+    conn: sqlite3 connection
+    """
+    conn = sqlite3.connect(db, timeout=60, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if create:
+        create_tables(conn)
+        conn.commit()
+    return conn
+
+
+def remove(db=config.DB):
+    """ deletes the catalog with its WAL and shared memory files, a leftover WAL would be replayed onto a new catalog """
+    for path in [db, db + "-wal", db + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@contextmanager
+def project_lock(project_id):
+    """ holds an exclusive lock on a project, shared by every process and thread,
+    so the update and the compaction of a project never interleave
+    """
+    os.makedirs(config.LOCK_FOLDER, exist_ok=True)
+    with open(os.path.join(config.LOCK_FOLDER, "{}.lock".format(project_id)), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,174 @@
+from config import config
+import os
+import math
+import glob
+import shutil
+import threading
+from datetime import date
+from clize import run
+import catalog
+from setup_indices import giggle_move_index, record_extents
+from query_cache import bump_index_version
+from interval_engine import remove_index
+
+config = config
+
+#####################
+# COMPACTION POLICY #
+#####################
+
+def delta_tier(size):
+    """ size tier of a delta index, deltas in one tier are within COMPACTION_TIER_RATIO of each other """
+    if size < config.COMPACTION_MIN_SIZE:
+        return 0
+    return 1 + int(math.log(size/config.COMPACTION_MIN_SIZE, config.COMPACTION_TIER_RATIO))
+
+
+def plan_compactions(deltas):
+    """ size tiered policy, every tier holding COMPACTION_MIN_DELTAS deltas is merged
+    Parameters
+    ----------
+    deltas: list
+        [(index id, size)] of one project
+    Returns
+    -------
+    merges: list
+        lists of index ids to merge into one index, smallest tier first
+    """
+    tiers = {}
+    for index_id, size in deltas:
+        tiers.setdefault(delta_tier(size), []).append(index_id)
+    return [tiers[tier] for tier in sorted(tiers.keys()) if len(tiers[tier]) >= config.COMPACTION_MIN_DELTAS]
+
+###################
+# COMPACTION JOBS #
+###################
+
+def merge_deltas(conn, project_id, index_ids):
+    """ builds one index from the kept files of index_ids and swaps it into the
+    catalog, the result stays a delta until it holds INDEX_FULL_FRACTION of
+    MAX_INTERVALS_PER_INDEX intervals. The project lock is held throughout, as
+    updates of the project hold it, so its next ITER cannot be taken during the build
+    Returns
+    -------
+    index_name: string
+        merged index, None if the index could not be built
+    """
+    with catalog.project_lock(project_id):
+        placeholders = ", ".join(["?"]*len(index_ids))
+        source, genome = conn.execute("SELECT DSOURCE, GENOME from INDICES WHERE INDEXID IN ({})".format(placeholders), index_ids).fetchone()
+        size = conn.execute("SELECT SUM(SIZE) from FILES WHERE INDEXID IN ({})".format(placeholders), index_ids).fetchone()[0] or 0
+        # files retired by updates are left out of the merge
+        retired = set(index_tombstones(conn, index_ids))
+        index_iter = conn.execute("SELECT MAX(ITER) from INDICES WHERE PROJECTID=?", (project_id,)).fetchone()[0] + 1
+        index_name = "{}_{}".format(project_id, index_iter)
+        full = size >= config.INDEX_FULL_FRACTION*config.MAX_INTERVALS_PER_INDEX
+
+        # copy so the deltas stay intact if the build fails
+        merge_folder = "data/{}_merge".format(index_name)
+        os.makedirs(merge_folder, exist_ok=True)
+        files = []
+        for index_id in index_ids:
+            for path in glob.glob(os.path.join(config.DELTA_FOLDER, index_id, "*.bed.gz")):
+                file_id = os.path.basename(path).replace(".bed.gz", "")
+                if (index_id, file_id) not in retired:
+                    shutil.copy(path, merge_folder)
+                    files.append(file_id)
+        output = giggle_move_index(merge_folder, [index_name, files], None if full else os.path.join(config.DELTA_FOLDER, index_name))
+        if output == "error":
+            shutil.rmtree(merge_folder, ignore_errors=True)
+            print("Could not compact", index_ids)
+            return None
+
+        # swap the merged index in with one transaction that no other writer interleaves, queries see either the deltas or the merge
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # files retired while the index was built are in it, they stay hidden by a tombstone on the merged index
+            late = [file_id for index_id, file_id in index_tombstones(conn, index_ids) if (index_id, file_id) not in retired]
+            size = conn.execute("SELECT SUM(SIZE) from FILES WHERE INDEXID IN ({})".format(placeholders), index_ids).fetchone()[0] or 0
+            conn.execute("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (index_name, index_iter, date.today(), source, project_id, genome, full, size,))
+            conn.execute("UPDATE FILES SET INDEXID=? WHERE INDEXID IN ({})".format(placeholders), [index_name] + index_ids)
+            conn.execute("DELETE FROM EXTENTS WHERE INDEXID IN ({})".format(placeholders), index_ids)
+            record_extents(conn, [output])
+            conn.execute("DELETE FROM INDICES WHERE INDEXID IN ({})".format(placeholders), index_ids)
+            conn.execute("DELETE FROM DELTAS WHERE INDEXID IN ({})".format(placeholders), index_ids)
+            conn.execute("DELETE FROM TOMBSTONES WHERE INDEXID IN ({})".format(placeholders), index_ids)
+            conn.executemany("INSERT INTO TOMBSTONES (INDEXID, FILEID) VALUES (?, ?)", [(index_name, file_id) for file_id in late])
+            if not full:
+                conn.execute("INSERT INTO DELTAS (INDEXID, PROJECTID) VALUES (?, ?)", (index_name, project_id))
+            bump_index_version(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        for index_id in index_ids:
+            remove_index(index_id)
+            shutil.rmtree(os.path.join(config.DELTA_FOLDER, index_id), ignore_errors=True)
+        return index_name
+
+
+def index_tombstones(conn, index_ids):
+    """ returns the (INDEXID, FILEID) of files retired from index_ids """
+    out = conn.execute("SELECT INDEXID, FILEID from TOMBSTONES WHERE INDEXID IN ({})".format(", ".join(["?"]*len(index_ids))), index_ids)
+    return [tuple(row) for row in out]
+
+
+def compact_project(conn, project_id):
+    """ merges the deltas of a project until no tier is due for compaction """
+    merged = []
+    while True:
+        deltas = conn.execute("SELECT d.INDEXID, i.SIZE from DELTAS as d join INDICES as i on d.INDEXID=i.INDEXID WHERE d.PROJECTID=? ORDER BY i.ITER", (project_id,)).fetchall()
+        merges = plan_compactions(deltas)
+        if len(merges) == 0:
+            return merged
+        index_name = merge_deltas(conn, project_id, merges[0])
+        if index_name is None:
+            return merged
+        merged.append(index_name)
+
+
+def compact_all(conn):
+    projects = [i[0] for i in conn.execute("SELECT DISTINCT PROJECTID from DELTAS")]
+    return {project_id: compact_project(conn, project_id) for project_id in projects}
+
+
+def start_background_compaction(db=config.DB, interval=config.COMPACTION_INTERVAL):
+    """ compacts deltas every interval seconds in a daemon thread
+    Returns
+    -------
+    stop: threading.Event
+        set to stop the thread
+    """
+    stop = threading.Event()
+
+    def compaction_loop():
+        conn = catalog.connect(db)
+        while not stop.wait(interval):
+            try:
+                compact_all(conn)
+            except Exception as e:
+                print("Compaction failed", e)
+        conn.close()
+
+    threading.Thread(target=compaction_loop, daemon=True).start()
+    return stop
+
+
+def COMPACT(*, watch=False, interval=config.COMPACTION_INTERVAL):
+    """ merges delta indices added by update_indices.py
+
+    :param watch: keep running and compact every interval seconds
+    :param interval: seconds between compactions when watching
+    """
+    if watch:
+        start_background_compaction(config.DB, interval).wait()
+    else:
+        conn = catalog.connect(config.DB)
+        print(compact_all(conn))
+        conn.close()
+
+
+if __name__ == "__main__":
+    run(COMPACT)
@@ -27,6 +27,20 @@ class config:
     # Max Number of Intervals per Index
     MAX_INTERVALS_PER_INDEX = 10000000
 
+    # Files are packed into near equal indices, at least INDEX_TARGET_COUNT of them (0 for as few as MAX_INTERVALS_PER_INDEX allows)
+    # an index holding INDEX_FULL_FRACTION of MAX_INTERVALS_PER_INDEX is full, indices that are not full are rebuilt on update
+    INDEX_TARGET_COUNT = 0
+    INDEX_FULL_FRACTION = 0.5
+
+    # Updates add new files as delta indices, compaction merges COMPACTION_MIN_DELTAS deltas of a size tier
+    # (tiers grow by COMPACTION_TIER_RATIO from COMPACTION_MIN_SIZE intervals), checked every COMPACTION_INTERVAL seconds
+    DELTA_FOLDER = "deltas/"
+    LOCK_FOLDER = "cache/locks/"  # a lock file per project, held while it is updated or compacted
+    COMPACTION_MIN_DELTAS = 4
+    COMPACTION_TIER_RATIO = 4
+    COMPACTION_MIN_SIZE = 10000
+    COMPACTION_INTERVAL = 60*10
+
     # Number of proccesses available to server
     AVAILABLE_PROCCESSES = 8
     
@@ -42,6 +56,62 @@ class config:
     timeout_file_download = 60*5
     timeout_file_processing = 60*10 # 10 minutes
 
+    # Download engine: simultaneous downloads, open connections per host and retries with exponential backoff (seconds)
+    DOWNLOAD_CONCURRENCY = 32
+    DOWNLOAD_CONNECTIONS_PER_HOST = 8
+    DOWNLOAD_RETRIES = 3
+    DOWNLOAD_BACKOFF = 1
+
+    # Setup pipeline: index buckets waiting between the download, convert, sort and index stages
+    PIPELINE_QUEUE_SIZE = 2
+
+    # Memory each worker holds while sorting a bed file before spilling sorted runs to disk
+    SORT_MEMORY_MB = 256
+
+    # Threads compressing the blocks of each bgzip file written by setup
+    BGZF_THREADS = 4
+
+    # Rows fetched at a time when exporting UCSC database tables, only the chrom, start and end columns are read
+    SQL_CHUNK_ROWS = 100000
+
+    # Downloaded and converted files are kept by content hash and reused across projects and runs, least recently used are evicted past BLOB_CACHE_MAX_MB
+    BLOB_CACHE = True
+    BLOB_CACHE_FOLDER = "blobs/"
+    BLOB_CACHE_MAX_MB = 20000
+
+    # Hub track descriptions are fetched METADATA_CONCURRENCY at a time and kept on disk, revalidated on each setup or update
+    METADATA_CONCURRENCY = 16
+    METADATA_CACHE_FOLDER = "cache/metadata/"
+
+    # Interval counts of local bed files, recounted only when a file's size or mtime changes
+    INTERVAL_COUNT_CACHE = "cache/interval_counts.json"
+
+    # Engine new indices are built with and searched by, "giggle" runs the giggle binary, "numpy" keeps sorted interval
+    # arrays in indices/<index>.npy and searches them in process. Indices the other engine built are searched with that engine
+    INDEX_ENGINE = "giggle"
+
+    # Resident query server (query_server.py), set QUERY_SERVER_SOCKET to serve on a unix socket instead
+    QUERY_SERVER_HOST = "127.0.0.1"
+    QUERY_SERVER_PORT = 8800
+    QUERY_SERVER_SOCKET = ""
+
+    # Query metrics: latency histogram bucket bounds in seconds, and the file query_indices.py adds the metrics of each call to
+    QUERY_METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+    QUERY_METRICS_FILE = "cache/query_metrics.json"
+
+    # Stage timings of setup and update runs are spooled here by each process before they are loaded into STAGE_TIMINGS
+    TIMINGS_FOLDER = "cache/timings/"
+
+    # Benchmark results of benchmark.py, the synthetic indices are built in BENCHMARK_FOLDER/work
+    BENCHMARK_FOLDER = "benchmarks/"
+
+    # Query result cache, results are reused until indices are setup or updated
+    QUERY_CACHE = True
+    CACHE_FOLDER = "cache/"
+    CACHE_MAX_MB = 500  # disk budget
+    CACHE_MEMORY_MB = 100  # in memory budget per process
+    CACHE_MAX_ROWS = 100000  # larger results are streamed to the output without being cached
+
     # List genomes from UCSC to download and index
     '''
     example:
@@ -0,0 +1,146 @@
+from config import config
+import os
+import time
+import asyncio
+import aiohttp
+
+config = config
+
+# responses worth retrying, anything else is a permanent failure
+RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+
+
+class DownloadError(Exception):
+    pass
+
+
+def response_validator(headers):
+    """ the strong ETag, else the Last-Modified, of a response, what If-Range compares a resumed download against """
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):  # If-Range only accepts strong validators
+        return etag
+    return headers.get("Last-Modified")
+
+
+def remove_partial(part_path):
+    for stale in [part_path, part_path + ".validator"]:
+        if os.path.exists(stale):
+            os.remove(stale)
+
+
+class DownloadEngine:
+    """ Downloads many files concurrently over pooled keep-alive connections.
+    Each file is streamed to <path>.part and renamed when complete, an
+    interrupted download is resumed with a range request on the next attempt
+    while the remote file still has the validator stored in <path>.part.validator.
+    """
+    def __init__(self, concurrency=config.DOWNLOAD_CONCURRENCY, connections_per_host=config.DOWNLOAD_CONNECTIONS_PER_HOST,
+                 retries=config.DOWNLOAD_RETRIES, backoff=config.DOWNLOAD_BACKOFF, timeout=config.timeout_file_download, chunk_size=1 << 16):
+        self.concurrency = concurrency
+        self.connections_per_host = connections_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        # {path: (started, seconds)} of each download, retries included
+        self.timings = {}
+
+    async def fetch(self, session, url, path):
+        """ streams url to path, resuming a partial download if the remote file has not changed since """
+        part_path = path + ".part"
+        validator_path = part_path + ".validator"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = None
+        if offset > 0 and os.path.exists(validator_path):
+            with open(validator_path) as f:
+                validator = f.read()
+        # the server sends the whole file instead of the range when it no longer matches the validator
+        headers = {"Range": "bytes={}-".format(offset), "If-Range": validator} if validator else {}
+        async with session.get(url, headers=headers) as response:
+            if response.status == 416 and validator:  # partial file already holds everything
+                os.remove(validator_path)
+                os.replace(part_path, path)
+                return
+            if response.status in RETRY_STATUS:
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status, message=response.reason)
+            if response.status not in [200, 206]:
+                raise DownloadError("{} returned {}".format(url, response.status))
+            resumed = validator is not None and response.status == 206 and response.headers.get("Content-Range", "").startswith("bytes {}-".format(offset))
+            if response.status == 206 and not resumed:
+                # a range the partial file does not end at, the next attempt starts over
+                remove_partial(part_path)
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status, message="unexpected Content-Range")
+            if not resumed:  # a new download, servers without range support or a changed file resend everything
+                remove_partial(part_path)
+                if response_validator(response.headers) is not None:
+                    with open(validator_path, "w") as f:
+                        f.write(response_validator(response.headers))
+            with open(part_path, "ab" if resumed else "wb") as f:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    f.write(chunk)
+        if os.path.exists(validator_path):
+            os.remove(validator_path)
+        os.replace(part_path, path)
+
+    async def fetch_with_retries(self, session, semaphore, url, path):
+        async with semaphore:
+            started = time.time()
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        await self.fetch(session, url, path)
+                        return None
+                    except DownloadError as e:
+                        return e
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        if attempt == self.retries:
+                            return e
+                        await asyncio.sleep(self.backoff * 2**attempt)
+            finally:
+                self.timings[path] = (started, time.time() - started)
+
+    async def download_all(self, downloads):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.connections_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            errors = await asyncio.gather(*[self.fetch_with_retries(session, semaphore, url, path) for url, path in downloads])
+        return {path: error for (_, path), error in zip(downloads, errors)}
+
+    async def head(self, session, semaphore, url):
+        """ size, ETag and Last-Modified of url without downloading it, None if unavailable """
+        async with semaphore:
+            try:
+                async with session.head(url, allow_redirects=True) as response:
+                    if response.status != 200:
+                        return None
+                    return {"size": response.content_length,
+                            "etag": response.headers.get("ETag"),
+                            "modified": response.headers.get("Last-Modified")}
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None
+
+    async def head_all(self, urls):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.connections_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            headers = await asyncio.gather(*[self.head(session, semaphore, url) for url in urls])
+        return dict(zip(urls, headers))
+
+    def remote_headers(self, urls):
+        """ returns {url: {"size", "etag", "modified"} or None} for each url """
+        if len(urls) == 0:
+            return {}
+        return asyncio.run(self.head_all(list(urls)))
+
+    def download(self, downloads):
+        """ downloads each (url, path) pair
+        Returns
+        -------
+        errors: dict
+            path: None if downloaded else the exception of the last attempt
+        """
+        if len(downloads) == 0:
+            return {}
+        return asyncio.run(self.download_all(downloads))
@@ -0,0 +1,110 @@
+import subprocess
+import itertools
+import numpy as np
+
+# giggle search -q <file> -s output columns
+FILE_RESULT_COLUMNS = ["file", "file_size", "overlaps", "odds_ratio", "fishers_two_tail", "fishers_left_tail", "fishers_right_tail", "combo_score"]
+INTERVAL_RESULT_COLUMNS = ["file", "size", "overlaps"]
+REGIONS_RESULT_COLUMNS = ["region", "file", "overlaps"]
+
+
+def column_dtype(column):
+    if column in ["file", "region"]:
+        return object
+    if column in ["size", "file_size", "overlaps"]:
+        return np.int64
+    return np.float64
+
+
+def column_converter(column):
+    dtype = column_dtype(column)
+    if dtype is object:
+        return bytes.decode
+    return int if dtype is np.int64 else float
+
+
+def empty_columns(columns):
+    return {c: np.array([], dtype=column_dtype(c)) for c in columns}
+
+
+def to_columns(records, columns):
+    """ collects typed records into one numpy array per column """
+    values = [[] for _ in columns]
+    for record in records:
+        for column_values, value in zip(values, record):
+            column_values.append(value)
+    return {c: np.array(v, dtype=column_dtype(c)) for c, v in zip(columns, values)}
+
+
+def giggle_lines(args):
+    """ runs giggle and yields its stdout lines as they are written
+    Parameters
+    ----------
+    args: list
+        giggle arguments, ex. ["search", "-i", "indices/hg19_1.d", "-r", "1:1-100"]
+    """
+    proc = subprocess.Popen(["giggle"] + args, stdout=subprocess.PIPE)
+    with proc:
+        for line in proc.stdout:
+            yield line
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, ["giggle"] + args)
+
+
+def strip_data_folder(file_name):
+    return file_name[5:] if file_name.startswith("data/") else file_name
+
+
+def parse_interval_search(lines):
+    """ yields (file, size, overlaps) from giggle search -r output,
+    one #<file>\tsize:<size>\toverlaps:<overlaps> line per file
+    """
+    for line in lines:
+        if not line.startswith(b"#") or b"\tsize:" not in line:
+            continue
+        fields = line[1:].rstrip(b"\r\n").split(b"\t")
+        yield (strip_data_folder(fields[0].decode()),
+               int(fields[1].split(b":")[1]),
+               int(fields[2].split(b":")[1]))
+
+
+def parse_file_search(lines):
+    """ returns the columns and a generator of typed records of giggle search -q -s output,
+    a #<column names> header followed by one line per file
+    """
+    lines = iter(lines)
+    first = next(lines, b"")
+    if first.startswith(b"#"):
+        columns = first[1:].rstrip(b"\r\n\t").decode().split("\t")
+        pending = []
+    else:
+        columns = FILE_RESULT_COLUMNS
+        pending = [first]
+    converters = [column_converter(c) for c in columns]
+
+    def records():
+        for line in itertools.chain(pending, lines):
+            fields = line.rstrip(b"\r\n\t").split(b"\t")
+            if len(fields) >= len(columns):
+                yield [convert(field) for convert, field in zip(converters, fields)]
+
+    return columns, records()
+
+
+def parse_regions_search(lines):
+    """ yields (region, file, overlaps) from giggle search -q -v output.
+    Each query interval is printed as a ##<query line> header followed by the
+    overlapping intervals, whose last column is the file they come from.
+    """
+    overlaps = {}
+    region = ""
+    for line in lines:
+        line = line.rstrip(b"\r\n")
+        if line.startswith(b"##"):
+            fields = line[2:].decode().split("\t")
+            region = fields[3] if len(fields) > 3 else "{}:{}-{}".format(fields[0], fields[1], fields[2])
+        elif line != b"":
+            key = (region, strip_data_folder(line.split(b"\t")[-1].decode()))
+            overlaps[key] = overlaps.get(key, 0) + 1
+    for (region, file), count in overlaps.items():
+        yield (region, file, count)
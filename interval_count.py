@@ -0,0 +1,99 @@
+from config import config
+import os
+import json
+import gzip
+from worker_pool import get_pool
+
+config = config
+
+# lines before the first interval that are not intervals
+HEADER_PREFIXES = (b"#", b"track", b"browser")
+
+
+def count_intervals(path):
+    """ counts the intervals of a bed file, gzip and bgzip files are decompressed
+    as they are read and header lines are not counted
+    Parameters
+    ----------
+    path: string
+        .bed or .bed.gz file
+    Returns
+    -------
+    count: int
+    """
+    with open(path, "rb") as raw:
+        gzipped = raw.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gzipped else open
+    count = 0
+    header = True
+    last = b"\n"
+    with opener(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 22), b""):
+            if header:
+                # header lines may only come before the first interval
+                lines = block.split(b"\n")
+                skipped = 0
+                for line in lines[:-1]:
+                    if line.startswith(HEADER_PREFIXES) or line.strip() == b"":
+                        skipped = skipped + 1
+                    else:
+                        header = False
+                        break
+                count = count - skipped
+                if header and lines[-1] != b"" and not lines[-1].startswith(HEADER_PREFIXES):
+                    header = False
+            count = count + block.count(b"\n")
+            last = block[-1:]
+    # last interval without a newline
+    if last != b"\n" and not header:
+        count = count + 1
+    return count
+
+
+def read_counts(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def write_counts(cache_path, counts):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(counts, f)
+    os.replace(temp_path, cache_path)
+
+
+def cached_interval_counts(paths, cache_path=config.INTERVAL_COUNT_CACHE):
+    """ interval counts of many bed files, counted in the worker pool. Counts are
+    kept by path with the size and mtime they were taken at, files that have not
+    changed since are not read again
+    Returns
+    -------
+    counts: dict
+        {path: interval count}
+    """
+    cached = read_counts(cache_path)
+    counts = {}
+    stamps = {}
+    stale = []
+    for path in paths:
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        stamps[key] = [stat.st_size, stat.st_mtime]
+        entry = cached.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            counts[path] = entry["intervals"]
+        else:
+            stale.append(path)
+    if len(stale) > 0:
+        for path, count in zip(stale, get_pool().map(count_intervals, stale)):
+            counts[path] = count
+            key = os.path.abspath(path)
+            cached[key] = {"size": stamps[key][0], "mtime": stamps[key][1], "intervals": count}
+        write_counts(cache_path, cached)
+    return counts
@@ -0,0 +1,320 @@
+from config import config
+import os
+import abc
+import glob
+import json
+import math
+import shutil
+import subprocess
+import numpy as np
+import pandas as pd
+from bed_sort import bed_frames
+from query_metrics import timed_lines, engine_timer
+from giggle_output import giggle_lines, parse_interval_search, parse_file_search, parse_regions_search, strip_data_folder, to_columns, FILE_RESULT_COLUMNS, INTERVAL_RESULT_COLUMNS, REGIONS_RESULT_COLUMNS
+
+config = config
+
+# array keys are file id << FILE_SHIFT | position, positions must stay below 2**40
+FILE_SHIFT = 40
+
+# genome size giggle search -s assumes for its fisher tests
+GENOME_SIZE = 3095677412
+
+# query interval x file lookups held at a time
+LOOKUP_CHUNK = 1000000
+
+
+class IntervalEngine(abc.ABC):
+    """ Builds an index from a folder of sorted bed.gz files and searches it,
+    each search returns the columns of the matching giggle search output
+    """
+    name = ""
+
+    @abc.abstractmethod
+    def index_path(self, index):
+        pass
+
+    def has_index(self, index):
+        return os.path.exists(self.index_path(index))
+
+    def remove(self, index):
+        shutil.rmtree(self.index_path(index), ignore_errors=True)
+
+    @abc.abstractmethod
+    def build(self, data_path, index):
+        pass
+
+    @abc.abstractmethod
+    def search_interval(self, index, interval):
+        """ columns of INTERVAL_RESULT_COLUMNS, one row per file """
+
+    @abc.abstractmethod
+    def search_regions(self, index, query_path):
+        """ columns of REGIONS_RESULT_COLUMNS, one row per region and file with overlaps """
+
+    @abc.abstractmethod
+    def search_file(self, index, path):
+        """ columns of FILE_RESULT_COLUMNS, one row per file """
+
+##########
+# GIGGLE #
+##########
+
+class GiggleEngine(IntervalEngine):
+    """ Runs the giggle binary, indices are kept in indices/<index>.d """
+    name = "giggle"
+
+    def index_path(self, index):
+        return "indices/{}.d".format(index)
+
+    def build(self, data_path, index):
+        cmd_str = 'giggle index -i \"{}/*.bed.gz\" -o {}  -f -s'.format(data_path, self.index_path(index))
+        print(cmd_str)
+        subprocess.check_output(cmd_str, timeout=config.timeout_file_processing, shell=True)
+
+    def search_interval(self, index, interval):
+        lines = timed_lines(giggle_lines(["search", "-i", self.index_path(index), "-r", interval]))
+        return to_columns(parse_interval_search(lines), INTERVAL_RESULT_COLUMNS)
+
+    def search_regions(self, index, query_path):
+        lines = timed_lines(giggle_lines(["search", "-i", self.index_path(index), "-q", query_path, "-v"]))
+        return to_columns(parse_regions_search(lines), REGIONS_RESULT_COLUMNS)
+
+    def search_file(self, index, path):
+        columns, records = parse_file_search(timed_lines(giggle_lines(["search", "-i", self.index_path(index), "-q", path, "-s"])))
+        return to_columns(records, columns)
+
+#########
+# NUMPY #
+#########
+
+class NumpyEngine(IntervalEngine):
+    """ Keeps the intervals of an index in indices/<index>.npy as .npy arrays, for
+    each chromosome the starts and, separately, the ends of every file as sorted
+    file id << FILE_SHIFT | position keys. The overlaps of [start, end] with a file
+    are its starts <= end minus its ends < start, both a binary search, and the
+    counts of earlier files cancel out so every file is searched at once.
+    Arrays are memory mapped, worker processes share them through the page cache
+    """
+    name = "numpy"
+
+    def __init__(self):
+        self.opened = {}  # index path -> (mtime, meta, {chrom: (starts, ends)})
+
+    def index_path(self, index):
+        return "indices/{}.npy".format(index)
+
+    def build(self, data_path, index):
+        files = sorted(glob.glob(os.path.join(data_path, "*.bed.gz")))
+        chroms = []
+        starts = []
+        ends = []
+        file_ids = []
+        sizes = []
+        widths = []
+        for file_id, path in enumerate(files):
+            intervals = 0
+            width = 0
+            for frame in bed_frames(path):
+                chroms.append(normalize_chroms(frame["chrom"]))
+                starts.append(frame["start"].to_numpy(dtype=np.int64))
+                ends.append(frame["end"].to_numpy(dtype=np.int64))
+                file_ids.append(np.full(len(frame), file_id, dtype=np.int64))
+                intervals = intervals + len(frame)
+                width = width + int((ends[-1] - starts[-1]).sum())
+            sizes.append(intervals)
+            widths.append(width/intervals if intervals > 0 else 0)
+
+        path = self.index_path(index)
+        temp_path = path + ".tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        meta = {"files": [strip_data_folder(f) for f in files], "sizes": sizes, "mean_widths": widths, "chroms": {}}
+        if len(chroms) > 0:
+            chroms, starts, ends, file_ids = [np.concatenate(arrays) for arrays in [chroms, starts, ends, file_ids]]
+            codes, names = pd.factorize(chroms)
+            for code, chrom in enumerate(names):
+                on_chrom = codes == code
+                keys = file_ids[on_chrom] << FILE_SHIFT
+                np.save(os.path.join(temp_path, "{}.starts.npy".format(code)), np.sort(keys | starts[on_chrom]))
+                np.save(os.path.join(temp_path, "{}.ends.npy".format(code)), np.sort(keys | ends[on_chrom]))
+                meta["chroms"][chrom] = code
+        with open(os.path.join(temp_path, "index.json"), "w") as f:
+            json.dump(meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(temp_path, path)
+
+    def open(self, index):
+        """ returns the meta and memory mapped arrays of an index, kept open until it is rebuilt """
+        path = self.index_path(index)
+        mtime = os.path.getmtime(os.path.join(path, "index.json"))
+        if path not in self.opened or self.opened[path][0] != mtime:
+            with open(os.path.join(path, "index.json")) as f:
+                meta = json.load(f)
+            arrays = {chrom: (np.load(os.path.join(path, "{}.starts.npy".format(code)), mmap_mode="r"),
+                              np.load(os.path.join(path, "{}.ends.npy".format(code)), mmap_mode="r"))
+                      for chrom, code in meta["chroms"].items()}
+            self.opened[path] = (mtime, meta, arrays)
+        return self.opened[path][1], self.opened[path][2]
+
+    def file_counts(self, index, chroms, starts, ends):
+        """ yields the overlaps of query intervals with each file of the index, a batch at a time
+        Returns
+        -------
+        rows, counts: tuple
+            rows of the query intervals in the batch and their counts, shape (rows, files)
+        """
+        meta, arrays = self.open(index)
+        file_count = len(meta["files"])
+        if file_count == 0:
+            return
+        bases = np.arange(file_count, dtype=np.int64) << FILE_SHIFT
+        chunk = max(1, LOOKUP_CHUNK//file_count)
+        for chrom in np.unique(chroms):
+            if chrom not in arrays:
+                continue
+            index_starts, index_ends = arrays[chrom]
+            chrom_rows = np.flatnonzero(chroms == chrom)
+            for i in range(0, len(chrom_rows), chunk):
+                rows = chrom_rows[i:i + chunk]
+                with engine_timer():
+                    started = np.searchsorted(index_starts, (bases[None, :] | ends[rows, None]).ravel(), "right")
+                    ended = np.searchsorted(index_ends, (bases[None, :] | starts[rows, None]).ravel(), "left")
+                yield rows, (started - ended).reshape(len(rows), file_count)
+
+    def search_interval(self, index, interval):
+        chrom, bounds = interval.split(":")
+        start, end = [int(i) for i in bounds.split("-")]
+        meta, _ = self.open(index)
+        overlaps = np.zeros(len(meta["files"]), dtype=np.int64)
+        for _, counts in self.file_counts(index, normalize_chroms(pd.Series([chrom])), np.array([start]), np.array([end])):
+            overlaps = overlaps + counts[0]
+        return to_columns(zip(meta["files"], meta["sizes"], overlaps), INTERVAL_RESULT_COLUMNS)
+
+    def search_regions(self, index, query_path):
+        meta, _ = self.open(index)
+        query = read_query(query_path)
+        overlaps = {}
+        for rows, counts in self.file_counts(index, query["chrom"], query["start"], query["end"]):
+            for row, file_id in zip(*np.nonzero(counts)):
+                key = (query["name"][rows[row]], meta["files"][file_id])
+                overlaps[key] = overlaps.get(key, 0) + int(counts[row, file_id])
+        return to_columns([(region, file, count) for (region, file), count in overlaps.items()], REGIONS_RESULT_COLUMNS)
+
+    def search_file(self, index, path):
+        meta, _ = self.open(index)
+        query = read_query(path)
+        overlaps = np.zeros(len(meta["files"]), dtype=np.int64)
+        for _, counts in self.file_counts(index, query["chrom"], query["start"], query["end"]):
+            overlaps = overlaps + counts.sum(axis=0)
+        query_width = float((query["end"] - query["start"]).mean()) if len(query["start"]) > 0 else 0
+        records = []
+        for file, size, width, n11 in zip(meta["files"], meta["sizes"], meta["mean_widths"], overlaps):
+            records.append([file, size, int(n11)] + enrichment(int(n11), len(query["start"]), size, query_width + width))
+        return to_columns(records, FILE_RESULT_COLUMNS)
+
+
+def normalize_chroms(chroms):
+    # same as setup_indices.normalize_chrom, giggle matches chromosomes with or without the chr prefix
+    return chroms.str.replace("^[cC][hH][rR]", "", regex=True).to_numpy(dtype=object)
+
+
+def read_query(path):
+    """ chrom, start, end and name arrays of a bed(.gz) or vcf(.gz) query file,
+    the name is the fourth bed column or Chr:#-# when there is none
+    """
+    if ".vcf" in path:
+        try:
+            frame = pd.read_csv(path, sep="\t", comment="#", header=None, usecols=[0, 1, 3], dtype={0: str, 3: str})
+        except pd.errors.EmptyDataError:
+            frame = pd.DataFrame({0: [], 1: [], 3: []})
+        chroms = frame[0].astype(str)
+        starts = frame[1].to_numpy(dtype=np.int64) - 1
+        ends = starts + frame[3].astype(str).str.len().to_numpy(dtype=np.int64)
+        names = (chroms + ":" + pd.Series(starts).astype(str) + "-" + pd.Series(ends).astype(str)).to_numpy(dtype=object)
+    else:
+        frames = list(bed_frames(path))
+        frame = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame({"chrom": [], "start": [], "end": [], "line": []})
+        chroms = frame["chrom"].astype(str)
+        starts = frame["start"].to_numpy(dtype=np.int64)
+        ends = frame["end"].to_numpy(dtype=np.int64)
+        fields = frame["line"].astype(str).str.rstrip("\r\n").str.split("\t")
+        names = fields.str[3].fillna(chroms + ":" + frame["start"].astype(str) + "-" + frame["end"].astype(str)).to_numpy(dtype=object)
+    return {"chrom": normalize_chroms(chroms), "start": starts, "end": ends, "name": names}
+
+
+def enrichment(n11, query_size, file_size, combined_width):
+    """ odds ratio, fisher two, left and right tail and combo score of a file the
+    way giggle search -s reports them
+    Parameters
+    ----------
+    n11: int
+        overlaps of the query with the file
+    query_size, file_size: int
+        intervals in the query and in the file
+    combined_width: float
+        mean interval width of the query plus that of the file
+    """
+    n12 = max(0, query_size - n11)
+    n21 = max(0, file_size - n11)
+    n22_full = max(n11 + n12 + n21, int(GENOME_SIZE/combined_width) if combined_width > 0 else 0)
+    n22 = max(0, n22_full - (n11 + n12 + n21))
+    left, right, two = fisher_exact(n11, n12, n21, n22)
+    ratio = ((n11 + 1)/(n12 + 1))/((n21 + 1)/(n22 + 1))
+    combo = math.log2(ratio)*-math.log10(max(right, np.finfo(float).tiny))
+    return [ratio, two, left, right, combo]
+
+
+def fisher_exact(n11, n12, n21, n22):
+    """ left, right and two tailed p values of a 2x2 table, as kt_fisher_exact in giggle.
+    The hypergeometric probabilities of the table's support are built from the
+    ratio of consecutive terms so no factorial is ever evaluated
+    """
+    row = n11 + n12
+    column = n11 + n21
+    n = n11 + n12 + n21 + n22
+    low = max(0, row + column - n)
+    high = min(row, column)
+    k = np.arange(low, high, dtype=np.float64)
+    log_ratios = np.log(row - k) + np.log(column - k) - np.log(k + 1) - np.log(n - row - column + k + 1)
+    log_p = np.concatenate([[0.0], np.cumsum(log_ratios)])
+    p = np.exp(log_p - log_p.max())
+    p = p/p.sum()
+    observed = p[n11 - low]
+    left = min(1.0, float(p[:n11 - low + 1].sum()))
+    right = min(1.0, float(p[n11 - low:].sum()))
+    two = min(1.0, float(p[p <= observed*(1 + 1e-7)].sum()))
+    return left, right, two
+
+###########
+# ENGINES #
+###########
+
+ENGINES = {"giggle": GiggleEngine(), "numpy": NumpyEngine()}
+
+
+def build_engine():
+    """ the engine setup and update build new indices with, INDEX_ENGINE """
+    if config.INDEX_ENGINE not in ENGINES:
+        print("ERROR: Index engine {} not supported, use one of {}".format(config.INDEX_ENGINE, ", ".join(ENGINES)))
+        raise ValueError(config.INDEX_ENGINE)
+    return ENGINES[config.INDEX_ENGINE]
+
+
+def index_engine(index):
+    """ the engine to search an index with, INDEX_ENGINE when it has the index,
+    otherwise the engine that built it
+    """
+    engine = build_engine()
+    if engine.has_index(index):
+        return engine
+    for other in ENGINES.values():
+        if other.has_index(index):
+            return other
+    return engine
+
+
+def remove_index(index):
+    """ deletes the files every engine keeps for an index """
+    for engine in ENGINES.values():
+        engine.remove(index)
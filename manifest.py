@@ -0,0 +1,157 @@
+from config import config
+import os
+import numpy as np
+import pandas as pd
+from download_engine import DownloadEngine
+from blob_cache import file_hash
+
+config = config
+
+# what is known about the source of each indexed file, stored in MANIFEST
+MANIFEST_COLUMNS = ["FILEID", "SOURCE", "REMOTESIZE", "ETAG", "MODIFIED", "MTIME", "HASH"]
+
+# a file is changed when any of these differ from its manifest entry
+CHANGE_COLUMNS = ["REMOTESIZE", "ETAG", "MODIFIED", "HASH"]
+
+################
+# FINGERPRINTS #
+################
+
+def file_source(file_info):
+    params = file_info["download_params"]
+    if "download_location" in params:
+        return params["download_location"]
+    # tracks stored in the UCSC sql database
+    return "{}.{}".format(params["genome"], params["track"])
+
+
+def fingerprint_files(files_info, previous=None):
+    """ describes the current source of each file: remote files by their HTTP
+    headers, local files by size, mtime and content hash, database tracks by
+    their item count
+    Parameters
+    ----------
+    files_info: dict
+        {track: file info} as collected by setup_indices.py
+    previous: DataFrame
+        manifest rows, the hash of a local file is reused while its size and mtime are unchanged
+    Returns
+    -------
+    fingerprints: DataFrame
+        one row per file with MANIFEST_COLUMNS
+    """
+    previous = {} if previous is None else {row["FILEID"]: row for _, row in previous.iterrows()}
+    sources = {track: file_source(info) for track, info in files_info.items()}
+    remote = [source for source in sources.values() if source.startswith("http://") or source.startswith("https://")]
+    headers = DownloadEngine().remote_headers(remote)
+
+    rows = []
+    for track, info in files_info.items():
+        source = sources[track]
+        row = {"FILEID": track, "SOURCE": source, "REMOTESIZE": None, "ETAG": None, "MODIFIED": None, "MTIME": None, "HASH": None}
+        if source in headers:
+            if headers[source] is not None:
+                row["REMOTESIZE"] = headers[source]["size"]
+                row["ETAG"] = headers[source]["etag"]
+                row["MODIFIED"] = headers[source]["modified"]
+        elif os.path.isfile(source):
+            row["REMOTESIZE"] = os.path.getsize(source)
+            row["MTIME"] = os.path.getmtime(source)
+            old = previous.get(track)
+            if old is not None and old["REMOTESIZE"] == row["REMOTESIZE"] and old["MTIME"] == row["MTIME"] and pd.notna(old["HASH"]):
+                row["HASH"] = old["HASH"]
+            else:
+                row["HASH"] = file_hash(source)
+        else:
+            row["REMOTESIZE"] = info["file_size"]
+        rows.append(row)
+    return pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+
+###############
+# UPDATE PLAN #
+###############
+
+def read_manifest(conn, project_id):
+    cursor = conn.execute("SELECT {} from MANIFEST WHERE PROJECTID=?".format(", ".join(MANIFEST_COLUMNS)), (project_id,))
+    return pd.DataFrame(cursor.fetchall(), columns=MANIFEST_COLUMNS)
+
+
+def changed_rows(current, recorded):
+    """ True where a fingerprint differs from its manifest entry, a value that is unknown on either side is not compared """
+    changed = np.zeros(len(current), dtype=bool)
+    for column in CHANGE_COLUMNS:
+        if column == "REMOTESIZE":
+            a = pd.to_numeric(current[column]).to_numpy(dtype=float)
+            b = pd.to_numeric(recorded[column]).to_numpy(dtype=float)
+        else:
+            a = current[column].to_numpy(dtype=object)
+            b = recorded[column].to_numpy(dtype=object)
+        known = ~(pd.isna(a) | pd.isna(b))
+        changed |= known & (a.astype(str) != b.astype(str))
+    return changed
+
+
+def plan_update(conn, project_id, files_info):
+    """ compares the files found at the source with the indexed files and their
+    manifest in one pass
+    Returns
+    -------
+    plan: dict
+        "new", "changed", "removed" and "unchanged" dataframes of FILEID (and
+        INDEXID for indexed files), "fingerprints" of every file found
+    """
+    indexed = pd.DataFrame(conn.execute("SELECT FILEID, INDEXID from FILES WHERE PROJECTID=?", (project_id,)).fetchall(), columns=["FILEID", "INDEXID"])
+    manifest = read_manifest(conn, project_id)
+    fingerprints = fingerprint_files(files_info, manifest)
+
+    merged = fingerprints.merge(indexed, on="FILEID", how="outer", indicator="state")
+    both = merged[merged["state"] == "both"]
+    recorded = both[["FILEID"]].merge(manifest, on="FILEID", how="left")
+    # files indexed before the manifest existed are taken as unchanged and recorded
+    changed = changed_rows(both.reset_index(drop=True), recorded)
+    return {"new": merged.loc[merged["state"] == "left_only", ["FILEID"]],
+            "changed": both.loc[changed, ["FILEID", "INDEXID"]],
+            "removed": merged.loc[merged["state"] == "right_only", ["FILEID", "INDEXID"]],
+            "unchanged": both.loc[~changed, ["FILEID", "INDEXID"]],
+            "fingerprints": fingerprints}
+
+
+def plan_cost(plan, files_info):
+    """ estimated work of applying a plan """
+    fetch = pd.concat([plan["new"]["FILEID"], plan["changed"]["FILEID"]])
+    fingerprints = plan["fingerprints"].set_index("FILEID")
+    remote = fingerprints.loc[fetch[fetch.isin(fingerprints.index)], ["SOURCE", "REMOTESIZE"]]
+    remote = remote[remote["SOURCE"].str.startswith("http")]
+    return {"new": len(plan["new"]),
+            "changed": len(plan["changed"]),
+            "removed": len(plan["removed"]),
+            "unchanged": len(plan["unchanged"]),
+            "download_MB": round(float(pd.to_numeric(remote["REMOTESIZE"]).fillna(0).sum())/1000/1000, 2),
+            "intervals": int(sum([files_info[f]["file_size"] for f in fetch if f in files_info])),
+            "indices_touched": int(pd.concat([plan["changed"]["INDEXID"], plan["removed"]["INDEXID"]]).nunique())}
+
+###################
+# APPLYING A PLAN #
+###################
+
+def retire_files(conn, project_id, rows):
+    """ removes files from the catalog, their intervals stay in the giggle
+    index until it is rebuilt so they are recorded in TOMBSTONES and dropped
+    from query results
+    """
+    rows = [(index_id, file_id) for file_id, index_id in zip(rows["FILEID"], rows["INDEXID"])]
+    conn.executemany("INSERT INTO TOMBSTONES (INDEXID, FILEID) VALUES (?, ?)", rows)
+    conn.executemany("UPDATE INDICES SET SIZE = SIZE - (SELECT SUM(SIZE) from FILES WHERE INDEXID=? AND FILEID=?) WHERE INDEXID=?",
+                     [(index_id, file_id, index_id) for index_id, file_id in rows])
+    conn.executemany("DELETE FROM FILES WHERE INDEXID=? AND FILEID=?", rows)
+    conn.executemany("DELETE FROM MANIFEST WHERE PROJECTID=? AND FILEID=?", [(project_id, file_id) for _, file_id in rows])
+
+
+def record_manifest(conn, project_id, fingerprints):
+    """ stores the fingerprints of the files of a project that are indexed """
+    indexed = set([i[0] for i in conn.execute("SELECT FILEID from FILES WHERE PROJECTID=?", (project_id,))])
+    fingerprints = fingerprints[fingerprints["FILEID"].isin(indexed)]
+    fingerprints = fingerprints.astype(object).where(pd.notna(fingerprints), None)
+    conn.executemany("DELETE FROM MANIFEST WHERE PROJECTID=? AND FILEID=?", [(project_id, f) for f in fingerprints["FILEID"]])
+    conn.executemany("INSERT INTO MANIFEST (PROJECTID, {}) VALUES (?, {})".format(", ".join(MANIFEST_COLUMNS), ", ".join(["?"]*len(MANIFEST_COLUMNS))),
+                     [[project_id] + list(row) for row in fingerprints.itertuples(index=False, name=None)])
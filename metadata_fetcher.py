@@ -0,0 +1,86 @@
+from config import config
+import os
+import json
+import asyncio
+import hashlib
+import aiohttp
+
+config = config
+
+
+class MetadataFetcher:
+    """ Fetches many small pages (hub track descriptions) concurrently over one
+    pooled session. Responses are kept on disk by URL and revalidated with
+    If-None-Match / If-Modified-Since, so unchanged pages cost a 304
+    """
+    def __init__(self, cache_folder=config.METADATA_CACHE_FOLDER, concurrency=config.METADATA_CONCURRENCY, timeout=config.timeout_file_download):
+        self.cache_folder = cache_folder
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.revalidated = 0
+        self.fetched = 0
+        self.failed = 0
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_folder, hashlib.sha1(url.encode()).hexdigest())
+
+    def cached(self, url):
+        """ returns (headers, body) stored for url, (None, None) if not cached """
+        path = self.cache_path(url)
+        if not (os.path.exists(path + ".json") and os.path.exists(path + ".body")):
+            return None, None
+        with open(path + ".json") as f:
+            headers = json.load(f)
+        with open(path + ".body", "rb") as f:
+            return headers, f.read()
+
+    def store(self, url, headers, body):
+        path = self.cache_path(url)
+        with open(path + ".body", "wb") as f:
+            f.write(body)
+        with open(path + ".json", "w") as f:
+            json.dump({"url": url, "etag": headers.get("ETag"), "modified": headers.get("Last-Modified")}, f)
+
+    async def fetch_one(self, session, semaphore, url):
+        headers, body = self.cached(url)
+        request_headers = {}
+        if headers is not None:
+            if headers["etag"]:
+                request_headers["If-None-Match"] = headers["etag"]
+            if headers["modified"]:
+                request_headers["If-Modified-Since"] = headers["modified"]
+        async with semaphore:
+            try:
+                async with session.get(url, headers=request_headers) as response:
+                    if response.status == 304 and body is not None:
+                        self.revalidated += 1
+                        return body
+                    if response.status == 200:
+                        content = await response.read()
+                        self.store(url, response.headers, content)
+                        self.fetched += 1
+                        return content
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        # unreachable pages fall back to the cached copy
+        self.failed += 1
+        return body if body is not None else b""
+
+    async def fetch_all(self, urls):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            bodies = await asyncio.gather(*[self.fetch_one(session, semaphore, url) for url in urls])
+        return dict(zip(urls, bodies))
+
+    def fetch(self, urls):
+        """ returns {url: body bytes} for each distinct url, b"" when a page could not be fetched or found in the cache """
+        urls = list(dict.fromkeys(urls))
+        if len(urls) == 0:
+            return {}
+        return asyncio.run(self.fetch_all(urls))
+
+    def stats(self):
+        return {"fetched": self.fetched, "revalidated": self.revalidated, "failed": self.failed}
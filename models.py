@@ -1,48 +1,11 @@
 from config import config
-import sqlite3
+import catalog
 
 config = config
-conn = sqlite3.connect(config.DB)
+conn = catalog.connect(config.DB, create=False)
 
-conn.execute('''DROP TABLE IF EXISTS GENOMES;''')
-conn.execute('''CREATE TABLE GENOMES
-         (GENOME     TEXT    NOT NULL,
-          SCINAME    TEXT,
-          COMMONNAME TEXT,
-          DESCRIPTION TEXT);''')
+catalog.create_tables(conn, drop=True)
 
-conn.execute('''DROP TABLE IF EXISTS PROJECTS;''')
-conn.execute('''CREATE TABLE PROJECTS
-         (PROJECTID    TEXT    NOT NULL,
-          OSOURCE    TEXT    NOT NULL,
-          DSOURCE    TEXT    NOT NULL,
-          SHORTNAME  TEXT    NOT NULL,
-          LONGNAME   TEXT    NOT NULL,
-          INFO       TEXT    NOT NULL);''')
-
-conn.execute('''DROP TABLE IF EXISTS INDICES;''')
-conn.execute('''CREATE TABLE INDICES
-         (INDEXID   TEXT    NOT NULL,
-          ITER      INT     NOT NULL,
-          DATE      NUMERIC NOT NULL,
-          PROJECTID TEXT    NOT NULL,
-          DSOURCE   TEXT    NOT NULL,
-          GENOME    TEXT    NOT NULL,
-          FULL      BOOL    NOT NULL,
-          SIZE      INT     NOT NULL);''')
-
-conn.execute('''DROP TABLE IF EXISTS FILES;''')
-conn.execute('''CREATE TABLE FILES
-         (FILEID    TEXT     NOT NULL,
-          SIZE      INT      NOT NULL,
-          GENOME    TEXT     NOT NULL,
-          PROJECTID TEXT     NOT NULL,
-          INDEXID   TEXT     NOT NULL,
-          SHORTNAME TEXT,
-          LONGNAME  TEXT,
-          SHORTINFO TEXT,
-          LONGINFO  TEXT);''')
-
-print("Database created. Tables initialized PROJECTS, FILES and INDICES")
+print("Database created. Tables initialized {}".format(", ".join(catalog.TABLES)))
 conn.commit()
 conn.close()
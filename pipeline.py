@@ -0,0 +1,74 @@
+from config import config
+import time
+import queue
+import threading
+
+config = config
+
+# marks the end of the items passed between stages
+DONE = object()
+
+
+class Pipeline:
+    """ Runs each stage in its own thread, connected by bounded queues, so an
+    item can be in one stage while the next item is still in the stage before.
+    A stage returning None drops the item, an exception in a stage is printed
+    and drops the item.
+    Parameters
+    ----------
+    stages: list
+        [(name, function)] applied in order
+    queue_size: int
+        items waiting between two stages before the earlier stage blocks
+    """
+    def __init__(self, stages, queue_size=config.PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.timings = {name: {"items": 0, "failed": 0, "busy": 0} for name, _ in stages}
+
+    def run_stage(self, name, func, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                outbox.put(DONE)
+                return
+            started = time.time()
+            try:
+                result = func(item)
+                error = None
+            except Exception as e:
+                result = None
+                error = e
+                print("Pipeline stage {} failed: {}".format(name, e))
+            with self.lock:
+                self.timings[name]["items"] += 1
+                self.timings[name]["failed"] += 0 if error is None else 1
+                self.timings[name]["busy"] += time.time() - started
+            if result is not None:
+                outbox.put(result)
+
+    def feed(self, items, outbox):
+        for item in items:
+            outbox.put(item)
+        outbox.put(DONE)
+
+    def run(self, items):
+        """ yields the output of the last stage for each item, in order """
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.feed, args=(items, queues[0]), daemon=True)]
+        for i, (name, func) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self.run_stage, args=(name, func, queues[i], queues[i+1]), daemon=True))
+        for thread in threads:
+            thread.start()
+        while True:
+            item = queues[-1].get()
+            if item is DONE:
+                break
+            yield item
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {name: dict(timing) for name, timing in self.timings.items()}
@@ -0,0 +1,212 @@
+from config import config
+import os
+import json
+import pickle
+import hashlib
+import sqlite3
+import time
+import threading
+import uuid
+from collections import OrderedDict
+
+config = config
+
+# seconds between merges of the hit and miss counters of a process into the stats file
+STATS_SAVE_INTERVAL = 30
+
+#####################
+# INDEX SET VERSION #
+#####################
+
+def index_version(conn):
+    """ returns the version of the index set, changes whenever INDICES or indices/*.d are rewritten """
+    try:
+        out = conn.execute("SELECT VERSION from VERSION").fetchall()
+    except sqlite3.OperationalError:  # databases created before VERSION existed
+        return ""
+    return out[0][0] if len(out) > 0 else ""
+
+
+def bump_index_version(conn):
+    """ gives the index set a new version so that cached query results are no longer used """
+    conn.execute("DELETE FROM VERSION")
+    conn.execute("INSERT INTO VERSION (VERSION) VALUES (?)", (uuid.uuid4().hex,))
+
+################
+# RESULT CACHE #
+################
+
+class QueryCache:
+    """ LRU cache of query results, kept in memory and on disk.
+    Entries are keyed by the query, the genome and the index set version so
+    a rebuilt or updated index set never serves old results, stale entries
+    are evicted as the cache fills. Hit and miss counters are kept in memory
+    and merged into the stats file shared between runs by save_stats.
+    """
+    def __init__(self, folder=config.CACHE_FOLDER, max_MB=config.CACHE_MAX_MB, memory_MB=config.CACHE_MEMORY_MB):
+        self.folder = folder
+        self.max_bytes = max_MB*1000*1000
+        self.memory_max_bytes = memory_MB*1000*1000
+        self.memory = OrderedDict()  # key: [result, size in bytes]
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self.unsaved = {}  # counts not yet merged into the stats file
+        self.saved = time.time()
+        os.makedirs(folder, exist_ok=True)
+        # disk entries in least recently used order, listed once and then kept up to date
+        self.disk = OrderedDict([(f[:-len(".pkl")], size) for _, size, f in sorted(self.disk_entries())])
+        self.disk_bytes = sum(self.disk.values())
+
+    @staticmethod
+    def key(kind, query, genome, version):
+        return hashlib.sha1("{}|{}|{}|{}".format(kind, query, genome, version).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.folder, key + ".pkl")
+
+    def get(self, key):
+        """ returns the cached result for key or None """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.count("memory_hits")
+                return self.memory[key][0]
+
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            os.utime(path)  # mark as recently used
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self.lock:
+                self.count("misses")
+            return None
+
+        size = os.path.getsize(path)
+        with self.lock:
+            self.count("disk_hits")
+            self.add_to_disk(key, size)
+            self.add_to_memory(key, result, size)
+        return result
+
+    def put(self, key, result):
+        path = self.entry_path(key)
+        temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(temp_path, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.add_to_disk(key, size)
+            self.add_to_memory(key, result, size)
+            self.evict_disk()
+
+    def add_to_memory(self, key, result, size):
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[1]
+        self.memory[key] = [result, size]
+        self.memory_bytes += size
+        while self.memory_bytes > self.memory_max_bytes and len(self.memory) > 0:
+            _, (_, evicted_size) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted_size
+
+    def add_to_disk(self, key, size):
+        if key in self.disk:
+            self.disk_bytes -= self.disk.pop(key)
+        self.disk[key] = size
+        self.disk_bytes += size
+
+    def disk_entries(self):
+        entries = []
+        for f in os.listdir(self.folder):
+            if f.endswith(".pkl"):
+                stat = os.stat(os.path.join(self.folder, f))
+                entries.append([stat.st_mtime, stat.st_size, f])
+        return entries
+
+    def evict_disk(self):
+        # remove least recently used entries until the cache is within budget
+        while self.disk_bytes > self.max_bytes and len(self.disk) > 0:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            if key in self.memory:
+                self.memory_bytes -= self.memory.pop(key)[1]
+            try:
+                os.remove(self.entry_path(key))
+            except OSError:
+                pass
+            self.count("evictions")
+
+    def count(self, counter):
+        """ increments a counter, counts are merged into the stats file every STATS_SAVE_INTERVAL seconds """
+        self.counters[counter] += 1
+        self.unsaved[counter] = self.unsaved.get(counter, 0) + 1
+        if time.time() - self.saved > STATS_SAVE_INTERVAL:
+            self.write_stats()
+
+    def read_stats(self):
+        try:
+            with open(os.path.join(self.folder, "stats.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_stats(self):
+        stats = self.read_stats()
+        for counter, value in self.unsaved.items():
+            stats[counter] = stats.get(counter, 0) + value
+        stats_path = os.path.join(self.folder, "stats.json")
+        temp_path = "{}.{}.tmp".format(stats_path, uuid.uuid4().hex)
+        with open(temp_path, "w") as f:
+            json.dump(stats, f)
+        os.replace(temp_path, stats_path)
+        self.unsaved = {}
+        self.saved = time.time()
+
+    def save_stats(self):
+        """ merges the counts of this process into the stats file shared between runs """
+        with self.lock:
+            if len(self.unsaved) > 0:
+                self.write_stats()
+
+    def stats(self):
+        """ returns the hit and miss counters of all runs along with the current cache size """
+        with self.lock:
+            stats = self.read_stats()
+            for counter, value in self.unsaved.items():
+                stats[counter] = stats.get(counter, 0) + value
+            disk_entries = len(self.disk)
+            disk_bytes = self.disk_bytes
+            memory_entries = len(self.memory)
+            memory_bytes = self.memory_bytes
+        hits = stats.get("memory_hits", 0) + stats.get("disk_hits", 0)
+        lookups = hits + stats.get("misses", 0)
+        return {"memory_hits": stats.get("memory_hits", 0),
+                "disk_hits": stats.get("disk_hits", 0),
+                "misses": stats.get("misses", 0),
+                "evictions": stats.get("evictions", 0),
+                "hit_rate": hits/lookups if lookups > 0 else 0,
+                "disk_entries": disk_entries,
+                "disk_bytes": disk_bytes,
+                "memory_entries": memory_entries,
+                "memory_bytes": memory_bytes,
+                "max_bytes": self.max_bytes,
+                "memory_max_bytes": self.memory_max_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            self.disk.clear()
+            self.disk_bytes = 0
+            self.unsaved = {}
+            # the folder is shared with the metadata cache, stage timings and query metrics
+            for f in os.listdir(self.folder):
+                if self.owns(f):
+                    os.remove(os.path.join(self.folder, f))
+
+    @staticmethod
+    def owns(f):
+        """ True for the entries, stats file and their temp files, the files of this cache """
+        return f.endswith(".pkl") or f == "stats.json" or (f.endswith(".tmp") and (".pkl." in f or f.startswith("stats.json.")))
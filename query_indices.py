@@ -2,17 +2,35 @@ import os.path
 from os import path
 import subprocess
 from config import config
-import sqlite3
+import catalog
 from sys import argv
 from clize import run
-from multiprocessing.pool import Pool
+from worker_pool import get_pool
 import multiprocessing 
 from functools import partial
 import pandas as pd
-from setup_indices import download_linked_file
+import tempfile
+import shutil
+import time
+import json
+import heapq
+import numpy as np
+from setup_indices import download_linked_file, bed_extents, normalize_chrom
+from query_cache import QueryCache, index_version
+from timings import load_spans
+from query_metrics import query_metrics, measured_query, query_kind, save_metrics, load_metrics, INDEX_SUMMARY_COLUMNS
+from interval_engine import index_engine
+from result_writer import open_writer
+from bgzf import BGZFWriter
+from giggle_output import empty_columns, FILE_RESULT_COLUMNS, INTERVAL_RESULT_COLUMNS, REGIONS_RESULT_COLUMNS
 
 config = config
-conn = sqlite3.connect(config.DB)
+conn = catalog.connect(config.DB)
+
+# file search columns results can be ranked by, higher is better except for the p values in ASCENDING_RANKS
+RANK_COLUMNS = ["combo_score", "odds_ratio", "overlaps", "fishers_right_tail", "fishers_two_tail"]
+ASCENDING_RANKS = ["fishers_right_tail", "fishers_two_tail"]
+
 
 def GENOMES(output_path=""):
     """"returns all currently hosted genomes"""
@@ -29,7 +47,7 @@ def PROJECTS(genome="", output_path=""):
         cursor = conn.execute("SELECT * from PROJECTS")
     else:
         validate_genome(genome)
-        cursor = conn.execute("SELECT P.PROJECTID, I.GENOME, P.OSOURCE, P.DSOURCE, P.SHORTNAME, P.LONGNAME, P.INFO  from PROJECTS as P left join INDICES as I on P.PROJECTID=I.PROJECTID WHERE I.GENOME='{}'".format(genome))
+        cursor = conn.execute("SELECT P.PROJECTID, I.GENOME, P.OSOURCE, P.DSOURCE, P.SHORTNAME, P.LONGNAME, P.INFO  from PROJECTS as P left join INDICES as I on P.PROJECTID=I.PROJECTID WHERE I.GENOME=?", (genome,))
 
     df = pd.DataFrame(cursor.fetchall(), columns = [i[0] for i in cursor.description])
 
@@ -58,7 +76,7 @@ def FILES(genome="", output_path=""):
         cursor = conn.execute("SELECT * from FILES")
     else:
         validate_genome(genome)
-        cursor = conn.execute("SELECT * from FILES WHERE GENOME='{}'".format(genome))
+        cursor = conn.execute("SELECT * from FILES WHERE GENOME=?", (genome,))
 
     df = pd.DataFrame(cursor.fetchall(), columns = [i[0] for i in cursor.description])
     
@@ -69,7 +87,7 @@ def FILES(genome="", output_path=""):
 
 
 def validate_source(source):
-    out = conn.execute("SELECT INDEXID from INDICES WHERE DSOURCE = '{}'".format(source))
+    out = conn.execute("SELECT INDEXID from INDICES WHERE DSOURCE GLOB ? LIMIT 1", (source,))
     source_valid = False
     for i in out:
         source_valid = True
@@ -81,7 +99,7 @@ def validate_source(source):
 
 
 def validate_genome(genome):
-    out = conn.execute("SELECT INDEXID from INDICES WHERE GENOME = '{}'".format(genome))
+    out = conn.execute("SELECT INDEXID from INDICES WHERE GENOME = ? LIMIT 1", (genome,))
     genome_valid = False
     for i in out:
         genome_valid = True
@@ -92,6 +110,58 @@ def validate_genome(genome):
         raise
 
 
+def validate_project(project):
+    out = conn.execute("SELECT INDEXID from INDICES WHERE PROJECTID GLOB ? LIMIT 1", (project,))
+    project_valid = False
+    for i in out:
+        project_valid = True
+        break
+
+    if not project_valid:
+        print("ERROR: Project {} not found in system, use -p to find valid projects".format(project))
+        raise
+
+
+def split_scope(value):
+    """ 'hg19, hg38' -> ['hg19', 'hg38'] """
+    return [v.strip() for v in value.split(",") if v.strip() != ""]
+
+
+def validate_scope(genome, source="", project=""):
+    """ checks every genome of a comma separated list, and every source and project pattern, matches hosted indices """
+    if len(split_scope(genome)) == 0:
+        print("ERROR: No genome given, use -g to find valid genomes")
+        raise
+    for g in split_scope(genome):
+        validate_genome(g)
+    for s in split_scope(source):
+        validate_source(s)
+    for p in split_scope(project):
+        validate_project(p)
+
+
+def scope_where(genome, source="", project=""):
+    """ WHERE clause and parameters selecting the INDICES (as I) of one or more genomes,
+    optionally only those whose DSOURCE and PROJECTID match one of the given glob patterns
+    Parameters
+    ----------
+    genome, source, project: string
+        comma separated genomes, DSOURCE patterns and PROJECTID patterns, ex. "hg19,hg38", "UCSC", "UCSC_hg19_*"
+    """
+    clauses = []
+    params = []
+    for column, operator, values in [("GENOME", "=", split_scope(genome)), ("DSOURCE", "GLOB", split_scope(source)), ("PROJECTID", "GLOB", split_scope(project))]:
+        if len(values) > 0:
+            clauses.append("(" + " OR ".join(["I.{} {} ?".format(column, operator)]*len(values)) + ")")
+            params.extend(values)
+    return " AND ".join(clauses), params
+
+
+def scope_key(genome, source="", project=""):
+    # query cache key of a scope, unscoped queries keep the keys they had before scopes
+    return genome if source == "" and project == "" else "{}|{}|{}".format(genome, source, project)
+
+
 def validate_interval(interval):
     if len(interval.split("-")) != 2 or len(interval.split(":")) != 2:
         print("ERROR: Interval not in correct format Chr:#-# ex 1:200457776-200457776")
@@ -106,47 +176,238 @@ def validate_interval(interval):
 
 
 def query_interval_index(interval, index):
-    index_path = "indices/" + index + ".d"
-    cmd_str = 'giggle search -i ' + index_path + ' -r ' + interval
-    search_out = subprocess.check_output(cmd_str, shell=True)
-    cleaned_out = ""
-    for x in str(search_out).split('#')[2:]:
-        formatted_string = x[:-2].replace('\\t', ", ").replace('data/', "").replace("\\", "")
-        cleaned_out += formatted_string.replace("size:","").replace("overlaps:","") + "\n"
-    # cleaned_rows = [chunk.split("\n") for chunk in cleaned_out]
-    # print(cleaned_rows)
-    return cleaned_out.split("\n")
-
-
-def QUERY_INTERVAL(interval, genome, output_path="", metadata=False):
-    """Query a given interval in format 'Chr:#-#' <genome> <optional param: output_path>"""
-    validate_interval(interval)
-    validate_genome(genome)
+    return index_engine(index).search_interval(index, interval)
+
+
+def interval_extents(intervals):
+    """returns {chrom: [start, end]} covering a list of 'Chr:#-#' intervals"""
+    extents = {}
+    for interval in intervals:
+        chrom, bounds = interval.split(":")
+        chrom = normalize_chrom(chrom)
+        start, end = [int(i) for i in bounds.split("-")]
+        if chrom in extents:
+            extents[chrom] = [min(extents[chrom][0], start), max(extents[chrom][1], end)]
+        else:
+            extents[chrom] = [start, end]
+    return extents
+
+
+def prune_indices(indices, extent_rows, extents):
+    """ drops indices without intervals inside the extents of a query
+    Parameters
+    ----------
+    indices: list
+        INDEXIDs to prune
+    extent_rows: list
+        (INDEXID, CHROM, MINSTART, MAXEND) rows of EXTENTS
+    extents: dict
+        {chrom: [start, end, ...]} of the query
+    Returns
+    -------
+    indices: list
+        indices that can overlap the query, indices missing from EXTENTS are always kept
+    """
+    cataloged = set()
+    overlapping = set()
+    for index, chrom, min_start, max_end in extent_rows:
+        cataloged.add(index)
+        if chrom in extents and min_start <= extents[chrom][1] and max_end >= extents[chrom][0]:
+            overlapping.add(index)
+    return [i for i in indices if i not in cataloged or i in overlapping]
+
+
+def genome_indices(genome, extents=None, source="", project=""):
+    """returns the INDEXIDs hosted for one or more genomes, only those of matching sources and projects
+    when given (see scope_where), skipping indices that cannot overlap extents when given"""
+    where, params = scope_where(genome, source, project)
+    out = conn.execute("SELECT I.INDEXID from INDICES as I WHERE " + where, params)
+    indices = list([i[0] for i in out])  # reformat sql results into list
+    if extents is None:
+        return indices
+    out = conn.execute("SELECT E.INDEXID, E.CHROM, E.MINSTART, E.MAXEND from EXTENTS as E join INDICES as I on E.INDEXID=I.INDEXID WHERE " + where, params)
+    return prune_indices(indices, out.fetchall(), extents)
 
-    out = conn.execute("SELECT INDEXID from INDICES WHERE GENOME = '{}'".format(genome))
 
-    indices = list([i[0] for i in out])  # reformat sql results into list
+def files_metadata(index_ids):
+    """returns the FILES metadata of the given indices as a dataframe"""
+    index_ids = list(index_ids)
+    cursor = conn.execute("SELECT * from FILES WHERE INDEXID IN ({})".format(",".join(["?"]*len(index_ids))), index_ids)
+    return pd.DataFrame(cursor.fetchall(), columns=[i[0].replace(" ", "") for i in cursor.description])
+
+
+def add_file_ids(df):
+    parts = df["file"].str.replace(".bed.gz", "", regex=False).str.split("/")
+    df["FILEID"] = parts.str[-1]
+    df["INDEXID"] = parts.str[-2]
+    return df
+
+
+def index_tombstones(indices):
+    """returns the 'INDEXID/FILEID' of files retired from the given indices whose intervals are still indexed"""
+    indices = list(indices)
+    out = conn.execute("SELECT INDEXID, FILEID from TOMBSTONES WHERE INDEXID IN ({})".format(",".join(["?"]*len(indices))), indices)
+    return set(["{}/{}".format(index, file_id) for index, file_id in out])
+
+
+def drop_tombstones(df, tombstones):
+    if not tombstones:
+        return df
+    return df[~(df["INDEXID"] + "/" + df["FILEID"]).isin(tombstones)].reset_index(drop=True)
+
+
+def result_chunks(worker, indices, pool, columns, tombstones=None):
+    """yields a dataframe of results for each index as soon as its search finishes, without retired files.
+    The search time, engine and parse time, rows and queue wait of each index are added to the query metrics"""
+    if len(indices) == 0:
+        yield add_file_ids(pd.DataFrame(empty_columns(columns)))
+    metrics = query_metrics()
+    query = query_kind(worker)
+    submitted = time.time()
+    for result, measure in pool.imap_unordered(partial(measured_query, worker), indices):
+        metrics.observe_index(query, measure, submitted)
+        yield drop_tombstones(add_file_ids(pd.DataFrame(result)), tombstones)
+
+
+def collect_chunks(chunks):
+    return pd.concat(list(chunks), ignore_index=True)
+
+
+def write_results(chunks, output_path="", metadata=False, output_format="csv"):
+    """writes result chunks as they arrive, FILES metadata is added chunk by chunk, returns the number of rows written"""
+    rows = 0
+    with open_writer(output_path, output_format) as writer:
+        for chunk in chunks:
+            if metadata:
+                chunk = chunk.merge(files_metadata(chunk["INDEXID"].unique()), on="FILEID", how='left')
+            writer.write(chunk)
+            rows = rows + len(chunk)
+    return rows
+
+
+def cached_chunks(chunks, cache, key, max_rows=config.CACHE_MAX_ROWS):
+    """yields result chunks as they arrive and caches the whole result once the last one is written,
+    results of more than max_rows rows are not cached so that at most max_rows rows are held"""
+    held = []
+    rows = 0
+    for chunk in chunks:
+        yield chunk
+        rows = rows + len(chunk)
+        if rows <= max_rows:
+            held.append(chunk)
+    if rows <= max_rows and len(held) > 0:
+        cache.put(key, collect_chunks(held))
+
+
+def record_query(query, started, rows, indices):
+    """adds the wall time of a command line query to the saved query metrics"""
+    query_metrics().observe_query(query, time.time() - started, rows, indices)
+    save_metrics()
+
+
+def interval_results(interval, indices, pool, tombstones=None):
+    """queries an interval on each index through pool and returns results as a dataframe"""
+    return collect_chunks(result_chunks(partial(query_interval_index, interval), indices, pool, INTERVAL_RESULT_COLUMNS, tombstones))
+
+
+def QUERY_INTERVAL(interval, genome, output_path="", metadata=False, *, output_format="csv", source="", project=""):
+    """Query a given interval in format 'Chr:#-#' <genome, or genomes comma seperated> <optional param: output_path> <optional param: output_format csv, jsonl, parquet or arrow> <optional param: source, DSOURCE patterns> <optional param: project, PROJECTID patterns>"""
+    started = time.time()
+    validate_interval(interval)
+    validate_scope(genome, source, project)
+
+    if config.QUERY_CACHE:
+        cache = QueryCache()
+        key = cache.key("interval", interval, scope_key(genome, source, project), index_version(conn))
+        df = cache.get(key)
+        cache.save_stats()
+        if df is not None:
+            record_query("interval", started, write_results([df], output_path, metadata, output_format), 0)
+            return
+
+    indices = genome_indices(genome, interval_extents([interval]), source, project)
     
     # Multiproccesing used to query indices
-    with Pool(config.AVAILABLE_PROCCESSES) as p:  # to check multiprocessing.cpu_count()
-        output = p.map(partial(query_interval_index, interval), indices)
+    chunks = result_chunks(partial(query_interval_index, interval), indices, get_pool(), INTERVAL_RESULT_COLUMNS, index_tombstones(indices))
+    if config.QUERY_CACHE:
+        chunks = cached_chunks(chunks, cache, key)
+    record_query("interval", started, write_results(chunks, output_path, metadata, output_format), len(indices))
+    if config.QUERY_CACHE:
+        cache.save_stats()
 
-    data = [row.replace("\n","").split(",") for result in output for row in result[:-1]]
-    df = pd.DataFrame(data, columns=['file','size','overlaps'])
 
-    df["FILEID"] = df["file"].apply(lambda x: x.replace(".bed.gz","").split("/")[-1])
-    df["INDEXID"] = df["file"].apply(lambda x: x.replace(".bed.gz","").split("/")[-2])
-    
-    if metadata:
-        cursor = conn.execute("SELECT * from FILES WHERE GENOME='{}'".format(genome))
-        df_metadata = pd.DataFrame(cursor.fetchall())
-        df_metadata.columns = [i[0].replace(" ", "") for i in cursor.description]
-        df = df.merge(df_metadata, on="FILEID", how='left')
+def read_regions(regions):
+    """ returns a list of 'Chr:#-#' regions from a file with one region or bed interval
+    per line, or from a comma seperated string of regions
+    """
+    if path.isfile(regions):
+        return read_regions_file(regions)
+    return parse_regions(regions)
+
+
+def read_regions_file(regions_path):
+    """ returns the 'Chr:#-#' regions of a file with one region or bed interval per line """
+    with open(regions_path) as f:
+        return region_list([l.strip() for l in f if l.strip() != "" and not l.startswith("#")])
+
+
+def parse_regions(regions):
+    """ returns the 'Chr:#-#' regions of a comma seperated string, never read as a path
+    so it is safe for regions sent by query server clients
+    """
+    return region_list([l.strip() for l in regions.split(",") if l.strip() != ""])
+
+
+def region_list(lines):
+    regions = []
+    for l in lines:
+        fields = l.split()
+        if len(fields) >= 3:  # bed interval
+            l = "{}:{}-{}".format(fields[0], fields[1], fields[2])
+        validate_interval(l)
+        regions.append(l)
+    return regions
+
+
+def make_regions_file(regions, folder):
+    """ writes regions into a bgzipped bed file that giggle can use as a query file,
+    the region is kept as the name column so that results can be keyed by region
+    """
+    bed_path = os.path.join(folder, "regions.bed.gz")
+    # written in process, the query file is small and hosts need no bgzip binary
+    with BGZFWriter(bed_path, threads=1) as f:
+        for region in regions:
+            chrom, bounds = region.split(":")
+            start, end = bounds.split("-")
+            f.write("{}\t{}\t{}\t{}\n".format(chrom, start, end, region))
+    return bed_path
+
+
+def query_regions_index(query_path, index):
+    """ searches every region of the query file against one index in a single search """
+    return index_engine(index).search_regions(index, query_path)
+
+
+def regions_results(query_path, indices, pool, tombstones=None):
+    """queries a regions file on each index through pool and returns one table keyed by region and file"""
+    return collect_chunks(result_chunks(partial(query_regions_index, query_path), indices, pool, REGIONS_RESULT_COLUMNS, tombstones))
 
-    if output_path=="":
-        df.to_csv("out.csv", index=False)
-    else:
-        df.to_csv(output_path, index=False)
+
+def QUERY_INTERVALS(regions, genome, output_path="", metadata=False, *, output_format="csv", source="", project=""):
+    """Query a batch of intervals given a file of regions or 'Chr:#-#,Chr:#-#' <genome, or genomes comma seperated> <optional param: output_path> <optional param: output_format> <optional param: source> <optional param: project>"""
+    started = time.time()
+    regions = read_regions(regions)
+    validate_scope(genome, source, project)
+
+    indices = genome_indices(genome, interval_extents(regions), source, project)
+
+    folder = tempfile.mkdtemp()
+    try:
+        query_path = make_regions_file(regions, folder)
+        chunks = result_chunks(partial(query_regions_index, query_path), indices, get_pool(), REGIONS_RESULT_COLUMNS, index_tombstones(indices))
+        record_query("regions", started, write_results(chunks, output_path, metadata, output_format), len(indices))
+    finally:
+        shutil.rmtree(folder)
 
 
 def validate_query_file(path_):
@@ -177,47 +438,135 @@ def validate_query_file(path_):
     return path_
 
 
-def query_file_index(path, index):
-    index_path = "indices/" + index + ".d"
-    cmd_str = 'giggle search -i ' + index_path + ' -q ' + path + " -s"
-    search_out = str(subprocess.check_output(cmd_str, shell=True))
-    cleaned_out = ""
-    # delete header words in query file
-    rows = search_out.replace("b'#","").replace("","").split("\\n")
-    # headers are in rows[0]
-    cleaned_rows = [i.replace("\\t",",")+"\n" for i in rows]
-    cleaned_rows = [i.replace(",\n","\n") for i in cleaned_rows]
-    return cleaned_rows
+def validate_rank(rank_by):
+    if rank_by not in RANK_COLUMNS:
+        print("ERROR: Cannot rank by {}, use one of {}".format(rank_by, ", ".join(RANK_COLUMNS)))
+        raise
 
 
-def QUERY_FILE(path, genome, output_path="", metadata=False):
-    """Query a given file given a path. ie: <path> <genome> <optional param: output_path>"""
-    
+def rank_key(values, rank_by):
+    """ sort key of rank_by values, larger is better and NaN is last """
+    values = np.asarray(values, dtype=np.float64)
+    values = -values if rank_by in ASCENDING_RANKS else values
+    return np.where(np.isnan(values), -np.inf, values)
+
+
+def rank_filter(columns, top=0, rank_by="combo_score", min_overlaps=0, score_threshold=None):
+    """ keeps the rows of one index search with at least min_overlaps and a rank_by
+    score at least as good as score_threshold, only the best top of them when top > 0
+    """
+    key = rank_key(columns[rank_by], rank_by)
+    keep = np.asarray(columns["overlaps"]) >= min_overlaps
+    if score_threshold is not None:
+        keep = keep & (key >= rank_key([score_threshold], rank_by)[0])
+    rows = np.flatnonzero(keep)
+    if top > 0 and len(rows) > top:
+        rows = rows[np.argpartition(-key[rows], top - 1)[:top]]
+    return {c: np.asarray(v)[rows] for c, v in columns.items()}
+
+
+def query_file_index(path, index, top=0, rank_by="combo_score", min_overlaps=0, score_threshold=None):
+    """ searches a file against one index, thresholds and the per index top are applied in the worker """
+    columns = index_engine(index).search_file(index, path)
+    if top > 0 or min_overlaps > 0 or score_threshold is not None:
+        columns = rank_filter(columns, top, rank_by, min_overlaps, score_threshold)
+    return columns
+
+
+def top_chunks(chunks, top, rank_by="combo_score"):
+    """ merges the result chunks of every index into their best top rows, best first.
+    Rows are kept in a heap of top entries so only the winners are ever held
+    """
+    heap = []
+    columns = FILE_RESULT_COLUMNS
+    for chunk in chunks:
+        columns = list(chunk.columns)
+        keys = rank_key(chunk[rank_by].to_numpy(), rank_by)
+        for key, file, row in zip(keys, chunk["file"], chunk.itertuples(index=False, name=None)):
+            if len(heap) < top:
+                heapq.heappush(heap, (key, file, row))
+            elif (key, file) > heap[0][:2]:
+                heapq.heapreplace(heap, (key, file, row))
+    yield pd.DataFrame([row for _, _, row in sorted(heap, key=lambda item: item[:2], reverse=True)], columns=columns)
+
+
+def file_chunks(path, indices, pool, tombstones=None, top=0, rank_by="combo_score", min_overlaps=0, score_threshold=None):
+    """ result chunks of a file search, one per index, or a single chunk of the best top rows across indices when top > 0 """
+    validate_rank(rank_by)
+    # an index keeps extra rows for any of its retired files that make its top
+    index_top = top + len(tombstones) if top > 0 and tombstones else top
+    worker = partial(query_file_index, path, top=index_top, rank_by=rank_by, min_overlaps=min_overlaps, score_threshold=score_threshold)
+    chunks = result_chunks(worker, indices, pool, FILE_RESULT_COLUMNS, tombstones)
+    return top_chunks(chunks, top, rank_by) if top > 0 else chunks
+
+
+def file_results(path, indices, pool, tombstones=None, top=0, rank_by="combo_score", min_overlaps=0, score_threshold=None):
+    """queries a file on each index through pool and returns results as a dataframe"""
+    return collect_chunks(file_chunks(path, indices, pool, tombstones, top, rank_by, min_overlaps, score_threshold))
+
+
+def QUERY_FILE(path, genome, output_path="", metadata=False, *, output_format="csv", top=0, rank_by="combo_score", min_overlaps=0, score_threshold="", source="", project=""):
+    """Query a given file given a path. ie: <path> <genome, or genomes comma seperated> <optional param: source, DSOURCE patterns> <optional param: project, PROJECTID patterns> <optional param: output_path> <optional param: output_format csv, jsonl, parquet or arrow> <optional param: top, only the best top files by rank_by> <optional param: rank_by combo_score, odds_ratio, overlaps, fishers_right_tail or fishers_two_tail> <optional param: min_overlaps> <optional param: score_threshold>"""
+    started = time.time()
     path = validate_query_file(path)
-    validate_genome(genome)
+    validate_scope(genome, source, project)
 
-    out = conn.execute("SELECT INDEXID from INDICES WHERE GENOME = '{}'".format(genome))
+    indices = genome_indices(genome, bed_extents(path), source, project)
 
-    indices = list([i[0] for i in out])
+    chunks = file_chunks(path, indices, get_pool(), index_tombstones(indices), int(top), rank_by, int(min_overlaps),
+                         float(score_threshold) if score_threshold != "" else None)
+    record_query("file", started, write_results(chunks, output_path, metadata, output_format), len(indices))
 
-    with Pool(config.AVAILABLE_PROCCESSES) as p: # to check multiprocessing.cpu_count()
-        output = p.map(partial(query_file_index, path), indices)
 
-    data = [row.replace("\n","").split(",") for result in output for row in result[1:-1]]
-    df = pd.DataFrame(data, columns=output[0][0].replace("\n","").split(","))
-    df["FILEID"] = df["file"].apply(lambda x: x.replace(".bed.gz","").split("/")[-1])
-    df["INDEXID"] = df["file"].apply(lambda x: x.replace(".bed.gz","").split("/")[-2])
-    
-    if metadata:
-        cursor = conn.execute("SELECT * from FILES WHERE GENOME='{}'".format(genome))
-        df_metadata = pd.DataFrame(cursor.fetchall())
-        df_metadata.columns = [i[0].replace(" ", "") for i in cursor.description]
-        df = df.merge(df_metadata, on="FILEID", how='left')
+def CACHE(*, clear=False):
+    """"returns query cache hit and miss counters and size, <optional param: clear>"""
+    cache = QueryCache()
+    if clear:
+        cache.clear()
+    df = pd.DataFrame([cache.stats()])
+    df.to_csv("out.csv", index=False)
 
-    if output_path=="":
-        df.to_csv("out.csv", index=False)
+
+def METRICS(*, output_format="indices", clear=False):
+    """"returns the saved query metrics, per index latency, engine and parse time and rows by default <optional param: output_format indices, prometheus or json> <optional param: clear>"""
+    metrics = load_metrics()
+    if clear and os.path.exists(config.QUERY_METRICS_FILE):
+        os.remove(config.QUERY_METRICS_FILE)
+    if output_format == "prometheus":
+        print(metrics.prometheus(), end="")
+    elif output_format == "json":
+        print(json.dumps(metrics.to_json()))
     else:
-        df.to_csv(output_path, index=False)
+        df = pd.DataFrame(metrics.index_summary(), columns=INDEX_SUMMARY_COLUMNS)
+        df.to_csv("out.csv", index=False)
+
+
+def TIMINGS(run_id="", top=10, output_path=""):
+    """"summarises the stage timings of a setup or update run, the latest when run_id is not given <optional param: run_id> <optional param: top> <optional param: output_path>"""
+    load_spans(conn)
+    if run_id == "":
+        latest = conn.execute("SELECT RUNID from RUNS ORDER BY STARTED DESC LIMIT 1").fetchone()
+        if latest is None:
+            print("ERROR: No setup or update runs recorded")
+            raise
+        run_id = latest[0]
+    run_info = conn.execute("SELECT COMMAND, STARTED, FINISHED from RUNS WHERE RUNID=?", (run_id,)).fetchone()
+    if run_info is None:
+        print("ERROR: Run {} not found".format(run_id))
+        raise
+    cursor = conn.execute("SELECT STAGE, NAME, SECONDS, BYTES, INTERVALS, FAILED from STAGE_TIMINGS WHERE RUNID=?", (run_id,))
+    spans = pd.DataFrame(cursor.fetchall(), columns=[i[0] for i in cursor.description])
+    stages = spans.groupby("STAGE").agg(SPANS=("SECONDS", "size"), SECONDS=("SECONDS", "sum"), MEAN=("SECONDS", "mean"), MAX=("SECONDS", "max"),
+                                        BYTES=("BYTES", "sum"), INTERVALS=("INTERVALS", "sum"), FAILED=("FAILED", "sum"))
+    stages["MB_PER_SECOND"] = stages["BYTES"]/1000/1000/stages["SECONDS"].where(stages["SECONDS"] > 0)
+    stages = stages.sort_values("SECONDS", ascending=False).reset_index()
+
+    finished = run_info[2] if run_info[2] is not None else conn.execute("SELECT MAX(STARTED + SECONDS) from STAGE_TIMINGS WHERE RUNID=?", (run_id,)).fetchone()[0]
+    print("Run {} ({}) took {:.0f} seconds{}".format(run_id, run_info[0], (finished or run_info[1]) - run_info[1], "" if run_info[2] is not None else ", unfinished"))
+    print(stages.to_string(index=False))
+    print(spans.sort_values("SECONDS", ascending=False).head(top).to_string(index=False))
+    stages.to_csv("out.csv" if output_path == "" else output_path, index=False)
+
 
 if __name__ == "__main__":
     run(FILES, alt={
@@ -226,6 +575,10 @@ if __name__ == "__main__":
                 'g': GENOMES,
                 'p': PROJECTS,
                 's': SOURCES,
+                'c': CACHE,
                 'qf': QUERY_FILE,
                 'qi': QUERY_INTERVAL,
+                'qb': QUERY_INTERVALS,
+                't': TIMINGS,
+                'm': METRICS,
                 })
\ No newline at end of file
@@ -0,0 +1,251 @@
+from config import config
+import os
+import json
+import time
+import fcntl
+import bisect
+import threading
+from contextlib import contextmanager
+
+config = config
+
+INDEX_SUMMARY_COLUMNS = ["index", "query", "searches", "mean_seconds", "p95_seconds", "engine_seconds", "parse_seconds", "rows"]
+
+##################
+# WORKER TIMINGS #
+##################
+
+# time spent waiting on the search engine during the current index query of this process
+engine_time = {"seconds": 0.0}
+
+
+def timed_lines(lines):
+    """ yields lines, counting the time spent waiting for each one as engine time """
+    iterator = iter(lines)
+    while True:
+        started = time.perf_counter()
+        line = next(iterator, None)
+        engine_time["seconds"] = engine_time["seconds"] + time.perf_counter() - started
+        if line is None:
+            return
+        yield line
+
+
+@contextmanager
+def engine_timer():
+    """ counts the time spent in the body as engine time, for engines that search in process """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        engine_time["seconds"] = engine_time["seconds"] + time.perf_counter() - started
+
+
+def measured_query(worker, index):
+    """ runs worker(index) in a pool worker and returns its result with how long it
+    took, split into engine time and parse time, and when it started
+    Returns
+    -------
+    result, measure: tuple
+        measure is {"index", "started", "seconds", "engine", "parse", "rows"}
+    """
+    engine_time["seconds"] = 0.0
+    started = time.time()
+    timer = time.perf_counter()
+    result = worker(index)
+    seconds = time.perf_counter() - timer
+    rows = len(next(iter(result.values()))) if len(result) > 0 else 0
+    return result, {"index": index, "started": started, "seconds": seconds, "engine": engine_time["seconds"],
+                    "parse": max(0.0, seconds - engine_time["seconds"]), "rows": rows}
+
+
+def query_kind(worker):
+    # query_interval_index -> interval
+    name = getattr(worker, "func", worker).__name__
+    return name.replace("query_", "").replace("_index", "")
+
+##############
+# HISTOGRAMS #
+##############
+
+class Histogram:
+    """ Cumulative histogram with fixed upper bounds, as Prometheus exposes them """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)  # last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def cumulative(self):
+        total = 0
+        out = []
+        for count in self.counts:
+            total = total + count
+            out.append(total)
+        return out
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding quantile q """
+        if self.count == 0:
+            return None
+        for bound, total in zip(self.bounds + [float("inf")], self.cumulative()):
+            if total >= q*self.count:
+                return bound
+
+    def to_dict(self):
+        return {"bounds": self.bounds, "counts": self.counts, "sum": self.sum, "count": self.count}
+
+    def merge(self, other):
+        if other["bounds"] != self.bounds:
+            return
+        self.counts = [a + b for a, b in zip(self.counts, other["counts"])]
+        self.sum = self.sum + other["sum"]
+        self.count = self.count + other["count"]
+
+
+class QueryMetrics:
+    """ Query latency histograms and counters of one process: the wall time of each
+    query, and for each index its search time, engine and parse time, result rows
+    and the time its search waited in the worker pool queue
+    """
+    def __init__(self, bounds=config.QUERY_METRICS_BUCKETS):
+        self.bounds = bounds
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.bounds)
+            self.histograms[key].observe(value)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe_index(self, query, measure, submitted):
+        labels = {"query": query, "index": measure["index"]}
+        self.observe("giggle_index_query_seconds", labels, measure["seconds"])
+        self.inc("giggle_index_engine_seconds_total", labels, measure["engine"])
+        self.inc("giggle_index_parse_seconds_total", labels, measure["parse"])
+        self.inc("giggle_index_result_rows_total", labels, measure["rows"])
+        self.observe("giggle_pool_queue_wait_seconds", {"query": query}, max(0.0, measure["started"] - submitted))
+
+    def observe_query(self, query, seconds, rows, indices):
+        labels = {"query": query}
+        self.observe("giggle_query_seconds", labels, seconds)
+        self.inc("giggle_query_result_rows_total", labels, rows)
+        self.inc("giggle_query_indices_searched_total", labels, indices)
+
+    def to_json(self):
+        with self.lock:
+            return {"histograms": [dict(name=name, labels=dict(labels), **histogram.to_dict()) for (name, labels), histogram in self.histograms.items()],
+                    "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()]}
+
+    def merge(self, dump):
+        """ adds the metrics of a to_json dump """
+        for histogram in dump["histograms"]:
+            key = (histogram["name"], tuple(sorted(histogram["labels"].items())))
+            with self.lock:
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(histogram["bounds"])
+                self.histograms[key].merge(histogram)
+        for counter in dump["counters"]:
+            self.inc(counter["name"], counter["labels"], counter["value"])
+
+    def prometheus(self):
+        """ metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for name in sorted(set([name for name, _ in self.histograms])):
+                lines.append("# TYPE {} histogram".format(name))
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, total in zip(histogram.bounds + ["+Inf"], histogram.cumulative()):
+                        lines.append("{}_bucket{} {}".format(name, label_text(labels + (("le", str(bound)),)), total))
+                    lines.append("{}_sum{} {}".format(name, label_text(labels), histogram.sum))
+                    lines.append("{}_count{} {}".format(name, label_text(labels), histogram.count))
+            for name in sorted(set([name for name, _ in self.counters])):
+                lines.append("# TYPE {} counter".format(name))
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append("{}{} {}".format(name, label_text(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def index_summary(self):
+        """ one row per index and query type, slowest indices first, to spot skewed indices
+        Returns
+        -------
+        rows: list
+            dicts keyed by INDEX_SUMMARY_COLUMNS
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        rows = []
+        for (name, labels), histogram in histograms.items():
+            if name != "giggle_index_query_seconds":
+                continue
+            rows.append({"index": dict(labels)["index"], "query": dict(labels)["query"], "searches": histogram.count,
+                         "mean_seconds": histogram.sum/histogram.count if histogram.count > 0 else 0, "p95_seconds": histogram.quantile(0.95),
+                         "engine_seconds": counters.get(("giggle_index_engine_seconds_total", labels), 0),
+                         "parse_seconds": counters.get(("giggle_index_parse_seconds_total", labels), 0),
+                         "rows": counters.get(("giggle_index_result_rows_total", labels), 0)})
+        return sorted(rows, key=lambda row: -row["mean_seconds"])
+
+
+def label_text(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(['{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels]) + "}"
+
+####################
+# PROCESS REGISTRY #
+####################
+
+registry = QueryMetrics()
+
+
+def query_metrics():
+    """ returns the QueryMetrics of this process, shared by the query functions and the query server """
+    return registry
+
+
+def save_metrics(path=config.QUERY_METRICS_FILE):
+    """ adds the metrics of this process to those saved by earlier query_indices.py calls and resets them """
+    global registry
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # processes saving at the same time take turns, otherwise the last replace drops the counts of the others
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        saved = QueryMetrics()
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    saved.merge(json.load(f))
+            except ValueError:
+                pass
+        saved.merge(registry.to_json())
+        temp_path = "{}.{}".format(path, os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(saved.to_json(), f)
+        os.replace(temp_path, path)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    registry = QueryMetrics()
+
+
+def load_metrics(path=config.QUERY_METRICS_FILE):
+    metrics = QueryMetrics()
+    if os.path.exists(path):
+        with open(path) as f:
+            metrics.merge(json.load(f))
+    return metrics
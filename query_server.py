@@ -0,0 +1,335 @@
+from config import config
+import os
+import json
+import catalog
+import threading
+import tempfile
+import shutil
+import traceback
+from fnmatch import fnmatchcase
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+from worker_pool import WorkerPool
+from clize import run
+import pandas as pd
+from query_indices import validate_interval, validate_query_file, interval_results, file_results, parse_regions, make_regions_file, regions_results, interval_extents, prune_indices, RANK_COLUMNS, split_scope, scope_key
+from setup_indices import bed_extents
+from query_cache import QueryCache, index_version
+from query_metrics import query_metrics, INDEX_SUMMARY_COLUMNS
+
+config = config
+
+
+class QueryError(Exception):
+    pass
+
+
+def glob_match(value, patterns):
+    # same matching as SQL GLOB, an empty list of patterns matches everything
+    patterns = split_scope(patterns)
+    return len(patterns) == 0 or any([fnmatchcase(value, pattern) for pattern in patterns])
+
+
+class IndexCatalog:
+    """ In memory copy of the INDICES and FILES tables, loaded when the
+    server starts, refreshed through /reload and whenever the index version
+    changes (setup, update or compaction)
+    """
+    def __init__(self, db=config.DB):
+        self.db = db
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        conn = catalog.connect(self.db)
+        cursor = conn.execute("SELECT * from INDICES")
+        indices = pd.DataFrame(cursor.fetchall(), columns=[i[0] for i in cursor.description])
+        cursor = conn.execute("SELECT * from FILES")
+        files = pd.DataFrame(cursor.fetchall(), columns=[i[0].replace(" ", "") for i in cursor.description])
+        version = index_version(conn)
+        extent_rows = conn.execute("SELECT INDEXID, CHROM, MINSTART, MAXEND from EXTENTS").fetchall()
+        tombstones = set(["{}/{}".format(index, file_id) for index, file_id in conn.execute("SELECT INDEXID, FILEID from TOMBSTONES")])
+        conn.close()
+
+        genome_indices = {}
+        for index, genome in zip(indices["INDEXID"], indices["GENOME"]):
+            genome_indices.setdefault(genome, []).append(index)
+        genome_metadata = {genome: df for genome, df in files.groupby("GENOME")}
+
+        with self.lock:
+            self.indices = indices
+            self.genome_indices = genome_indices
+            self.genome_metadata = genome_metadata
+            self.extent_rows = extent_rows
+            self.tombstones = tombstones
+            self.version = version
+
+    def refresh(self):
+        conn = catalog.connect(self.db, create=False)
+        version = index_version(conn)
+        conn.close()
+        if version != self.version:
+            self.load()
+
+    def validate_genome(self, genome):
+        if genome not in self.genome_indices:
+            raise QueryError("Genome {} not found in system, use /genomes to find valid genomes".format(genome))
+
+    def get_indices(self, genome, extents=None, source="", project=""):
+        """ indices of one or more comma separated genomes, only those whose DSOURCE and
+        PROJECTID match one of the source and project glob patterns when given, the
+        same scope query_indices.scope_where selects in SQL
+        """
+        self.refresh()
+        genomes = split_scope(genome)
+        if len(genomes) == 0:
+            raise QueryError("No genome given, use /genomes to find valid genomes")
+        indices = []
+        for g in genomes:
+            self.validate_genome(g)
+            indices.extend(self.genome_indices[g])
+        if source != "" or project != "":
+            scoped = self.indices[self.indices["INDEXID"].isin(indices)]
+            keep = [glob_match(s, source) and glob_match(p, project) for s, p in zip(scoped["DSOURCE"], scoped["PROJECTID"])]
+            indices = list(scoped["INDEXID"][keep])
+        if extents is None:
+            return indices
+        return prune_indices(indices, self.extent_rows, extents)
+
+    def get_metadata(self, genome):
+        frames = []
+        for g in split_scope(genome):
+            self.validate_genome(g)
+            frames.append(self.genome_metadata.get(g, pd.DataFrame(columns=["FILEID"])))
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+class QueryServerMixin:
+    """ Shared state of the HTTP and unix socket servers: the catalog and a
+    pool of worker processes that stay alive between requests
+    """
+    def setup_query_state(self, db, processes, cache=config.QUERY_CACHE):
+        self.catalog = IndexCatalog(db)
+        self.pool = WorkerPool(processes)
+        self.cache = QueryCache() if cache else None
+
+    def query_interval(self, params):
+        started = time.time()
+        interval = params.get("interval", "")
+        try:
+            validate_interval(interval)
+            extents = interval_extents([interval])
+        except Exception:
+            raise QueryError("Interval not in correct format Chr:#-# ex 1:200457776-200457776")
+        genome = params.get("genome", "")
+        source = params.get("source", "")
+        project = params.get("project", "")
+        indices = self.catalog.get_indices(genome, extents, source, project)
+        if self.cache is None:
+            df = interval_results(interval, indices, self.pool, self.catalog.tombstones)
+        else:
+            key = self.cache.key("interval", interval, scope_key(genome, source, project), self.catalog.version)
+            df = self.cache.get(key)
+            if df is None:
+                df = interval_results(interval, indices, self.pool, self.catalog.tombstones)
+                self.cache.put(key, df)
+            else:
+                indices = []
+        query_metrics().observe_query("interval", time.time() - started, len(df), len(indices))
+        return self.add_metadata(df, genome, params)
+
+    def query_intervals(self, params):
+        started = time.time()
+        try:
+            regions = parse_regions(params.get("regions", ""))
+            extents = interval_extents(regions)
+        except Exception:
+            raise QueryError("Regions not in correct format Chr:#-#,Chr:#-# ex 1:200457776-200457776")
+        if len(regions) == 0:
+            raise QueryError("No regions given")
+        genome = params.get("genome", "")
+        indices = self.catalog.get_indices(genome, extents, params.get("source", ""), params.get("project", ""))
+        folder = tempfile.mkdtemp()
+        try:
+            query_path = make_regions_file(regions, folder)
+            df = regions_results(query_path, indices, self.pool, self.catalog.tombstones)
+        finally:
+            shutil.rmtree(folder)
+        query_metrics().observe_query("regions", time.time() - started, len(df), len(indices))
+        return self.add_metadata(df, genome, params)
+
+    def query_file(self, params):
+        started = time.time()
+        try:
+            path = validate_query_file(params.get("path", ""))
+        except Exception:
+            raise QueryError("Path given, {} , is not an existing bed.gz or vcf.gz file".format(params.get("path", "")))
+        try:
+            top = int(params.get("top", 0))
+            min_overlaps = int(params.get("min_overlaps", 0))
+            score_threshold = float(params["score_threshold"]) if "score_threshold" in params else None
+        except ValueError:
+            raise QueryError("top and min_overlaps must be integers and score_threshold a number")
+        rank_by = params.get("rank_by", "combo_score")
+        if rank_by not in RANK_COLUMNS:
+            raise QueryError("Cannot rank by {}, use one of {}".format(rank_by, ", ".join(RANK_COLUMNS)))
+        genome = params.get("genome", "")
+        indices = self.catalog.get_indices(genome, bed_extents(path), params.get("source", ""), params.get("project", ""))
+        df = file_results(path, indices, self.pool, self.catalog.tombstones, top, rank_by, min_overlaps, score_threshold)
+        query_metrics().observe_query("file", time.time() - started, len(df), len(indices))
+        return self.add_metadata(df, genome, params)
+
+    def add_metadata(self, df, genome, params):
+        if params.get("metadata", "false").lower() in ["1", "true", "yes"]:
+            df = df.merge(self.catalog.get_metadata(genome), on="FILEID", how='left')
+        return df
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+        if self.cache is not None:
+            self.cache.save_stats()
+
+
+class HTTPQueryServer(QueryServerMixin, ThreadingHTTPServer):
+    pass
+
+
+class UnixQueryServer(QueryServerMixin, ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """ GET /genomes
+        GET /indices
+        GET /cache
+        GET /pool
+        GET /metrics[?format=json]  Prometheus text by default
+        GET /metrics/indices[?format=csv]  latency, engine and parse time and rows per index
+        GET /query/interval?interval=<Chr:#-#>&genome=<genome[,genome]>[&source=<pattern>][&project=<pattern>][&metadata=true][&format=csv]
+        GET /query/intervals?regions=<Chr:#-#,Chr:#-#>&genome=<genome[,genome]>[&source=<pattern>][&project=<pattern>][&metadata=true][&format=csv]
+        POST /query/intervals?genome=<genome[,genome]> with one region per line as the body
+        GET /query/file?path=<bed.gz path>&genome=<genome[,genome]>[&source=<pattern>][&project=<pattern>][&top=<k>][&rank_by=combo_score][&min_overlaps=<n>][&score_threshold=<x>][&metadata=true][&format=csv]
+        POST /reload
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: value[-1] for key, value in parse_qs(url.query).items()}
+        try:
+            if url.path == "/genomes":
+                self.server.catalog.refresh()
+                df = pd.DataFrame(sorted(self.server.catalog.genome_indices.keys()), columns=["GENOME"])
+            elif url.path == "/indices":
+                self.server.catalog.refresh()
+                df = self.server.catalog.indices
+            elif url.path == "/pool":
+                df = pd.DataFrame([self.server.pool.stats()])
+            elif url.path == "/cache":
+                df = pd.DataFrame([self.server.cache.stats()] if self.server.cache is not None else [])
+            elif url.path == "/metrics":
+                self.respond_metrics(params.get("format", "prometheus"))
+                return
+            elif url.path == "/metrics/indices":
+                df = pd.DataFrame(query_metrics().index_summary(), columns=INDEX_SUMMARY_COLUMNS)
+            elif url.path == "/query/interval":
+                df = self.server.query_interval(params)
+            elif url.path == "/query/intervals":
+                df = self.server.query_intervals(params)
+            elif url.path == "/query/file":
+                df = self.server.query_file(params)
+            else:
+                self.send_error(404, "Unknown endpoint {}".format(url.path))
+                return
+        except QueryError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.internal_error(e)
+            return
+        self.respond(df, params.get("format", "json"))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = {key: value[-1] for key, value in parse_qs(url.query).items()}
+        try:
+            if url.path == "/reload":
+                self.server.catalog.load()
+                df = pd.DataFrame([["reloaded"]], columns=["status"])
+            elif url.path == "/query/intervals":
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                params["regions"] = ",".join(body.split("\n"))
+                df = self.server.query_intervals(params)
+            else:
+                self.send_error(404, "Unknown endpoint {}".format(url.path))
+                return
+        except QueryError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.internal_error(e)
+            return
+        self.respond(df, params.get("format", "json"))
+
+    def internal_error(self, e):
+        # the client gets a 500 rather than a dropped connection, the traceback goes to the server log
+        self.log_error("%s %s failed: %s", self.command, self.path, traceback.format_exc())
+        self.send_error(500, "Query failed", "{}: {}".format(type(e).__name__, e))
+
+    def respond(self, df, output_format):
+        if output_format == "csv":
+            body = df.to_csv(index=False).encode()
+            content_type = "text/csv"
+        else:
+            body = json.dumps(json.loads(df.to_json(orient="records"))).encode()
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_metrics(self, output_format):
+        if output_format == "json":
+            body = json.dumps(query_metrics().to_json()).encode()
+            content_type = "application/json"
+        else:
+            body = query_metrics().prometheus().encode()
+            content_type = "text/plain; version=0.0.4"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients do not have an address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+def make_server(host=config.QUERY_SERVER_HOST, port=config.QUERY_SERVER_PORT, socket_path=config.QUERY_SERVER_SOCKET, db=config.DB, processes=config.AVAILABLE_PROCCESSES, cache=config.QUERY_CACHE):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixQueryServer(socket_path, QueryHandler)
+    else:
+        server = HTTPQueryServer((host, int(port)), QueryHandler)
+    server.setup_query_state(db, int(processes), cache)
+    return server
+
+
+def serve(*, host=config.QUERY_SERVER_HOST, port=config.QUERY_SERVER_PORT, socket_path=config.QUERY_SERVER_SOCKET):
+    """Start the resident query server. <optional param: host> <optional param: port> <optional param: socket_path>"""
+    server = make_server(host, port, socket_path)
+    print("Query server listening on {}".format(socket_path if socket_path else "http://{}:{}".format(host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    run(serve)
@@ -0,0 +1,124 @@
+try:  # parquet and arrow output are optional
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+
+OUTPUT_FORMATS = ["csv", "jsonl", "parquet", "arrow"]
+
+
+class ResultWriter:
+    """ Writes query results chunk by chunk as each index returns,
+    so that only one chunk is held in memory at a time
+    """
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, df):
+        self.write_chunk(df)
+        self.rows += df.shape[0]
+
+    def write_chunk(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CSVWriter(ResultWriter):
+    def __init__(self, output_path):
+        super().__init__(output_path)
+        self.f = open(output_path, "w", newline="")
+        self.header = True
+
+    def write_chunk(self, df):
+        df.to_csv(self.f, index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        self.f.close()
+
+
+class JSONLWriter(ResultWriter):
+    def __init__(self, output_path):
+        super().__init__(output_path)
+        self.f = open(output_path, "w")
+
+    def write_chunk(self, df):
+        if df.shape[0] > 0:
+            # pandas ends the last record with a newline, older versions did not
+            text = df.to_json(orient="records", lines=True)
+            self.f.write(text if text.endswith("\n") else text + "\n")
+
+    def close(self):
+        self.f.close()
+
+
+class ArrowWriter(ResultWriter):
+    """ Parquet and Arrow IPC writer, the schema is fixed by the first chunk with rows """
+    def __init__(self, output_path, output_format):
+        if pa is None:
+            raise ImportError("pyarrow is required for {} output, pip3 install pyarrow".format(output_format))
+        super().__init__(output_path)
+        self.output_format = output_format
+        self.writer = None
+        self.schema = None
+        self.empty = None
+
+    def write_chunk(self, df):
+        if self.schema is None and df.shape[0] == 0:
+            # an empty chunk has no column types, it only fixes the schema when no rows ever come
+            if self.empty is None:
+                self.empty = df
+            return
+        if self.schema is None:
+            table = self.open(df)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        if self.output_format == "parquet":
+            self.writer.write_table(table)
+        else:
+            self.writer.write(table)
+
+    def open(self, df):
+        """ fixes the schema from df and opens the output file, returns df as a table of that schema """
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # all null columns are stored as strings so later chunks can fill them
+        self.schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema])
+        if self.output_format == "parquet":
+            self.writer = pq.ParquetWriter(self.output_path, self.schema)
+        else:
+            self.writer = ipc.new_file(self.output_path, self.schema)
+        return table.cast(self.schema)
+
+    def close(self):
+        if self.writer is None and self.empty is not None:
+            # a result without rows is still written, with its columns
+            table = self.open(self.empty)
+            if self.output_format == "parquet":
+                self.writer.write_table(table)
+            else:
+                self.writer.write(table)
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_writer(output_path="", output_format="csv"):
+    """ returns a ResultWriter for output_format, one of csv, jsonl, parquet or arrow """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Output format {} not supported, use one of {}".format(output_format, ", ".join(OUTPUT_FORMATS)))
+    if output_path == "":
+        output_path = "out.{}".format(output_format)
+    if output_format == "csv":
+        return CSVWriter(output_path)
+    if output_format == "jsonl":
+        return JSONLWriter(output_path)
+    return ArrowWriter(output_path, output_format)
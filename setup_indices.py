@@ -5,18 +5,29 @@ from contextlib import contextmanager
 import requests 
 import glob
 import os
-import pybedtools
-from multiprocessing.pool import Pool
+from worker_pool import get_pool, close_pool
 from functools import partial
 from alive_progress import alive_bar
 from datetime import date
-import sqlite3
+import catalog
 import subprocess
 import re
 import numpy as np
 from math import isnan
 import math
 import shutil
+import gzip
+import heapq
+from query_cache import bump_index_version
+from download_engine import DownloadEngine
+from blob_cache import blob_cache, source_version
+from metadata_fetcher import MetadataFetcher
+from pipeline import Pipeline
+from bed_sort import sort_into_folder
+from interval_count import cached_interval_counts
+from timings import span, record_span, start_run, finish_run
+from sql_export import sql_table_columns, sql_first_value, sql_table_version, export_sql_bed
+from interval_engine import build_engine
 
 
 config = config
@@ -99,113 +110,289 @@ def file_download_handler(path, file_info):
     except Exception as e:
         print(e)
 
+def fetch_linked_files(folder, files_info):
+    """ fetches remote linked files together over pooled connections
+    Returns
+    -------
+    files: list
+        file info of the files left to convert, files that failed to download are dropped
+    """
+    os.makedirs("data/{}".format(folder), exist_ok=True)
+    files = list(files_info.values())
+    if 'local' not in folder:
+        linked = [f["download_params"] for f in files if f["download_function"] == download_linked_file]
+        # files converted by an earlier run or another project need no download or conversion
+        cache = blob_cache()
+        if cache is not None:
+            # a cached copy is only used while the remote file keeps its ETag or Last-Modified
+            headers = DownloadEngine().remote_headers([params["download_location"] for params in linked if params["download_location"].startswith("http")])
+            for params in linked:
+                params["version"] = source_version(headers.get(params["download_location"]))
+                params["cached"] = not params.get("refresh", False) and cache.get("bed:{}".format(params["download_location"]), "data/{}/{}.bed".format(folder, params["track"]), params["version"])
+            files = [f for f in files if not f["download_params"].get("cached", False)]
+            linked = [params for params in linked if not params["cached"]]
+        downloads = [(params["download_location"], "data/{}/{}.{}".format(folder, params["track"], params["file_type"])) for params in linked]
+        engine = DownloadEngine()
+        errors = engine.download(downloads)
+        for params, (url, local_path) in zip(linked, downloads):
+            started, seconds = engine.timings.get(local_path, (0, 0))
+            record_span("download", params["track"], started, seconds, os.path.getsize(local_path) if os.path.exists(local_path) else None, failed=errors[local_path] is not None)
+            if errors[local_path] is None:
+                params["downloaded"] = True
+            else:
+                print("Exception thrown for track", params["track"], errors[local_path])
+        files = [f for f in files if f["download_function"] != download_linked_file or f["download_params"].get("downloaded", False)]
+    return files
+
+def convert_files(folder, files):
+    # conversion to bed runs in the worker pool
+    output = get_pool().map(partial(file_download_handler, folder), files)
+
 def download_all_files(folder, files_info):
-    proc = subprocess.check_output("mkdir -p data/{}".format(folder), shell=True)
-    with Pool(config.AVAILABLE_PROCCESSES) as p:  # to check multiprocessing.cpu_count()
-        output = p.map(partial(file_download_handler, folder), files_info.values())
+    convert_files(folder, fetch_linked_files(folder, files_info))
 
 
 def giggle_sort(path):
+    """ sorts every bed file in path into path_sorted as bgzip files, one file
+    per worker, then removes path
+    Returns
+    -------
+    extents: dict
+        {file name: {chrom: [min start, max end, interval count]}}
+    """
     sorted_path = path + "_sorted"
-    temp_path = path + "_temp"
-
-    # make sorted directory
     os.makedirs(sorted_path, exist_ok=True)
+    file_list = [os.path.join(path, f) for f in os.listdir(path) if ".bed" in f]
+    output = get_pool().map(partial(sort_into_folder, sorted_path), file_list)
+    shutil.rmtree(path, ignore_errors=True)
+    # extents are taken while sorting so indexing does not read the files again
+    return dict([sorted_file for sorted_file in output if sorted_file is not None])
 
-    # split into 500 files groups and then sort bed
-    batch_size = 500
-    file_list = os.listdir(path)
-    while len(file_list) > batch_size:
-        os.makedirs(temp_path, exist_ok=True)
-        # sort batch of files
-        for f in file_list[:batch_size]:
-            shutil.move(path+"/"+f, temp_path)
-
-        cmd_str = 'giggle/scripts/sort_bed \"{}/*.bed*\" {} {}'.format(temp_path, sorted_path, config.AVAILABLE_PROCCESSES)
-        proc = subprocess.check_output(cmd_str,
-                                    shell=True,
-                                    timeout=2*60)
-        proc = subprocess.check_output("rm -R -f {}".format(temp_path), shell=True)
-        proc = subprocess.check_output("mkdir -p {}".format(temp_path), shell=True, timeout=config.timeout_file_processing)
-        # remove unsorted files from queue
-        file_list = file_list[batch_size:]
-
-    # sort remaining files using giggle sort
-    cmd_str = 'giggle/scripts/sort_bed \"{}/*.bed*\" {} {}'.format(path, sorted_path, config.AVAILABLE_PROCCESSES)
-    print(cmd_str)
-    proc = subprocess.check_output(cmd_str,
-                                    shell=True,
-                                    timeout=2*60)
-    
-    proc = subprocess.check_output("rm -R -f {}".format(path), shell=True)
-    proc = subprocess.check_output("rm -R -f {}".format(temp_path), shell=True)
+def normalize_chrom(chrom):
+    # giggle matches chromosomes with or without the chr prefix
+    return chrom[3:] if chrom[:3].lower() == "chr" else chrom
 
-def giggle_move_index(path, params):
+
+def bed_extents(path, extents=None):
+    """ scans a bed(.gz) or vcf(.gz) file for the extent of its intervals on each chromosome
+    Parameters
+    ----------
+    path: string
+        path to file
+    extents: dict
+        extents to add the file to, used to combine the extents of several files
+    Returns
+    -------
+    extents: dict
+        {chrom: [min start, max end, interval count]}, chrom without chr prefix
+    """
+    extents = {} if extents is None else extents
+    vcf = ".vcf" in path
+    f = gzip.open(path, "rt") if path.endswith(".gz") else open(path, "r")
+    with f:
+        for line in f:
+            if line.startswith("#") or line.startswith("track") or line.startswith("browser"):
+                continue
+            fields = line.split("\t")
+            if len(fields) < 3:
+                continue
+            if vcf:
+                start = int(fields[1]) - 1
+                end = start + len(fields[3])
+            else:
+                start = int(fields[1])
+                end = int(fields[2])
+            chrom = normalize_chrom(fields[0])
+            if chrom in extents:
+                extent = extents[chrom]
+                extent[0] = min(extent[0], start)
+                extent[1] = max(extent[1], end)
+                extent[2] = extent[2] + 1
+            else:
+                extents[chrom] = [start, end, 1]
+    return extents
+
+
+def add_extents(extents, file_extents):
+    """ adds extents taken with the chromosome names of a file to extents keyed without the chr prefix """
+    for chrom, (start, end, count) in file_extents.items():
+        chrom = normalize_chrom(chrom)
+        if chrom in extents:
+            extent = extents[chrom]
+            extent[0] = min(extent[0], start)
+            extent[1] = max(extent[1], end)
+            extent[2] = extent[2] + count
+        else:
+            extents[chrom] = [start, end, count]
+    return extents
+
+
+def record_extents(conn, index_extents):
+    """ stores the chromosome extents of indices into EXTENTS
+    Parameters
+    ----------
+    index_extents: list
+        [index name, {chrom: [min start, max end, interval count]}] for each index
+    """
+    rows = [(index_name, chrom, extent[0], extent[1], extent[2]) for index_name, extents in index_extents for chrom, extent in extents.items()]
+    conn.executemany("INSERT INTO EXTENTS (INDEXID, CHROM, MINSTART, MAXEND, INTERVALS) VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def giggle_move_index(path, params, keep_folder=None):
+    """ moves the sorted files of an index out of path and indexes them, the
+    files are moved to keep_folder afterwards if given, else deleted. Files
+    without extents in params are scanned for them
+    """
     try:
         index_name = params[0]
         files = params[1]
+        file_extents = params[2] if len(params) > 2 else {}
         print("Making indices")
         index_path = "data/{}".format(index_name)
         os.makedirs(index_path, exist_ok=True)
 
+        extents = {}
+        index_bytes = 0
         for f in files:
             shutil.move("{}/{}.bed.gz".format(path, f),index_path)
+            index_bytes = index_bytes + os.path.getsize("{}/{}.bed.gz".format(index_path, f))
+            if f in file_extents:
+                add_extents(extents, file_extents[f])
+            else:
+                bed_extents("{}/{}.bed.gz".format(index_path, f), extents)
             # proc = subprocess.check_output("mv {}/{}.bed.gz {}/".format(path, f, index_path), shell=True)
 
-        cmd_str = 'giggle index -i \"{}/*.bed.gz\" -o indices/{}.d  -f -s'.format(index_path, index_name)
-        print(cmd_str)
-        proc = subprocess.check_output(cmd_str, timeout=config.timeout_file_processing, shell=True)
+        with span("index", index_name, index_bytes, sum([extent[2] for extent in extents.values()])):
+            build_engine().build(index_path, index_name)
 
-        proc = subprocess.check_output("rm -R -f {}".format(index_path), shell=True)
-        proc = subprocess.check_output("rm -R -f {}/".format(path), shell=True)
+        if keep_folder is not None:
+            shutil.rmtree(keep_folder, ignore_errors=True)
+            shutil.move(index_path, keep_folder)
+        shutil.rmtree(index_path, ignore_errors=True)
+        shutil.rmtree(path, ignore_errors=True)
+        return [index_name, extents]
     except Exception as e:
         print(e)
         return "error"    
 
-def download_cluster_index(index_base, source, project, genome, files_info, metadata, conn, current_index_num=1):
-    # download all files
-    all_files_folder = index_base
-    download_all_files(all_files_folder, files_info)
-    files_downloaded = os.listdir("data/" + all_files_folder)
-
-    # sort all files
-    if len(files_downloaded) > 0:
-        giggle_sort("data/{}".format(all_files_folder))
-        all_files_folder = "data/{}_sorted".format(all_files_folder)
-        files_downloaded = [i.replace(".bed.gz", "") for i in os.listdir(all_files_folder)]
-        
-        metadata = metadata[metadata["file_name"].isin(files_downloaded)]
-        metadata = pd.merge(metadata, 
-                            pd.DataFrame([[i] for i in files_downloaded], columns=['file_name']),
-                            on ="file_name",
-                            how ="right")
-        metadata["file_size"] = metadata["file_name"].apply(lambda n: files_info[n]["file_size"] if n in files_info.keys() else 0)
-
-        indices = []
-        while metadata.shape[0] > 0:
-            current_index_name = "{}_{}".format(index_base, current_index_num)
-            current_index_size = 0
-            current_index_full = False
-            current_index_files = []
-            for index, row in metadata.iterrows():
-                current_index_size = current_index_size + row["file_size"]
-                current_index_files.append(row["file_name"])
-                metadata.drop([index], inplace=True)
-                # insert file into DB
-                conn.execute("INSERT INTO FILES (FILEID, SIZE, GENOME, PROJECTID, INDEXID, SHORTNAME, LONGNAME, SHORTINFO, LONGINFO) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (row["file_name"], row["file_size"], genome, index_base, current_index_name, row["short_name"], row["long_name"], str(row["short_info"]), str(row["long_info"]),))
-                
-                if current_index_size > config.MAX_INTERVALS_PER_INDEX:
-                    current_index_full = True
-                    break
-            current_index_num = current_index_num + 1
-            indices.append([current_index_name, current_index_files])
-
-            conn.execute("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", 
-                (current_index_name, int(current_index_name.split("_")[-1]), date.today(), source, index_base, genome, (current_index_full), current_index_size,))
-
-        with Pool(config.AVAILABLE_PROCCESSES) as p:  # to check multiprocessing.cpu_count()
-            output = p.map(partial(giggle_move_index, all_files_folder), indices)
+def plan_index_buckets(files_info, target_count=config.INDEX_TARGET_COUNT, target_size=config.MAX_INTERVALS_PER_INDEX):
+    """ packs files into near equal sized indices before anything is downloaded.
+    Files are placed largest first into the least filled index, with as many
+    indices as target_count or as needed to keep them near target_size
+    Parameters
+    ----------
+    files_info: dict
+        {track: {"file_size": interval count, ...}}
+    target_count: int
+        minimum number of indices, 0 to use as few as target_size allows
+    target_size: int
+        intervals per index
+    Returns
+    -------
+    buckets: list
+        [{"files": {track: file info}, "size": intervals, "full": bool}]
+    """
+    if len(files_info) == 0:
+        return []
+    tracks = np.array(list(files_info.keys()), dtype=object)
+    sizes = np.array([info["file_size"] for info in files_info.values()], dtype=np.int64)
+    bin_count = int(min(len(tracks), max(1, target_count, math.ceil(sizes.sum()/target_size))))
+
+    loads = [(0, b) for b in range(bin_count)]
+    assignment = np.empty(len(tracks), dtype=np.int64)
+    for i in np.argsort(-sizes, kind="stable"):
+        load, b = heapq.heappop(loads)
+        assignment[i] = b
+        heapq.heappush(loads, (load + sizes[i], b))
+    bin_sizes = np.bincount(assignment, weights=sizes, minlength=bin_count)
+
+    # full indices are left alone by update_indices.py, the others are rebuilt with new files
+    return [{"files": {track: files_info[track] for track in tracks[assignment == b]},
+             "size": int(bin_sizes[b]),
+             "full": bool(bin_sizes[b] >= config.INDEX_FULL_FRACTION*target_size)} for b in range(bin_count)]
+
+def download_cluster_index(index_base, source, project, genome, files_info, metadata, conn, current_index_num=1, delta=False):
+    """ downloads, converts, sorts and indexes a project as a pipeline of index
+    buckets, a bucket is sorted and indexed as soon as its files are converted
+    while the following buckets are still downloading. Delta indices keep their
+    sorted files in DELTA_FOLDER so compaction.py can merge them later
+    """
+    index_names = iter(range(current_index_num, current_index_num + len(files_info) + 1))
+
+    def fetch_stage(bucket):
+        bucket["folder"] = "{}/bucket_{}".format(index_base, bucket["number"])
+        bucket["to_convert"] = fetch_linked_files(bucket["folder"], bucket["files"])
+        return bucket
+
+    def convert_stage(bucket):
+        convert_files(bucket["folder"], bucket["to_convert"])
+        # database tracks land in the sorted folder directly
+        converted = os.listdir("data/" + bucket["folder"])
+        exported = os.listdir("data/{}_sorted".format(bucket["folder"])) if os.path.isdir("data/{}_sorted".format(bucket["folder"])) else []
+        return bucket if len(converted) + len(exported) > 0 else None
+
+    def sort_stage(bucket):
+        bucket["extents"] = giggle_sort("data/{}".format(bucket["folder"]))
+        bucket["sorted_folder"] = "data/{}_sorted".format(bucket["folder"])
+        bucket["sorted_files"] = [i.replace(".bed.gz", "") for i in os.listdir(bucket["sorted_folder"])]
+        return bucket if len(bucket["sorted_files"]) > 0 else None
+
+    def index_stage(bucket):
+        # names are given here so buckets that fail to download leave no gaps
+        bucket["index_name"] = "{}_{}".format(index_base, next(index_names))
+        keep_folder = os.path.join(config.DELTA_FOLDER, bucket["index_name"]) if delta else None
+        # builds run in the worker pool, several at a time, and are collected once every bucket is through
+        bucket["build"] = get_pool().submit(partial(giggle_move_index, bucket["sorted_folder"], keep_folder=keep_folder),
+                                            [bucket["index_name"], bucket["sorted_files"], bucket["extents"]])
+        return bucket
+
+    with span("cluster", index_base, intervals=sum([f["file_size"] for f in files_info.values()])):
+        buckets = plan_index_buckets(files_info)
+    for number, bucket in enumerate(buckets):
+        bucket["number"] = number
+    stages = [("download", fetch_stage), ("convert", convert_stage), ("sort", sort_stage), ("index", index_stage)]
+    setup_pipeline = Pipeline(stages)
+
+    output = []
+    indexed = []
+    index_rows = []
+    submitted = list(setup_pipeline.run(buckets))
+    for bucket in submitted:
+        try:
+            bucket["output"] = bucket["build"]()
+        except Exception as e:
+            print("Could not build index", bucket["index_name"], e)
+            continue
+        if bucket["output"] == "error":
+            continue
+        index_name = bucket["index_name"]
+        indexed.extend([[f, index_name] for f in bucket["sorted_files"]])
+        index_rows.append([index_name, int(index_name.split("_")[-1]), date.today(), source, index_base, genome, bucket["full"]])
+        output.append(bucket["output"])
+    shutil.rmtree("data/{}".format(index_base), ignore_errors=True)
+    print("Setup pipeline", setup_pipeline.stats())
+
+    # the whole plan is written to the catalog at once
+    files = pd.DataFrame(indexed, columns=["file_name", "index_name"])
+    files = pd.merge(metadata[metadata["file_name"].isin(files["file_name"])], files, on="file_name", how="right")
+    files["file_size"] = files["file_name"].map(lambda n: files_info[n]["file_size"] if n in files_info.keys() else 0)
+    files["genome"] = genome
+    files["project_id"] = index_base
+    files["short_info"] = files["short_info"].astype(str)
+    files["long_info"] = files["long_info"].astype(str)
+    columns = ["file_name", "file_size", "genome", "project_id", "index_name", "short_name", "long_name", "short_info", "long_info"]
+    conn.executemany("INSERT INTO FILES (FILEID, SIZE, GENOME, PROJECTID, INDEXID, SHORTNAME, LONGNAME, SHORTINFO, LONGINFO) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        zip(*[files[c].tolist() for c in columns]))
+    index_sizes = files.groupby("index_name")["file_size"].sum().to_dict()
+    conn.executemany("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [row + [int(index_sizes.get(row[0], 0))] for row in index_rows])
+    if delta:
+        conn.executemany("INSERT INTO DELTAS (INDEXID, PROJECTID) VALUES (?, ?)", [(row[0], index_base) for row in index_rows])
+
+    # record chromosome extents of each index so queries can skip indices
+    record_extents(conn, output)
+    # indices were rewritten, cached query results are no longer valid
+    bump_index_version(conn)
 
 #########################
 # UCSC GENOME FUNCTIONS #
@@ -225,7 +412,10 @@ def collect_ucsc_files(genome, max_file_size = config.max_file_size, HUB_EXT = "
     request_url = "{}/list/tracks?{}genome={};trackLeavesOnly=1".format(config.UCSC_API, HUB_EXT, genome)
     print("REQUEST URL", request_url)
     try:
-        tracks = requests.get(url=request_url).json()[genome]
+        with span("api_listing", genome) as counts:
+            response = requests.get(url=request_url)
+            counts["bytes"] = len(response.content)
+        tracks = response.json()[genome]
 
         files_info = {}  # Create empty dict to fill with info
         with alive_bar(len(tracks), bar='bubbles', spinner='classic') as bar:  # Start progress bar
@@ -279,19 +469,35 @@ def download_UCSC_sql_file(path, params):
     file_type = params["file_type"]
     HUB_EXT = params["hub_ext"]
 
+    table = "{}.{}".format(genome, track)
+    # database tables are exported already sorted, straight into the folder giggle_sort fills
+    source = "sql-sorted:{}{}".format(HUB_EXT, table)
+    sorted_path = 'data/{}_sorted/{}.bed.gz'.format(path, track)
+    os.makedirs(os.path.dirname(sorted_path), exist_ok=True)
+    cache = blob_cache()
+
     with connect_SQL_db(config.UCSC_SQL_DB_HOST, "genome") as db:
-        df = pd.read_sql("Select * from {}.{}".format(genome, track), con=db)
-        columns = df.columns
+        # an export is reused while its table keeps the UPDATE_TIME it had, tables without one are always exported
+        version = sql_table_version(db, table) if cache is not None else None
+        if version is None:
+            cache = None
+        if cache is not None and not params.get("refresh", False) and cache.get(source, sorted_path, version):
+            return
+        columns = sql_table_columns(db, table)
         if "fileName" in columns: # bigWig files do not like big data url in API, only in sql table
-            big_data_URL = df["fileName"].iloc[0]
-            if big_data_URL.split(".")[-1] in config.UCSC_ACCEPTABLE_FILE_FORMATS:
-                download_linked_file(path,{"track":track, "download_location":big_data_URL if HUB_EXT!="" else (config.UCSC_BIG_DATA_LINK+big_data_URL), "file_type":big_data_URL.split(".")[-1]})
+            big_data_URL = sql_first_value(db, table, "fileName")
+            if big_data_URL is not None and big_data_URL.split(".")[-1] in config.UCSC_ACCEPTABLE_FILE_FORMATS:
+                download_linked_file(path,{"track":track, "download_location":big_data_URL if HUB_EXT!="" else (config.UCSC_BIG_DATA_LINK+big_data_URL), "file_type":big_data_URL.split(".")[-1], "refresh": params.get("refresh", False)})
         elif len(columns)>3: # some tables are empty
-            column_mapping, baseshift = extract_bed_columns(columns, file_type)
-            if column_mapping!="bed mapping not found":
-                df.rename(columns=column_mapping, inplace=True)
-                df = df[["chrom","start","end"]]
-                pybedtools.BedTool.from_dataframe(df).saveas('data/{}/{}.bed'.format(path, track))
+            bed_columns = extract_bed_columns(columns, file_type)
+            if bed_columns!="bed mapping not found":
+                column_mapping, base_shift = bed_columns
+                with span("sql_export", table) as counts:
+                    extents = export_sql_bed(db, table, column_mapping, base_shift, sorted_path)
+                    counts["bytes"] = os.path.getsize(sorted_path)
+                    counts["intervals"] = sum([extent[2] for extent in extents.values()])
+                if cache is not None:
+                    cache.put(source, sorted_path, version)
 
 
 def download_linked_file(path, params):
@@ -308,35 +514,56 @@ def download_linked_file(path, params):
     nothing
     """
 
+    source = "bed:{}".format(params["download_location"])
+    bed_path = "data/{}/{}.bed".format(path, params["track"])
+    cache = None if 'local' in path else blob_cache()
+    if cache is not None and "version" not in params:
+        remote = [params["download_location"]] if params["download_location"].startswith("http") else []
+        params["version"] = source_version(DownloadEngine(concurrency=1).remote_headers(remote).get(params["download_location"]))
     try:
-        # download file from
-        if 'local' in path:
-            shutil.copyfile(params["download_location"], "data/{}/{}.{}".format(path, params["track"], params["file_type"]))
+        # reuse the bed converted by an earlier run or another project
+        if cache is not None and not params.get("refresh", False) and cache.get(source, bed_path, params["version"]):
+            return
+
+        # download file from, skipped when download_all_files already fetched it
+        local_path = "data/{}/{}.{}".format(path, params["track"], params["file_type"])
+        if params.get("downloaded", False):
+            pass
         else:
-            cmd_str = "curl {} --output data/{}/{}.{}".format(params["download_location"], path, params["track"], params["file_type"])
-            subprocess.check_output(cmd_str, shell=True, timeout = config.timeout_file_download)
-        params["download_location"] = "data/{}/{}.{}".format(path, params["track"], params["file_type"])
+            with span("download", params["track"]) as counts:
+                if 'local' in path:
+                    shutil.copyfile(params["download_location"], local_path)
+                else:
+                    error = DownloadEngine(concurrency=1).download([(params["download_location"], local_path)])[local_path]
+                    if error is not None:
+                        raise error
+                counts["bytes"] = os.path.getsize(local_path)
+        params["download_location"] = local_path
 
         try:
-            if "bb" == params["file_type"]:
-                cmd_str  = "UCSC_utilities/bigBedToBed {} data/{}/{}.bed".format(params["download_location"], path, params["track"])
-                subprocess.check_output(cmd_str, shell=True, timeout = config.timeout_file_download)
-                os.remove(params["download_location"])
-            elif "bw" == params["file_type"]:
-                cmd_str  = "UCSC_utilities/bigWigToBedGraph {} data/{}/{}.bed".format(params["download_location"], path, params["track"])
-                subprocess.check_output(cmd_str, shell=True, timeout = config.timeout_file_download)
-                os.remove(params["download_location"])
-            elif "bigPsl" == params["file_type"]:
-                cmd_str = "UCSC_utilities/bigPslToPsl {} data/{}/{}.psl".format(params["download_location"], path, params["track"])
-                subprocess.check_output(cmd_str, shell=True, timeout = config.timeout_file_download)
-                cmd_str = "UCSC_utilities/pslToBed data/{}/{}.psl data/{}/{}.bed".format(path, params["track"], path, params["track"])
-                subprocess.check_output(cmd_str, shell=True)
-                os.remove(params["download_location"])
-                os.remove("data/{}/{}.psl".format(path, params["track"]))
-            elif "bed" == params["file_type"]:
-                pass
-            else:
-                print("File {} of type not able to be converted".format(params["track"], params["file_type"]))
+            with span("convert", params["track"]) as counts:
+                if "bb" == params["file_type"]:
+                    cmd_str  = "UCSC_utilities/bigBedToBed {} data/{}/{}.bed".format(params["download_location"], path, params["track"])
+                    subprocess.check_output(cmd_str, shell=True, timeout = config.timeout_file_download)
+                    os.remove(params["download_location"])
+                elif "bw" == params["file_type"]:
+                    cmd_str  = "UCSC_utilities/bigWigToBedGraph {} data/{}/{}.bed".format(params["download_location"], path, params["track"])
+                    subprocess.check_output(cmd_str, shell=True, timeout = config.timeout_file_download)
+                    os.remove(params["download_location"])
+                elif "bigPsl" == params["file_type"]:
+                    cmd_str = "UCSC_utilities/bigPslToPsl {} data/{}/{}.psl".format(params["download_location"], path, params["track"])
+                    subprocess.check_output(cmd_str, shell=True, timeout = config.timeout_file_download)
+                    cmd_str = "UCSC_utilities/pslToBed data/{}/{}.psl data/{}/{}.bed".format(path, params["track"], path, params["track"])
+                    subprocess.check_output(cmd_str, shell=True)
+                    os.remove(params["download_location"])
+                    os.remove("data/{}/{}.psl".format(path, params["track"]))
+                elif "bed" == params["file_type"]:
+                    pass
+                else:
+                    print("File {} of type not able to be converted".format(params["track"], params["file_type"]))
+                counts["bytes"] = os.path.getsize(bed_path) if os.path.exists(bed_path) else None
+            if cache is not None and os.path.exists(bed_path):
+                cache.put(source, bed_path, params["version"])
 
         except Exception as e:
             # some files are labeled as .bb but store html with an alternate url
@@ -352,6 +579,8 @@ def download_linked_file(path, params):
                             url_found = True
                             url = l[start:stop+len(params["file_type"])]
                             params["download_location"] = url
+                            params["downloaded"] = False
+                            params.pop("version", None)
                             download_linked_file(path, params)
                             break
                 if not url_found:
@@ -364,7 +593,7 @@ def download_linked_file(path, params):
 
 
 def UCSC_metadata(genome):
-    with connect_SQL_db(config.UCSC_SQL_DB_HOST, "genome") as db:
+    with span("metadata", genome), connect_SQL_db(config.UCSC_SQL_DB_HOST, "genome") as db:
         query = "SELECT tableName AS file_name, shortLabel AS short_name, longLabel as long_name, html as long_info from {}.trackDb order by tableName".format(genome)
         df_metadata = pd.read_sql(query, con=db)
     
@@ -378,10 +607,12 @@ def UCSC_metadata(genome):
     return df_metadata
 
 
+# Format of descriptions <H3>Description</H3> <P> ... <P> <h2>Description</h2> <p>
+DESCRIPTION_PATTERN = re.compile('^[ \t]*<[hH]{1}[0-9]{1}>[ \t]*Description[ \t]*<\/[hH]{1}[0-9]{1}>(.*?)<[pP]{1}>[ \t]*(.*?)<\/[pP]{1}>', flags = re.DOTALL)
+
 def HTML_extract_description(html):
-    # Format of descriptions <H3>Description</H3> <P> ... <P> <h2>Description</h2> <p>
     if "Description" in html:
-        result = re.search('^[ \t]*<[hH]{1}[0-9]{1}>[ \t]*Description[ \t]*<\/[hH]{1}[0-9]{1}>(.*?)<[pP]{1}>[ \t]*(.*?)<\/[pP]{1}>', html, flags = re.DOTALL)
+        result = DESCRIPTION_PATTERN.search(html)
         if result != None:
             htmldescr = result.group(0)
             index = htmldescr.find("<P>")
@@ -390,12 +621,22 @@ def HTML_extract_description(html):
             return htmldescr[index:len(htmldescr)]
     return ""
 
+def extract_descriptions(pages):
+    """ extracts the description of each page once, {key: html} -> {key: description} """
+    descriptions = {}
+    by_html = {}
+    for key, html in pages.items():
+        if html not in by_html:
+            by_html[html] = HTML_extract_description(html)
+        descriptions[key] = by_html[html]
+    return descriptions
+
 ######################
 # UCSC HUB FUNCTIONS #
 ######################
 def add_genome(genome, science_name, common_name, description, conn):
     # add genome if it has yet to be added
-    cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = '{}'".format(genome))
+    cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = ?", (genome,))
     df = pd.DataFrame(cursor.fetchall())
     if df.empty:
         conn.execute("INSERT INTO GENOMES (GENOME, SCINAME, COMMONNAME, DESCRIPTION) VALUES (?, ?, ?, ?)", (genome, science_name, common_name, description,))
@@ -468,15 +709,23 @@ def collect_ucscHubs(hub_names):
 
 def UCSC_hubs_metadata(hub, genome):
     url = "{}/list/tracks?hubUrl={};genome={};trackLeavesOnly=1".format(config.UCSC_API, hub["hub_url"], genome)
-    track_metadata = requests.get(url = url).json()[genome]
+    with span("api_listing", "{} {}".format(hub["hub_short_label"], genome)) as counts:
+        response = requests.get(url = url)
+        counts["bytes"] = len(response.content)
+    track_metadata = response.json()[genome]
     hub_info_string = "This file is from the UCSC public hub <a href=\"{}\">{} : {}</a>".format(hub["descriptionUrl"], hub["hub_short_label"], hub["hub_long_label"])
-    # retrieve descriptions through html key
+    # retrieve descriptions through html key, all pages are fetched together then extracted
+    urls = {track: hub["hub_url"][:-7] + info["html"][5:-(len(track)+1)] + "/" + info["html"] for track, info in track_metadata.items() if "html" in info.keys()}
+    fetcher = MetadataFetcher()
+    with span("metadata", "{} {}".format(hub["hub_short_label"], genome)) as counts:
+        pages = fetcher.fetch(urls.values())
+        counts["bytes"] = sum([len(page) for page in pages.values()])
+    descriptions = extract_descriptions({url: str(content) for url, content in pages.items()})
+    print("Hub descriptions", fetcher.stats())
     for track, info in track_metadata.items():
-        if "html" in info.keys():
-            url = hub["hub_url"][:-7] + info["html"][5:-(len(track)+1)] + "/" + info["html"]
-            response = requests.get(url=url)
-            track_metadata[track]["short_info"] = HTML_extract_description(str(response.content) )+ "\\n" + hub_info_string 
-            track_metadata[track]["long_info"] = response.content
+        if track in urls:
+            track_metadata[track]["short_info"] = descriptions[urls[track]] + "\\n" + hub_info_string 
+            track_metadata[track]["long_info"] = pages[urls[track]]
         else:
             track_metadata[track]["short_info"] = hub_info_string 
             track_metadata[track]["long_info"] = ""
@@ -509,14 +758,15 @@ def setup_local(projects, conn):
 
 def local_collect_file_info(path, max_file_size=config.max_file_size):
     file_list = glob.glob(os.path.join(path, "*.bed*"))
+    # count number of intervals per file, unchanged files are not read again
+    interval_counts = cached_interval_counts(file_list)
     files_info = {}
-    for file_name in file_list:
+    for file_path in file_list:
         # record info
-        file_name = file_name.split("/")[-1]
+        file_name = file_path.split("/")[-1]
         file_type = file_name.replace(".gz","").split(".")[-1]
         track_name = file_name.split(".")[0]
-        # count number of intervals per file
-        interval_count = int(subprocess.check_output("wc -l {}/{}".format(path, file_name), shell=True, text=True).split()[0])
+        interval_count = interval_counts[file_path]
         # store file info
         if interval_count < max_file_size:
             files_info[track_name] = {"file_size": interval_count,
@@ -563,10 +813,12 @@ if __name__ == "__main__":
         shutil.rmtree("indices")
     if os.path.exists("outputs"):
         shutil.rmtree("outputs")
-    if os.path.exists("Indexing.db"):
-        os.remove("Indexing.db")
+    if os.path.exists(config.DELTA_FOLDER):
+        shutil.rmtree(config.DELTA_FOLDER)
+    catalog.remove(config.DB)
     os.system('python3 models.py')  # setup indexing and files database
-    conn = sqlite3.connect('Indexing.db')  # make connection to database
+    conn = catalog.connect(config.DB)  # make connection to database
+    start_run(conn, "setup")  # before the worker pool starts so workers record their stage timings under this run
     
     # make directories for data and indicies 
     proc = subprocess.check_output("mkdir data/", shell=True)
@@ -579,6 +831,9 @@ if __name__ == "__main__":
     setup_local(config.LOCAL_GENOMES, conn)
 
     conn.commit()
+    print("Worker pool", get_pool().stats())
+    close_pool()
+    finish_run(conn)
     conn.close()
     proc = subprocess.check_output("python3 query_indices.py -g outputs/genomes.csv",
                                     stderr=None,
@@ -0,0 +1,78 @@
+from config import config
+import os
+import pandas as pd
+from bed_sort import sort_bed_frames, BED_COLUMNS
+
+config = config
+
+
+def quote(name):
+    # backticks are accepted by both MySQL and SQLite
+    return ".".join(["`{}`".format(part) for part in name.split(".")])
+
+
+def sql_table_columns(db, table):
+    """ returns the column names of a table without reading any rows """
+    cursor = db.cursor()
+    cursor.execute("SELECT * FROM {} LIMIT 0".format(quote(table)))
+    columns = [c[0] for c in cursor.description]
+    cursor.fetchall()
+    cursor.close()
+    return columns
+
+
+def sql_table_version(db, table):
+    """ returns the last update time of a MySQL table as a string, None when the server does not record it """
+    schema, name = table.split(".")
+    cursor = db.cursor()
+    cursor.execute("SELECT UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s", (schema, name))
+    row = cursor.fetchone()
+    cursor.fetchall()
+    cursor.close()
+    return None if row is None or row[0] is None else str(row[0])
+
+
+def sql_first_value(db, table, column):
+    cursor = db.cursor()
+    cursor.execute("SELECT {} FROM {} LIMIT 1".format(quote(column), quote(table)))
+    row = cursor.fetchone()
+    cursor.fetchall()
+    cursor.close()
+    return None if row is None else row[0]
+
+
+def sql_bed_frames(db, table, column_mapping, base_shift, chunk_size=config.SQL_CHUNK_ROWS):
+    """ yields the intervals of a table as chrom, start and end frames, only those
+    columns are selected and rows are read chunk_size at a time from an unbuffered cursor
+    Parameters
+    ----------
+    db: DB-API connection
+        mysql.connector or sqlite3 connection
+    table: string
+        ex. hg19.rmsk
+    column_mapping: dict
+        {table column: "chrom" / "start" / "end"} from extract_bed_columns
+    base_shift: int
+        added to start, -1 for 1 based tables
+    """
+    bed_columns = {bed: column for column, bed in column_mapping.items()}
+    cursor = db.cursor()
+    cursor.execute("SELECT {}, {}, {} FROM {}".format(quote(bed_columns["chrom"]), quote(bed_columns["start"]), quote(bed_columns["end"]), quote(table)))
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            frame = pd.DataFrame.from_records(rows, columns=BED_COLUMNS)
+            frame["chrom"] = frame["chrom"].astype(object)
+            frame["start"] = frame["start"].astype("int64") + base_shift
+            frame["end"] = frame["end"].astype("int64")
+            yield frame
+    finally:
+        cursor.close()
+
+
+def export_sql_bed(db, table, column_mapping, base_shift, sorted_path, chunk_size=config.SQL_CHUNK_ROWS):
+    """ streams a table into a sorted bgzip bed file, rows past SORT_MEMORY_MB are spilled to disk while sorting """
+    os.makedirs(os.path.dirname(os.path.abspath(sorted_path)), exist_ok=True)
+    return sort_bed_frames(sql_bed_frames(db, table, column_mapping, base_shift, chunk_size), sorted_path)
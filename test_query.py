@@ -0,0 +1,599 @@
+from config import config
+import unittest
+import tempfile
+import threading
+import sqlite3
+import runpy
+import shutil
+import json
+import os
+import pandas as pd
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+config = config
+
+
+def make_test_db(path):
+    """ creates an empty catalog at path using models.py """
+    db = config.DB
+    config.DB = path
+    try:
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "models.py"))
+    finally:
+        config.DB = db
+
+
+class QueryServerTests(unittest.TestCase):
+
+    ######################
+    # setup and teardown #
+    ######################
+
+    # executed prior to each test
+    def setUp(self):
+        config.TESTING = True
+        self.folder = tempfile.mkdtemp()
+        self.db = os.path.join(self.folder, "Indexing.db")
+        make_test_db(self.db)
+        conn = sqlite3.connect(self.db)
+        conn.execute("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ("local_test_hg19_1", 1, "2021-01-01", "local", "local_test_hg19", "hg19", False, 10,))
+        conn.execute("INSERT INTO FILES (FILEID, SIZE, GENOME, PROJECTID, INDEXID, SHORTNAME, LONGNAME, SHORTINFO, LONGINFO) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ("track", 10, "hg19", "local_test_hg19", "local_test_hg19_1", "", "", "", "",))
+        conn.commit()
+        conn.close()
+
+        from query_server import make_server
+        self.server = make_server(host="127.0.0.1", port=0, socket_path="", db=self.db, processes=1, cache=False)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    # executed after each test
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    ################
+    # Query Server #
+    ################
+
+    def test_server_catalog(self):
+        # catalog is loaded once at startup and served from memory
+        genomes = json.loads(urlopen(self.url + "/genomes").read())
+        self.assertEqual(genomes, [{"GENOME": "hg19"}])
+        indices = json.loads(urlopen(self.url + "/indices").read())
+        self.assertEqual([i["INDEXID"] for i in indices], ["local_test_hg19_1"])
+
+    def test_server_scoped_indices(self):
+        catalog = self.server.catalog
+        self.assertEqual(catalog.get_indices("hg19", source="local", project="local_*"), ["local_test_hg19_1"])
+        self.assertEqual(catalog.get_indices("hg19", source="UCSC"), [])
+
+    def test_server_pool_stats(self):
+        pool = json.loads(urlopen(self.url + "/pool").read())[0]
+        self.assertEqual(pool["processes"], 1)
+        self.assertEqual(pool["queue_depth"], 0)
+
+    def test_server_metrics(self):
+        text = urlopen(self.url + "/metrics").read().decode()
+        self.assertIsInstance(text, str)
+        metrics = json.loads(urlopen(self.url + "/metrics?format=json").read())
+        self.assertEqual(set(metrics.keys()), {"histograms", "counters"})
+
+    def test_server_invalid_requests(self):
+        with self.assertRaises(HTTPError) as e:
+            urlopen(self.url + "/query/interval?interval=1:100-200&genome=fake")
+        self.assertEqual(e.exception.code, 400)
+        with self.assertRaises(HTTPError) as e:
+            urlopen(self.url + "/query/interval?interval=1-100&genome=hg19")
+        self.assertEqual(e.exception.code, 400)
+        with self.assertRaises(HTTPError) as e:
+            urlopen(self.url + "/fake")
+        self.assertEqual(e.exception.code, 404)
+        # regions are never read from a path on the server
+        regions_path = os.path.join(self.folder, "regions.bed")
+        with open(regions_path, "w") as f:
+            f.write("1\t100\t200\n")
+        with self.assertRaises(HTTPError) as e:
+            urlopen(self.url + "/query/intervals?regions={}&genome=hg19".format(regions_path))
+        self.assertEqual(e.exception.code, 400)
+        # the index has no files on disk, the search fails inside the server
+        with self.assertRaises(HTTPError) as e:
+            urlopen(self.url + "/query/interval?interval=1:100-200&genome=hg19")
+        self.assertEqual(e.exception.code, 500)
+
+    def test_server_catalog_refresh(self):
+        from query_cache import bump_index_version
+        conn = sqlite3.connect(self.db)
+        conn.execute("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ("local_test_hg38_1", 1, "2021-01-01", "local", "local_test_hg38", "hg38", False, 10,))
+        bump_index_version(conn)
+        conn.commit()
+        conn.close()
+        # an update is picked up without /reload
+        genomes = json.loads(urlopen(self.url + "/genomes").read())
+        self.assertEqual(genomes, [{"GENOME": "hg19"}, {"GENOME": "hg38"}])
+        indices = json.loads(urlopen(self.url + "/indices").read())
+        self.assertEqual(len(indices), 2)
+
+
+class QueryIndicesTests(unittest.TestCase):
+
+    # executed prior to each test
+    def setUp(self):
+        config.TESTING = True
+        self.folder = tempfile.mkdtemp()
+
+    # executed after each test
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    ##################
+    # Batch Interval #
+    ##################
+
+    def test_read_regions(self):
+        from query_indices import read_regions
+        self.assertEqual(read_regions("1:100-200, chr2:5-10"), ["1:100-200", "chr2:5-10"])
+        regions_path = os.path.join(self.folder, "regions.bed")
+        with open(regions_path, "w") as f:
+            f.write("#chrom\tstart\tend\n1\t100\t200\n\nX:1-5\n")
+        self.assertEqual(read_regions(regions_path), ["1:100-200", "X:1-5"])
+        with self.assertRaises(Exception):
+            read_regions("1:100-200,1-100")
+
+    def test_make_regions_file(self):
+        import gzip
+        from query_indices import make_regions_file
+        path = make_regions_file(["1:100-200", "chrX:5-10"], self.folder)
+        self.assertTrue(path.endswith(".bed.gz"))
+        with gzip.open(path, "rt") as f:
+            self.assertEqual(f.read(), "1\t100\t200\t1:100-200\nchrX\t5\t10\tchrX:5-10\n")
+
+    #################
+    # Giggle Output #
+    #################
+
+    def test_parse_interval_search(self):
+        from giggle_output import parse_interval_search, to_columns, INTERVAL_RESULT_COLUMNS
+        lines = [b"#data/hg19_1/a.bed.gz\tsize:120\toverlaps:3\n", b"#data/hg19_1/b.bed.gz\tsize:7\toverlaps:0\n"]
+        columns = to_columns(parse_interval_search(lines), INTERVAL_RESULT_COLUMNS)
+        self.assertEqual(list(columns["file"]), ["hg19_1/a.bed.gz", "hg19_1/b.bed.gz"])
+        self.assertEqual(columns["size"].dtype.kind, "i")
+        self.assertEqual(list(columns["overlaps"]), [3, 0])
+
+    def test_parse_file_search(self):
+        import pandas as pd
+        from giggle_output import parse_file_search, to_columns, empty_columns
+        from query_indices import add_file_ids
+        lines = [b"#file\tfile_size\toverlaps\todds_ratio\tfishers_two_tail\tfishers_left_tail\tfishers_right_tail\tcombo_score\n",
+                 b"data/hg19_1/a.bed.gz\t100\t5\t2.5\t0.01\t0.99\t0.005\t4.2\t\n"]
+        columns, records = parse_file_search(lines)
+        result = to_columns(records, columns)
+        df = add_file_ids(pd.concat([pd.DataFrame(result), pd.DataFrame(result)], ignore_index=True))
+        self.assertEqual(df.shape[0], 2)
+        self.assertEqual(df["overlaps"].dtype.kind, "i")
+        self.assertEqual(df["combo_score"].dtype.kind, "f")
+        self.assertEqual(list(df["FILEID"]), ["a", "a"])
+        self.assertEqual(list(df["INDEXID"]), ["hg19_1", "hg19_1"])
+        # no results from any index
+        df = add_file_ids(pd.DataFrame(empty_columns(columns)))
+        self.assertEqual(df.shape[0], 0)
+
+    def test_parse_regions_search(self):
+        from giggle_output import parse_regions_search
+        lines = [b"##1\t100\t200\t1:100-200\n", b"1\t150\t160\tdata/hg19_1/a.bed.gz\n", b"1\t170\t180\tdata/hg19_1/a.bed.gz\n",
+                 b"##1\t500\t600\t1:500-600\n", b"1\t550\t560\tx\tdata/hg19_1/b.bed.gz\n"]
+        self.assertEqual(list(parse_regions_search(lines)), [("1:100-200", "hg19_1/a.bed.gz", 2), ("1:500-600", "hg19_1/b.bed.gz", 1)])
+
+    ##################
+    # Result Writers #
+    ##################
+
+    def test_result_writers(self):
+        import pandas as pd
+        from result_writer import open_writer, pa
+        chunks = [pd.DataFrame([["hg19_1/a.bed.gz", 10, 2]], columns=["file", "size", "overlaps"]),
+                  pd.DataFrame([], columns=["file", "size", "overlaps"]).astype({"size": int, "overlaps": int}),
+                  pd.DataFrame([["hg19_2/b.bed.gz", 5, 1], ["hg19_2/c.bed.gz", 3, 0]], columns=["file", "size", "overlaps"])]
+        expected = pd.concat(chunks, ignore_index=True)
+        formats = ["csv", "jsonl"] + (["parquet", "arrow"] if pa is not None else [])
+        for output_format in formats:
+            output_path = os.path.join(self.folder, "out." + output_format)
+            with open_writer(output_path, output_format) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+            self.assertEqual(writer.rows, 3)
+            if output_format == "csv":
+                df = pd.read_csv(output_path)
+            elif output_format == "jsonl":
+                # strict JSONL, one record per line and no blank lines between chunks
+                with open(output_path) as f:
+                    self.assertEqual([json.loads(line)["file"] for line in f.read().split("\n")[:-1]], list(expected["file"]))
+                df = pd.read_json(output_path, lines=True)
+            elif output_format == "parquet":
+                df = pd.read_parquet(output_path)
+            else:
+                df = pa.ipc.open_file(output_path).read_all().to_pandas()
+            self.assertEqual(list(df["file"]), list(expected["file"]))
+            self.assertEqual(list(df["overlaps"]), list(expected["overlaps"]))
+        with self.assertRaises(ValueError):
+            open_writer(os.path.join(self.folder, "out.xml"), "xml")
+
+    def test_arrow_writer_empty_first_chunk(self):
+        import pandas as pd
+        from result_writer import open_writer, pa
+        if pa is None:
+            self.skipTest("pyarrow not installed")
+        # an index without hits merged with metadata has object columns, SIZE must not be fixed as string by it
+        empty = pd.DataFrame([], columns=["file", "FILEID", "SIZE", "SHORTNAME"])
+        hits = pd.DataFrame([["hg19_1/a.bed.gz", "a", 10, "A"]], columns=["file", "FILEID", "SIZE", "SHORTNAME"])
+        for output_format in ["parquet", "arrow"]:
+            output_path = os.path.join(self.folder, "out." + output_format)
+            with open_writer(output_path, output_format) as writer:
+                writer.write(empty)
+                writer.write(hits)
+                writer.write(empty)
+            df = pd.read_parquet(output_path) if output_format == "parquet" else pa.ipc.open_file(output_path).read_all().to_pandas()
+            self.assertEqual(list(df["SIZE"]), [10])
+            # a result without rows still gives a file with its columns
+            with open_writer(output_path, output_format) as writer:
+                writer.write(empty)
+            df = pd.read_parquet(output_path) if output_format == "parquet" else pa.ipc.open_file(output_path).read_all().to_pandas()
+            self.assertEqual((len(df), list(df.columns)), (0, list(empty.columns)))
+
+    #################
+    # Index Pruning #
+    #################
+
+    def test_prune_indices(self):
+        from query_indices import prune_indices, interval_extents
+        extent_rows = [("a", "1", 100, 500), ("a", "2", 0, 50), ("b", "2", 100, 200)]
+        indices = ["a", "b", "c"]
+        # c has no recorded extents and is always searched
+        self.assertEqual(prune_indices(indices, extent_rows, interval_extents(["chr1:450-600"])), ["a", "c"])
+        self.assertEqual(prune_indices(indices, extent_rows, interval_extents(["2:60-99"])), ["c"])
+        self.assertEqual(prune_indices(indices, extent_rows, interval_extents(["2:40-60", "2:150-160"])), ["a", "b", "c"])
+        self.assertEqual(prune_indices(indices, extent_rows, interval_extents(["X:1-10"])), ["c"])
+
+    def test_scoped_indices(self):
+        import query_indices
+        db = os.path.join(self.folder, "Indexing.db")
+        make_test_db(db)
+        conn = sqlite3.connect(db)
+        rows = [("UCSC_hg19_1", "UCSC", "UCSC_hg19", "hg19"), ("hub_hg19_1", "hub", "hub_encode_hg19", "hg19"),
+                ("local_hg19_1", "local", "local_test_hg19", "hg19"), ("UCSC_hg38_1", "UCSC", "UCSC_hg38", "hg38")]
+        conn.executemany("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, 1, '2021-01-01', ?, ?, ?, 1, 10)", rows)
+        conn.execute("INSERT INTO EXTENTS (INDEXID, CHROM, MINSTART, MAXEND, INTERVALS) VALUES ('UCSC_hg38_1', '1', 0, 100, 5)")
+        conn.commit()
+        default = query_indices.conn
+        query_indices.conn = conn
+        try:
+            indices = query_indices.genome_indices
+            self.assertEqual(sorted(indices("hg19")), ["UCSC_hg19_1", "hub_hg19_1", "local_hg19_1"])
+            self.assertEqual(indices("hg19", source="UCSC"), ["UCSC_hg19_1"])
+            self.assertEqual(sorted(indices("hg19", source="UCSC,local")), ["UCSC_hg19_1", "local_hg19_1"])
+            self.assertEqual(indices("hg19", project="hub_*"), ["hub_hg19_1"])
+            self.assertEqual(indices("hg19", source="UCSC", project="hub_*"), [])
+            # several genomes in one call, extents still prune
+            self.assertEqual(sorted(indices("hg19, hg38", source="UCSC")), ["UCSC_hg19_1", "UCSC_hg38_1"])
+            self.assertEqual(sorted(indices("hg19,hg38", {"1": [500, 600]}, source="UCSC")), ["UCSC_hg19_1"])
+            query_indices.validate_scope("hg19,hg38", "UCSC", "*_hg19")
+            with self.assertRaises(Exception):
+                query_indices.validate_scope("hg19", project="nothing_*")
+        finally:
+            query_indices.conn = default
+            conn.close()
+
+    def test_drop_tombstones(self):
+        from query_indices import add_file_ids, drop_tombstones
+        df = add_file_ids(pd.DataFrame({"file": ["hg19_1/a.bed.gz", "hg19_1/b.bed.gz", "hg19_2/a.bed.gz"], "overlaps": [1, 2, 3]}))
+        # a was changed, its old copy in hg19_1 is hidden and the new one in hg19_2 kept
+        self.assertEqual(list(drop_tombstones(df, {"hg19_1/a"})["overlaps"]), [2, 3])
+        self.assertEqual(len(drop_tombstones(df, set())), 3)
+
+    def test_top_files(self):
+        import numpy as np
+        from query_indices import rank_filter, top_chunks, add_file_ids
+        rng = np.random.default_rng(2)
+        searches = []
+        for index in range(4):
+            searches.append({"file": np.array(["hg19_{}/{}.bed.gz".format(index, i) for i in range(30)], dtype=object),
+                             "overlaps": rng.integers(0, 10, 30),
+                             "combo_score": rng.normal(0, 5, 30),
+                             "fishers_right_tail": rng.random(30)})
+        full = pd.concat([add_file_ids(pd.DataFrame(columns)) for columns in searches], ignore_index=True)
+        for rank_by, best_first in [("combo_score", False), ("fishers_right_tail", True)]:
+            chunks = [add_file_ids(pd.DataFrame(rank_filter(columns, 5, rank_by, min_overlaps=2))) for columns in searches]
+            top = next(top_chunks(chunks, 5, rank_by))
+            expected = full[full["overlaps"] >= 2].sort_values(rank_by, ascending=best_first).head(5)
+            self.assertEqual(list(top["file"]), list(expected["file"]))
+            self.assertEqual(list(top.columns), list(full.columns))
+        # p values are kept at or below the threshold, scores at or above it
+        self.assertTrue((rank_filter(searches[0], score_threshold=0.1, rank_by="fishers_right_tail")["fishers_right_tail"] <= 0.1).all())
+        self.assertTrue((rank_filter(searches[0], score_threshold=1)["combo_score"] >= 1).all())
+        self.assertEqual(len(next(top_chunks([add_file_ids(pd.DataFrame(searches[0])).head(0)], 5))), 0)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_synthetic_bed(self):
+        import gzip
+        import numpy as np
+        from benchmark import synthetic_bed, chrom_weights, latency_summary
+        self.assertAlmostEqual(chrom_weights(5, "skewed")[0]/chrom_weights(5, "skewed")[4], 5)
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, "{}.bed.gz".format(i)) for i in range(2)]
+            # the same seed gives the same file
+            extents = [synthetic_bed(path, np.random.default_rng(7), 500, chrom_count=3, distribution="skewed") for path in paths]
+            with gzip.open(paths[0], "rt") as a, gzip.open(paths[1], "rt") as b:
+                self.assertEqual(a.read(), b.read())
+        self.assertEqual(extents[0], extents[1])
+        self.assertEqual(sum([extent[2] for extent in extents[0].values()]), 500)
+        self.assertGreater(extents[0]["chr1"][2], extents[0]["chr3"][2])
+        summary = latency_summary(np.arange(1, 101)/100, 2)
+        self.assertAlmostEqual(summary["p99"], 0.9901)
+        self.assertEqual(summary["throughput"], 50)
+
+
+class IntervalEngineTests(unittest.TestCase):
+
+    # executed prior to each test
+    def setUp(self):
+        config.TESTING = True
+        self.folder = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.folder)
+
+    # executed after each test
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def test_incomplete_engine(self):
+        from interval_engine import IntervalEngine
+        class BuildOnly(IntervalEngine):
+            def index_path(self, index):
+                return index
+            def build(self, data_path, index):
+                pass
+        # an engine missing searches fails when it is made, not part way through a query
+        with self.assertRaises(TypeError):
+            BuildOnly()
+
+    def test_numpy_engine(self):
+        import gzip
+        import numpy as np
+        from bed_sort import write_sorted_bed
+        from interval_engine import NumpyEngine, fisher_exact, index_engine, remove_index
+        os.makedirs("data/hg19_1")
+        os.makedirs("indices")
+        rng = np.random.default_rng(1)
+        files = {}
+        for name in ["a", "b", "c"]:
+            chroms = np.array(["chr1", "2"])[rng.integers(0, 2, 500)]
+            starts = rng.integers(0, 10000, 500)
+            ends = starts + rng.integers(0, 200, 500)
+            write_sorted_bed({"chrom": chroms, "start": starts, "end": ends}, "data/hg19_1/{}.bed.gz".format(name))
+            files["hg19_1/{}.bed.gz".format(name)] = (np.char.replace(chroms.astype(str), "chr", ""), starts, ends)
+        engine = NumpyEngine()
+        engine.build("data/hg19_1", "hg19_1")
+        # indices are searched with the engine that built them
+        self.assertIs(type(index_engine("hg19_1")), NumpyEngine)
+
+        # overlaps are inclusive of both ends and match with or without the chr prefix
+        for interval, chrom, start, end in [("1:500-900", "1", 500, 900), ("chr2:100-100", "2", 100, 100), ("X:1-5", "X", 1, 5)]:
+            result = engine.search_interval("hg19_1", interval)
+            self.assertEqual(sorted(result["file"]), sorted(files))
+            for file, size, overlaps in zip(result["file"], result["size"], result["overlaps"]):
+                chroms, starts, ends = files[file]
+                self.assertEqual(size, 500)
+                self.assertEqual(overlaps, ((chroms == chrom) & (starts <= end) & (ends >= start)).sum())
+
+        with gzip.open("query.bed.gz", "wt") as f:
+            f.write("chr1\t100\t3000\tr1\n2\t4000\t4100\tr2\n")
+        regions = engine.search_regions("hg19_1", "query.bed.gz")
+        search = engine.search_file("hg19_1", "query.bed.gz")
+        for file, overlaps in zip(search["file"], search["overlaps"]):
+            self.assertEqual(overlaps, sum([o for r, f, o in zip(regions["region"], regions["file"], regions["overlaps"]) if f == file]))
+        self.assertEqual(set(regions["region"]), {"r1", "r2"})
+
+        # same p values as a fisher exact test of [[3, 1], [1, 3]]
+        left, right, two = fisher_exact(3, 1, 1, 3)
+        self.assertAlmostEqual(left, 0.985714, places=5)
+        self.assertAlmostEqual(right, 0.242857, places=5)
+        self.assertAlmostEqual(two, 0.485714, places=5)
+
+        remove_index("hg19_1")
+        self.assertFalse(os.path.exists("indices/hg19_1.npy"))
+
+
+# pool tasks are pickled by name, so they live at module level
+def square(x):
+    return x*x
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def test_worker_pool(self):
+        from worker_pool import WorkerPool
+        pool = WorkerPool(2)
+        try:
+            self.assertEqual(pool.map(square, range(10)), [i*i for i in range(10)])
+            self.assertEqual(sorted(pool.imap_unordered(square, range(5))), [0, 1, 4, 9, 16])
+            with self.assertRaises(ValueError):
+                pool.map(fail, [1])
+            builds = [pool.submit(square, i) for i in range(3)]
+            self.assertEqual([build() for build in builds], [0, 1, 4])
+            stats = pool.stats()
+            self.assertEqual((stats["submitted"], stats["completed"], stats["failed"]), (19, 19, 1))
+            self.assertEqual(stats["queue_depth"], 0)
+            self.assertGreaterEqual(stats["utilisation"], 0)
+        finally:
+            pool.close()
+
+
+class QueryCacheTests(unittest.TestCase):
+
+    # executed prior to each test
+    def setUp(self):
+        config.TESTING = True
+        self.folder = tempfile.mkdtemp()
+
+    # executed after each test
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_cache_hits_and_misses(self):
+        import pandas as pd
+        from query_cache import QueryCache
+        cache = QueryCache(folder=self.folder, max_MB=1, memory_MB=1)
+        key = cache.key("interval", "1:100-200", "hg19", "v1")
+        self.assertIsNone(cache.get(key))
+        df = pd.DataFrame([["a/b.bed.gz", 10, 2]], columns=["file", "size", "overlaps"])
+        cache.put(key, df)
+        self.assertTrue(cache.get(key).equals(df))
+        # counts stay in memory until they are saved
+        self.assertFalse(os.path.exists(os.path.join(self.folder, "stats.json")))
+        cache.save_stats()
+        # a new process only has the disk copy
+        cache = QueryCache(folder=self.folder, max_MB=1, memory_MB=1)
+        self.assertTrue(cache.get(key).equals(df))
+        # another index set version is a miss
+        self.assertIsNone(cache.get(cache.key("interval", "1:100-200", "hg19", "v2")))
+        stats = cache.stats()
+        self.assertEqual((stats["memory_hits"], stats["disk_hits"], stats["misses"]), (1, 1, 2))
+        self.assertEqual(stats["disk_entries"], 1)
+
+    def test_cache_eviction(self):
+        from query_cache import QueryCache
+        cache = QueryCache(folder=self.folder, max_MB=0.003, memory_MB=0.002)
+        keys = [cache.key("interval", "1:{}-{}".format(i, i+1), "hg19", "v1") for i in range(5)]
+        for k in keys:
+            cache.put(k, "x"*1000)
+        stats = cache.stats()
+        self.assertLessEqual(stats["disk_bytes"], 3000)
+        self.assertLessEqual(stats["memory_bytes"], 2000)
+        self.assertGreater(stats["evictions"], 0)
+        # most recently used entries are kept
+        self.assertIsNotNone(cache.get(keys[-1]))
+        self.assertIsNone(cache.get(keys[0]))
+
+    def test_cache_clear(self):
+        from query_cache import QueryCache
+        cache = QueryCache(folder=self.folder, max_MB=1, memory_MB=1)
+        cache.put(cache.key("interval", "1:1-2", "hg19", "v1"), "x")
+        cache.save_stats()
+        # the cache folder is shared, other files and folders are left alone
+        os.makedirs(os.path.join(self.folder, "metadata"))
+        with open(os.path.join(self.folder, "query_metrics.json"), "w") as f:
+            f.write("{}")
+        cache.clear()
+        self.assertEqual(sorted(os.listdir(self.folder)), ["metadata", "query_metrics.json"])
+        self.assertEqual(cache.stats()["disk_entries"], 0)
+
+    def test_cached_chunks(self):
+        import pandas as pd
+        from query_cache import QueryCache
+        from query_indices import cached_chunks
+        cache = QueryCache(folder=self.folder, max_MB=1, memory_MB=1)
+        chunks = [pd.DataFrame({"overlaps": [i, i]}) for i in range(3)]
+        # chunks are passed on one at a time and the whole result is cached afterwards
+        self.assertEqual(len(list(cached_chunks(iter(chunks), cache, "small", max_rows=6))), 3)
+        self.assertEqual(list(cache.get("small")["overlaps"]), [0, 0, 1, 1, 2, 2])
+        self.assertEqual(len(list(cached_chunks(iter(chunks), cache, "large", max_rows=5))), 3)
+        self.assertIsNone(cache.get("large"))
+
+    def test_index_version(self):
+        import catalog
+        from query_cache import index_version, bump_index_version
+        conn = sqlite3.connect(os.path.join(self.folder, "Indexing.db"))
+        self.assertEqual(index_version(conn), "")
+        conn.close()
+        conn = catalog.connect(os.path.join(self.folder, "Indexing.db"))
+        self.assertEqual(index_version(conn), "")
+        bump_index_version(conn)
+        version = index_version(conn)
+        bump_index_version(conn)
+        self.assertNotEqual(version, index_version(conn))
+        conn.close()
+
+
+# saved from worker processes, so at module level
+def save_saved_metrics(path, saved, _):
+    import query_metrics
+    query_metrics.registry.merge(saved)
+    query_metrics.save_metrics(path)
+
+
+class QueryMetricsTests(unittest.TestCase):
+
+    # executed prior to each test
+    def setUp(self):
+        config.TESTING = True
+        self.folder = tempfile.mkdtemp()
+
+    # executed after each test
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_histogram(self):
+        from query_metrics import Histogram
+        histogram = Histogram([0.1, 1, 10])
+        for value in [0.05, 0.1, 0.5, 5, 50]:
+            histogram.observe(value)
+        # buckets are inclusive of their upper bound, the last is +Inf
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.cumulative(), [2, 3, 4, 5])
+        self.assertEqual(histogram.quantile(0.5), 1)
+        self.assertEqual(histogram.quantile(1), float("inf"))
+
+    def test_query_metrics(self):
+        from query_metrics import QueryMetrics, measured_query, query_kind, timed_lines, save_metrics, load_metrics
+        from query_indices import query_interval_index
+        from functools import partial
+        worker = partial(query_interval_index, "1:1-2")
+        self.assertEqual(query_kind(worker), "interval")
+
+        def fake_worker(index):
+            return {"FILEID": [line for line in timed_lines(["a", "b", "c"])]}
+        result, measure = measured_query(fake_worker, "index_1")
+        self.assertEqual(result, {"FILEID": ["a", "b", "c"]})
+        self.assertEqual((measure["index"], measure["rows"]), ("index_1", 3))
+        self.assertAlmostEqual(measure["engine"] + measure["parse"], measure["seconds"], places=3)
+
+        metrics = QueryMetrics(bounds=[0.1, 1])
+        metrics.observe_index("interval", measure, measure["started"])
+        metrics.observe_query("interval", 0.5, 3, 1)
+        text = metrics.prometheus()
+        self.assertIn('giggle_query_seconds_bucket{query="interval",le="1"} 1', text)
+        self.assertIn('giggle_index_result_rows_total{index="index_1",query="interval"} 3', text)
+        summary = metrics.index_summary()
+        self.assertEqual([(row["index"], row["searches"], row["rows"]) for row in summary], [("index_1", 1, 3)])
+
+        # saved metrics of separate calls add up
+        import query_metrics
+        path = os.path.join(self.folder, "metrics.json")
+        for _ in range(2):
+            query_metrics.registry = QueryMetrics(bounds=[0.1, 1])
+            query_metrics.registry.merge(metrics.to_json())
+            save_metrics(path)
+        self.assertEqual(query_metrics.registry.to_json(), {"histograms": [], "counters": []})
+        self.assertEqual(load_metrics(path).index_summary()[0]["searches"], 2)
+
+        # processes saving at the same time keep each other's counts
+        from multiprocessing import Pool
+        from functools import partial
+        with Pool(4) as pool:
+            pool.map(partial(save_saved_metrics, path, metrics.to_json()), range(8))
+        self.assertEqual(load_metrics(path).index_summary()[0]["searches"], 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,4 @@
-from setup_indices import connect_SQL_db, extract_bed_columns
+from setup_indices import connect_SQL_db, extract_bed_columns, bed_extents
 from config import config
 from contextlib import contextmanager
 import pandas as pd
@@ -6,6 +6,9 @@ import unittest
 import mysql.connector
 import requests
 import random
+import tempfile
+import gzip
+import os
 
 config = config
 
@@ -171,6 +174,20 @@ class BasicTests(unittest.TestCase):
     # Indexing Tests #
     ##################
 
+    def test_bed_extents(self):
+        # extents are kept per chromosome without the chr prefix
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "a.bed.gz")
+            with gzip.open(path, "wt") as f:
+                f.write("track name=a\nchr1\t100\t200\nchr1\t50\t150\n2\t10\t20\tname\n")
+            extents = bed_extents(path)
+            self.assertEqual(extents, {"1": [50, 200, 2], "2": [10, 20, 1]})
+            # extents of several files are combined
+            path = os.path.join(folder, "b.bed")
+            with open(path, "w") as f:
+                f.write("chr2\t5\t8\n")
+            self.assertEqual(bed_extents(path, extents)["2"], [5, 20, 2])
+
     # def test_cluster_data(self):
     #     testing_size = config.MAX_INTERVALS_PER_INDEX/2
     #     files_info = {"bannana": {
@@ -219,5 +236,549 @@ class BasicTests(unittest.TestCase):
     #     self.assertTrue(expected_clusters == clusters)
 
 
+class CatalogTests(unittest.TestCase):
+
+    def test_catalog_connect(self):
+        import catalog
+        import sqlite3
+        with tempfile.TemporaryDirectory() as folder:
+            db = os.path.join(folder, "Indexing.db")
+            # databases from before the catalog layer are upgraded on connect
+            conn = sqlite3.connect(db)
+            conn.execute("CREATE TABLE GENOMES (GENOME TEXT NOT NULL, SCINAME TEXT, COMMONNAME TEXT, DESCRIPTION TEXT)")
+            conn.execute("INSERT INTO GENOMES (GENOME, SCINAME, COMMONNAME, DESCRIPTION) VALUES (?, ?, ?, ?)", ("hg19", "", "", ""))
+            conn.commit()
+            conn.close()
+
+            conn = catalog.connect(db)
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            tables = [i[0] for i in conn.execute("SELECT name from sqlite_master WHERE type='table'")]
+            self.assertEqual(sorted(tables), sorted(catalog.TABLES.keys()))
+            indexes = [i[0] for i in conn.execute("SELECT name from sqlite_master WHERE type='index'")]
+            self.assertEqual(sorted(indexes), sorted(catalog.INDEXES.keys()))
+            self.assertEqual(conn.execute("SELECT GENOME from GENOMES").fetchall(), [("hg19",)])
+            # lookups by genome use the index instead of scanning FILES
+            plan = " ".join([str(i[-1]) for i in conn.execute("EXPLAIN QUERY PLAN SELECT * from FILES WHERE GENOME=? AND FILEID=?", ("hg19", "a"))])
+            self.assertIn("FILES_GENOME_FILEID", plan)
+            conn.close()
+
+            # a fresh setup removes the catalog together with any WAL left by a crashed writer
+            for suffix in ["-wal", "-shm"]:
+                open(db + suffix, "w").close()
+            catalog.remove(db)
+            self.assertEqual(os.listdir(folder), [])
+
+
+class DownloadEngineTests(unittest.TestCase):
+
+    def test_download_retry_and_resume(self):
+        from download_engine import DownloadEngine
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        import threading
+        body = bytes(range(256))*64
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                requests_seen.append((self.path, self.headers.get("Range")))
+                if self.path == "/missing.bb":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.path == "/flaky.bb" and len([i for i in requests_seen if i[0] == self.path]) == 1:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                # the range is only served while If-Range matches the current ETag
+                start = int(self.headers["Range"][6:-1]) if self.headers.get("Range") and self.headers.get("If-Range") == '"v1"' else 0
+                self.send_response(206 if start > 0 else 200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body) - start))
+                if start > 0:
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(body) - 1, len(body)))
+                self.end_headers()
+                self.wfile.write(body[start:])
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                # a partial download left by an earlier attempt is resumed while the file is unchanged,
+                # the partial download of a file that has changed since is started over
+                for name, validator in [("partial", '"v1"'), ("changed", '"v0"')]:
+                    with open(os.path.join(folder, name + ".bb.part"), "wb") as f:
+                        f.write(b"x"*1000 if name == "changed" else body[:1000])
+                    with open(os.path.join(folder, name + ".bb.part.validator"), "w") as f:
+                        f.write(validator)
+                downloads = [(url + "/flaky.bb", os.path.join(folder, "flaky.bb")),
+                             (url + "/partial.bb", os.path.join(folder, "partial.bb")),
+                             (url + "/changed.bb", os.path.join(folder, "changed.bb")),
+                             (url + "/missing.bb", os.path.join(folder, "missing.bb"))]
+                errors = DownloadEngine(retries=2, backoff=0.01).download(downloads)
+
+                self.assertIsNone(errors[downloads[0][1]])
+                self.assertIsNone(errors[downloads[1][1]])
+                self.assertIsNone(errors[downloads[2][1]])
+                self.assertIsNotNone(errors[downloads[3][1]])
+                for _, path in downloads[:3]:
+                    with open(path, "rb") as f:
+                        self.assertEqual(f.read(), body)
+                self.assertIn(("/partial.bb", "bytes=1000-"), requests_seen)
+                self.assertEqual(sorted(os.listdir(folder)), ["changed.bb", "flaky.bb", "partial.bb"])
+                # permanent failures are not retried
+                self.assertEqual(len([i for i in requests_seen if i[0] == "/missing.bb"]), 1)
+                self.assertFalse(os.path.exists(downloads[3][1]))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_pipeline_overlaps_stages(self):
+        from pipeline import Pipeline
+        import threading
+        import time
+        running = set()
+        overlapped = []
+        lock = threading.Lock()
+
+        def stage(name, delay):
+            def run(item):
+                with lock:
+                    running.add(name)
+                    if len(running) > 1:
+                        overlapped.append(item)
+                time.sleep(delay)
+                with lock:
+                    running.discard(name)
+                if name == "first" and item == 3:
+                    raise ValueError("bad item")
+                return None if item == 5 else item * 10
+            return run
+
+        pipe = Pipeline([("first", stage("first", 0.02)), ("second", stage("second", 0.02))], queue_size=1)
+        self.assertEqual(list(pipe.run(range(8))), [0, 100, 200, 400, 600, 700])
+        self.assertGreater(len(overlapped), 0)
+        stats = pipe.stats()
+        self.assertEqual(stats["first"]["items"], 8)
+        self.assertEqual(stats["first"]["failed"], 1)
+        self.assertEqual(stats["second"]["items"], 6)
+
+    def test_plan_index_buckets(self):
+        from setup_indices import plan_index_buckets
+        sizes = [90, 10, 10, 10, 40, 40, 50, 60, 30, 20]
+        files_info = {"f{}".format(i): {"file_size": size} for i, size in enumerate(sizes)}
+        buckets = plan_index_buckets(files_info, target_size=100)
+        # 360 intervals fill 4 indices of near equal size instead of 100, 100, 100, 60
+        self.assertEqual(len(buckets), 4)
+        self.assertEqual(sorted([b["size"] for b in buckets]), [90, 90, 90, 90])
+        self.assertEqual(sorted([f for b in buckets for f in b["files"]]), sorted(files_info.keys()))
+        self.assertTrue(all([b["full"] for b in buckets]))
+        # a target count splits a project below the size target
+        buckets = plan_index_buckets(files_info, target_count=3, target_size=1000)
+        self.assertEqual(sorted([b["size"] for b in buckets]), [120, 120, 120])
+        self.assertEqual([b["full"] for b in buckets], [False, False, False])
+        self.assertEqual(len(plan_index_buckets({"a": {"file_size": 5}}, target_count=3)), 1)
+        self.assertEqual(plan_index_buckets({}), [])
+
+class BedSortTests(unittest.TestCase):
+
+    def test_sort_bed_file(self):
+        from bed_sort import sort_bed_file, sorted_name
+        random.seed(1)
+        rows = [("chr{}".format(random.choice(["1", "2", "10", "X"])), random.randint(0, 10**6)) for _ in range(2000)]
+        rows = [(chrom, start, start + random.randint(1, 500)) for chrom, start in rows]
+        expected = "".join(["{}\t{}\t{}\n".format(*r) for r in sorted(rows)])
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "a.bed")
+            with open(path, "w") as f:
+                f.write("track name=a\n")
+                f.writelines(["{}\t{}\t{}\n".format(*r) for r in rows])
+            self.assertEqual(sorted_name(path), "a.bed.gz")
+            self.assertEqual(sorted_name(path + ".gz"), "a.bed.gz")
+            # a budget well below the file size forces several spilled runs to be merged
+            for memory_MB in [100, 0.005]:
+                sorted_path = os.path.join(folder, "a_{}.bed.gz".format(memory_MB))
+                extents = sort_bed_file(path, sorted_path, memory_MB=memory_MB)
+                self.assertEqual(sum([extent[2] for extent in extents.values()]), len(rows))
+                with gzip.open(sorted_path, "rt") as f:
+                    self.assertEqual(f.read(), expected)
+                with open(sorted_path, "rb") as f:
+                    data = f.read()
+                # bgzip blocks carry the BC extra field and the file ends with the empty EOF block
+                self.assertEqual(data[12:14], b"BC")
+                self.assertTrue(data.endswith(bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")))
+            self.assertEqual(sorted(os.listdir(folder)), ["a.bed", "a_0.005.bed.gz", "a_100.bed.gz"])
+
+    def test_write_sorted_bed(self):
+        import numpy as np
+        from bed_sort import write_sorted_bed
+        from bgzf import BGZFWriter
+        chroms = np.array(["chr2", "chr10", "chr1", "chr2"])
+        starts = np.array([5, 7, 9, 1])
+        ends = starts + 3
+        with tempfile.TemporaryDirectory() as folder:
+            sorted_path = os.path.join(folder, "a.bed.gz")
+            extents = write_sorted_bed({"chrom": chroms, "start": starts, "end": ends}, sorted_path)
+            with gzip.open(sorted_path, "rt") as f:
+                self.assertEqual(f.read(), "chr1\t9\t12\nchr10\t7\t10\nchr2\t1\t4\nchr2\t5\t8\n")
+            self.assertEqual(extents, {"chr1": [9, 12, 1], "chr10": [7, 10, 1], "chr2": [1, 8, 2]})
+            # blocks compressed by threads are written in order, the same bytes as one thread
+            data = os.urandom(500000).hex().encode()
+            outputs = []
+            for threads in [1, 4]:
+                path = os.path.join(folder, "{}.gz".format(threads))
+                with BGZFWriter(path, threads=threads) as f:
+                    for i in range(0, len(data), 70001):
+                        f.write(data[i:i + 70001])
+                with open(path, "rb") as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(gzip.decompress(outputs[1]), data)
+
+    def test_export_sql_bed(self):
+        # sqlite takes the same backtick quoting as the UCSC MySQL server
+        import sqlite3
+        from sql_export import sql_table_columns, export_sql_bed
+        db = sqlite3.connect(":memory:")
+        db.execute("CREATE TABLE track (seqname TEXT, chrom TEXT, start INT, end INT, attributes BLOB)")
+        rows = [("x", "chr{}".format(c), s, s + 10, b"\0"*100) for c in ["2", "1", "10"] for s in [500, 1, 30]]
+        db.executemany("INSERT INTO track VALUES (?, ?, ?, ?, ?)", rows)
+        queries = []
+        db.set_trace_callback(queries.append)
+        columns = sql_table_columns(db, "main.track")
+        column_mapping, base_shift = extract_bed_columns(columns, "GFF")
+        with tempfile.TemporaryDirectory() as folder:
+            sorted_path = os.path.join(folder, "track.bed.gz")
+            export_sql_bed(db, "main.track", column_mapping, base_shift, sorted_path, chunk_size=4)
+            with gzip.open(sorted_path, "rt") as f:
+                lines = f.read().splitlines()
+        self.assertEqual(lines[:3], ["chr1\t0\t11", "chr1\t29\t40", "chr1\t499\t510"])
+        self.assertEqual(lines[-1], "chr2\t499\t510")
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(queries[-1], "SELECT `chrom`, `start`, `end` FROM `main`.`track`")
+
+    def test_count_intervals(self):
+        from unittest import mock
+        import interval_count
+        from bgzf import BGZFWriter
+        lines = ["chr1\t{}\t{}\n".format(i, i + 5) for i in range(70000)]
+        with tempfile.TemporaryDirectory() as folder:
+            paths = {"plain.bed": 70000, "gzip.bed.gz": 70000, "bgzip.bed.gz": 70000, "tail.bed": 2}
+            with open(os.path.join(folder, "plain.bed"), "w") as f:
+                f.write("browser position chr1\ntrack name=plain\n#comment\n")
+                f.writelines(lines)
+            with gzip.open(os.path.join(folder, "gzip.bed.gz"), "wt") as f:
+                f.writelines(lines)
+            # bgzip files are many gzip members, each of its blocks has to be read
+            with BGZFWriter(os.path.join(folder, "bgzip.bed.gz")) as f:
+                f.write("".join(lines).encode())
+            with open(os.path.join(folder, "tail.bed"), "w") as f:
+                f.write("chr1\t1\t2\nchr1\t3\t4")
+            paths = {os.path.join(folder, name): count for name, count in paths.items()}
+            cache_path = os.path.join(folder, "counts.json")
+            self.assertEqual(interval_count.cached_interval_counts(list(paths), cache_path), paths)
+            # a second scan only stats the files
+            with mock.patch.object(interval_count, "get_pool") as pool:
+                self.assertEqual(interval_count.cached_interval_counts(list(paths), cache_path), paths)
+                pool.assert_not_called()
+
+
+class CompactionTests(unittest.TestCase):
+
+    def test_plan_compactions(self):
+        from compaction import plan_compactions, delta_tier
+        small = config.COMPACTION_MIN_SIZE//2
+        large = config.COMPACTION_MIN_SIZE*config.COMPACTION_TIER_RATIO
+        self.assertEqual(delta_tier(small), 0)
+        self.assertLess(delta_tier(config.COMPACTION_MIN_SIZE), delta_tier(large))
+        deltas = [("s{}".format(i), small) for i in range(config.COMPACTION_MIN_DELTAS)] + [("l0", large), ("l1", large)]
+        self.assertEqual(plan_compactions(deltas), [["s{}".format(i) for i in range(config.COMPACTION_MIN_DELTAS)]])
+        self.assertEqual(plan_compactions(deltas[1:]), [])
+
+    def test_merge_deltas(self):
+        import catalog
+        import compaction
+        from unittest import mock
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                conn = catalog.connect("Indexing.db")
+                conn.execute("INSERT INTO VERSION (VERSION) VALUES (?)", ("old",))
+                for i in [1, 2]:
+                    index_id = "local_p_hg19_{}".format(i)
+                    conn.execute("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (index_id, i, "2024-01-01", "local", "local_p_hg19", "hg19", False, 10))
+                    conn.execute("INSERT INTO FILES (FILEID, SIZE, GENOME, PROJECTID, INDEXID) VALUES (?, ?, ?, ?, ?)", ("f{}".format(i), 10, "hg19", "local_p_hg19", index_id))
+                    conn.execute("INSERT INTO EXTENTS (INDEXID, CHROM, MINSTART, MAXEND, INTERVALS) VALUES (?, ?, ?, ?, ?)", (index_id, "1", 0, 100, 10))
+                    conn.execute("INSERT INTO DELTAS (INDEXID, PROJECTID) VALUES (?, ?)", (index_id, "local_p_hg19"))
+                    os.makedirs(os.path.join(config.DELTA_FOLDER, index_id))
+                    with gzip.open(os.path.join(config.DELTA_FOLDER, index_id, "f{}.bed.gz".format(i)), "wt") as f:
+                        f.write("chr1\t0\t100\n")
+                conn.commit()
+
+                built = []
+                def build(path, params, keep_folder=None):
+                    built.append(sorted(os.listdir(path)))
+                    # an update retires f2 while the merged index is built
+                    update = catalog.connect("Indexing.db")
+                    update.execute("INSERT INTO TOMBSTONES (INDEXID, FILEID) VALUES (?, ?)", ("local_p_hg19_2", "f2"))
+                    update.execute("DELETE FROM FILES WHERE FILEID=?", ("f2",))
+                    update.commit()
+                    update.close()
+                    return [params[0], {"1": [0, 100, 20]}]
+                with mock.patch.object(compaction, "giggle_move_index", build):
+                    merged = compaction.merge_deltas(conn, "local_p_hg19", ["local_p_hg19_1", "local_p_hg19_2"])
+
+                self.assertEqual(merged, "local_p_hg19_3")
+                self.assertEqual(built, [["f1.bed.gz", "f2.bed.gz"]])
+                self.assertEqual(conn.execute("SELECT INDEXID, SIZE FROM INDICES").fetchall(), [("local_p_hg19_3", 10)])
+                # f2 is in the merged index, its tombstone moves with it
+                self.assertEqual(conn.execute("SELECT INDEXID, FILEID FROM TOMBSTONES").fetchall(), [("local_p_hg19_3", "f2")])
+                self.assertEqual(conn.execute("SELECT DISTINCT INDEXID FROM FILES").fetchall(), [("local_p_hg19_3",)])
+                self.assertEqual(conn.execute("SELECT INDEXID FROM DELTAS").fetchall(), [("local_p_hg19_3",)])
+                self.assertEqual(conn.execute("SELECT INDEXID, INTERVALS FROM EXTENTS").fetchall(), [("local_p_hg19_3", 20)])
+                self.assertNotEqual(conn.execute("SELECT VERSION FROM VERSION").fetchone()[0], "old")
+                self.assertEqual(os.listdir(config.DELTA_FOLDER), [])
+                conn.close()
+            finally:
+                os.chdir(cwd)
+
+
+class ManifestTests(unittest.TestCase):
+
+    def test_plan_update(self):
+        import catalog
+        from manifest import plan_update, plan_cost, retire_files, record_manifest
+        with tempfile.TemporaryDirectory() as folder:
+            conn = catalog.connect(os.path.join(folder, "Indexing.db"))
+            files_info = {}
+            for name in ["a", "b", "c"]:
+                path = os.path.join(folder, name + ".bed")
+                with open(path, "w") as f:
+                    f.write("chr1\t0\t100\n")
+                files_info[name] = {"file_size": 1, "download_params": {"track": name, "download_location": path, "file_type": "bed"}}
+                conn.execute("INSERT INTO FILES (FILEID, SIZE, GENOME, PROJECTID, INDEXID) VALUES (?, ?, ?, ?, ?)", (name, 1, "hg19", "local_p_hg19", "local_p_hg19_1"))
+            conn.execute("INSERT INTO INDICES (INDEXID, ITER, DATE, DSOURCE, PROJECTID, GENOME, FULL, SIZE) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ("local_p_hg19_1", 1, "2024-01-01", "local", "local_p_hg19", "hg19", False, 3))
+
+            # files indexed before the manifest are recorded as they are
+            plan = plan_update(conn, "local_p_hg19", files_info)
+            self.assertEqual(sorted(plan["unchanged"]["FILEID"]), ["a", "b", "c"])
+            record_manifest(conn, "local_p_hg19", plan["fingerprints"])
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM MANIFEST").fetchone()[0], 3)
+
+            # a is rewritten, c is gone and d is new
+            with open(files_info["a"]["download_params"]["download_location"], "w") as f:
+                f.write("chr1\t0\t100\nchr1\t200\t300\n")
+            path = os.path.join(folder, "d.bed")
+            with open(path, "w") as f:
+                f.write("chr1\t0\t100\n")
+            files_info["d"] = {"file_size": 1, "download_params": {"track": "d", "download_location": path, "file_type": "bed"}}
+            del files_info["c"]
+            plan = plan_update(conn, "local_p_hg19", files_info)
+            self.assertEqual(list(plan["new"]["FILEID"]), ["d"])
+            self.assertEqual(list(plan["changed"]["FILEID"]), ["a"])
+            self.assertEqual(list(plan["removed"]["FILEID"]), ["c"])
+            self.assertEqual(list(plan["unchanged"]["FILEID"]), ["b"])
+            cost = plan_cost(plan, files_info)
+            self.assertEqual([cost["new"], cost["changed"], cost["removed"], cost["intervals"], cost["indices_touched"]], [1, 1, 1, 2, 1])
+
+            retire_files(conn, "local_p_hg19", pd.concat([plan["changed"], plan["removed"]]))
+            self.assertEqual(sorted(conn.execute("SELECT FILEID FROM TOMBSTONES").fetchall()), [("a",), ("c",)])
+            self.assertEqual(conn.execute("SELECT FILEID FROM FILES").fetchall(), [("b",)])
+            self.assertEqual(conn.execute("SELECT SIZE FROM INDICES").fetchone()[0], 1)
+            conn.close()
+
+
+class BlobCacheTests(unittest.TestCase):
+
+    def test_blob_cache(self):
+        from blob_cache import BlobCache
+        import time
+        with tempfile.TemporaryDirectory() as folder:
+            cache = BlobCache(os.path.join(folder, "blobs"), max_MB=0.002)
+            paths = []
+            for name, content in [("a", "x"*900), ("b", "x"*900), ("c", "y"*900)]:
+                paths.append(os.path.join(folder, name + ".bed"))
+                with open(paths[-1], "w") as f:
+                    f.write(content)
+            # the same content under two sources is stored once
+            self.assertEqual(cache.put("bed:http://a", paths[0]), cache.put("bed:http://b", paths[1]))
+            self.assertEqual(cache.stats()["blobs"], 1)
+            self.assertEqual(cache.stats()["sources"], 2)
+
+            out = os.path.join(folder, "out.bed")
+            self.assertTrue(cache.get("bed:http://b", out))
+            with open(out) as f:
+                self.assertEqual(f.read(), "x"*900)
+            self.assertFalse(cache.get("bed:http://missing", out))
+
+            # the least recently used blob is evicted once the store passes its budget
+            time.sleep(0.01)
+            cache.put("bed:http://c", paths[2])
+            cache.get("bed:http://c", out)
+            cache.put("bed:http://d", paths[0])
+            self.assertTrue(cache.get("bed:http://c", out))
+            cache.max_size = 1000
+            cache.evict()
+            self.assertEqual(cache.stats()["blobs"], 1)
+            self.assertTrue(cache.get("bed:http://c", out))
+            self.assertFalse(cache.get("bed:http://d", out))
+            self.assertFalse(cache.get("bed:http://a", out))
+            cache.clear()
+            self.assertEqual(cache.stats()["blobs"], 0)
+
+    def test_blob_cache_versions(self):
+        from blob_cache import BlobCache
+        with tempfile.TemporaryDirectory() as folder:
+            cache = BlobCache(os.path.join(folder, "blobs"))
+            path = os.path.join(folder, "a.bed")
+            with open(path, "w") as f:
+                f.write("x"*900)
+            cache.put("bed:http://a", path, '"etag-1"')
+            out = os.path.join(folder, "out.bed")
+            self.assertTrue(cache.get("bed:http://a", out, '"etag-1"'))
+            # a re-released file has a new ETag, its old copy is stale
+            self.assertFalse(cache.get("bed:http://a", out, '"etag-2"'))
+            # without a version to compare the copy is used
+            self.assertTrue(cache.get("bed:http://a", out))
+
+    def test_blob_cache_threads(self):
+        from blob_cache import BlobCache
+        import threading
+        with tempfile.TemporaryDirectory() as folder:
+            cache = BlobCache(os.path.join(folder, "blobs"))
+            path = os.path.join(folder, "a.bed")
+            with open(path, "w") as f:
+                f.write("x"*900)
+            cache.put("bed:http://a", path)
+            # pipeline threads of different projects share the cache of the process
+            found = []
+            def lookup(name):
+                out = os.path.join(folder, name + ".bed")
+                found.append(cache.get("bed:http://a", out))
+                cache.put("bed:http://" + name, out)
+            threads = [threading.Thread(target=lookup, args=(name,)) for name in ["b", "c"]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(found, [True, True])
+            self.assertEqual(cache.stats()["sources"], 3)
+
+
+class MetadataFetcherTests(unittest.TestCase):
+
+    def test_fetch_and_revalidate(self):
+        from metadata_fetcher import MetadataFetcher
+        from setup_indices import extract_descriptions
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        import threading
+        pages = {"/a.html": b"<H3>Description</H3> <P>Track a</P>", "/b.html": b"no description here"}
+        etags = {"/a.html": '"a1"', "/b.html": '"b1"'}
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                requests_seen.append((self.path, self.headers.get("If-None-Match")))
+                if self.path not in pages:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.headers.get("If-None-Match") == etags[self.path]:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etags[self.path])
+                self.send_header("Content-Length", str(len(pages[self.path])))
+                self.end_headers()
+                self.wfile.write(pages[self.path])
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        urls = [url + "/a.html", url + "/b.html", url + "/a.html", url + "/missing.html"]
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                fetcher = MetadataFetcher(cache_folder=folder, concurrency=2)
+                bodies = fetcher.fetch(urls)
+                self.assertEqual(bodies[url + "/a.html"], pages["/a.html"])
+                self.assertEqual(bodies[url + "/missing.html"], b"")
+                self.assertEqual(fetcher.stats(), {"fetched": 2, "revalidated": 0, "failed": 1})
+                descriptions = extract_descriptions({u: b.decode() for u, b in bodies.items()})
+                self.assertEqual(descriptions[url + "/a.html"], "<P>Track a</P>")
+                self.assertEqual(descriptions[url + "/b.html"], "")
+
+                # unchanged pages are revalidated, a changed page is fetched again
+                pages["/b.html"] = b"<h2>Description</h2> <p>Track b</p>"
+                etags["/b.html"] = '"b2"'
+                fetcher = MetadataFetcher(cache_folder=folder, concurrency=2)
+                bodies = fetcher.fetch(urls[:2])
+                self.assertEqual(fetcher.stats(), {"fetched": 1, "revalidated": 1, "failed": 0})
+                self.assertEqual(bodies[url + "/b.html"], pages["/b.html"])
+                self.assertIn(("/a.html", '"a1"'), requests_seen)
+
+                # cached pages are used when the server cannot be reached
+                server.shutdown()
+                server.server_close()
+                bodies = MetadataFetcher(cache_folder=folder).fetch(urls[:1])
+                self.assertEqual(bodies[url + "/a.html"], pages["/a.html"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TimingTests(unittest.TestCase):
+
+    def test_stage_timings(self):
+        from unittest import mock
+        import catalog
+        import timings
+        with tempfile.TemporaryDirectory() as folder, mock.patch.object(config, "TIMINGS_FOLDER", os.path.join(folder, "timings")):
+            conn = catalog.connect(os.path.join(folder, "test.db"))
+            # nothing is recorded outside a run
+            with timings.span("sort", "a"):
+                pass
+            self.assertFalse(os.path.exists(config.TIMINGS_FOLDER))
+
+            run_id = timings.start_run(conn, "setup")
+            with timings.span("download", "a", bytes=10):
+                pass
+            with self.assertRaises(ValueError):
+                with timings.span("convert", "a") as counts:
+                    counts["intervals"] = 5
+                    raise ValueError("conversion failed")
+            timings.record_span("index", "hg19_1", 100.0, 2.5, 30, 5)
+            timings.finish_run(conn)
+
+            rows = conn.execute("SELECT STAGE, NAME, BYTES, INTERVALS, FAILED, SECONDS from STAGE_TIMINGS WHERE RUNID=? ORDER BY STARTED", (run_id,)).fetchall()
+            self.assertEqual([row[:5] for row in rows], [("index", "hg19_1", 30, 5, 0), ("download", "a", 10, None, 0), ("convert", "a", None, 5, 1)])
+            self.assertEqual(rows[0][5], 2.5)
+            self.assertIsNotNone(conn.execute("SELECT FINISHED from RUNS WHERE RUNID=?", (run_id,)).fetchone()[0])
+            self.assertEqual(os.listdir(config.TIMINGS_FOLDER), [])
+
+            # the spans of a run still going are left in its spool file until it finishes
+            run_id = timings.start_run(conn, "update")
+            timings.record_span("index", "hg19_2", 200.0, 1.5)
+            timings.load_spans(conn)
+            self.assertEqual(conn.execute("SELECT COUNT(*) from STAGE_TIMINGS WHERE RUNID=?", (run_id,)).fetchone()[0], 0)
+            self.assertEqual(os.listdir(config.TIMINGS_FOLDER), [os.path.basename(timings.spool_path(run_id))])
+            timings.finish_run(conn)
+            self.assertEqual(conn.execute("SELECT COUNT(*) from STAGE_TIMINGS WHERE RUNID=?", (run_id,)).fetchone()[0], 1)
+            self.assertEqual(os.listdir(config.TIMINGS_FOLDER), [])
+            conn.close()
+
+
 if __name__ == "__main__":
     unittest.main()
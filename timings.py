@@ -0,0 +1,114 @@
+from config import config
+import os
+import json
+import glob
+import time
+import uuid
+from contextlib import contextmanager
+
+config = config
+
+# run the spans of this process belong to, set before the worker pool starts so workers inherit it
+RUN_ENV = "GIGGLE_RUN_ID"
+
+SPAN_COLUMNS = ["RUNID", "STAGE", "NAME", "PID", "STARTED", "SECONDS", "BYTES", "INTERVALS", "FAILED"]
+
+########
+# RUNS #
+########
+
+def start_run(conn, command):
+    """ records the start of a setup or update run, spans of this process and of
+    workers started afterwards are recorded under it
+    Returns
+    -------
+    run_id: string
+    """
+    run_id = uuid.uuid4().hex
+    conn.execute("INSERT INTO RUNS (RUNID, COMMAND, STARTED) VALUES (?, ?, ?)", (run_id, command, time.time()))
+    conn.commit()
+    os.environ[RUN_ENV] = run_id
+    return run_id
+
+
+def finish_run(conn):
+    """ loads the spans of the run into STAGE_TIMINGS and records its end """
+    run_id = os.environ.pop(RUN_ENV, None)
+    if run_id is None:
+        return
+    conn.execute("UPDATE RUNS SET FINISHED=? WHERE RUNID=?", (time.time(), run_id))
+    load_spans(conn)
+
+#########
+# SPANS #
+#########
+
+def spool_path(run_id):
+    return os.path.join(config.TIMINGS_FOLDER, "{}_{}.jsonl".format(run_id, os.getpid()))
+
+
+def record_span(stage, name, started, seconds, bytes=None, intervals=None, failed=False):
+    """ appends a span to the spool file of this process, nothing is recorded outside a run.
+    Spans are spooled to disk rather than written to the catalog so workers never
+    wait on the setup's open transaction
+    """
+    run_id = os.environ.get(RUN_ENV)
+    if run_id is None:
+        return
+    os.makedirs(config.TIMINGS_FOLDER, exist_ok=True)
+    with open(spool_path(run_id), "a") as f:
+        f.write(json.dumps([run_id, stage, name, os.getpid(), started, seconds, bytes, intervals, failed]) + "\n")
+
+
+@contextmanager
+def span(stage, name="", bytes=None, intervals=None):
+    """ times the body as one stage span, the yielded dict takes the "bytes" and
+    "intervals" counts once they are known
+        with span("convert", track) as counts:
+            ...
+            counts["bytes"] = os.path.getsize(bed_path)
+    """
+    counts = {"bytes": bytes, "intervals": intervals}
+    started = time.time()
+    failed = True
+    try:
+        yield counts
+        failed = False
+    finally:
+        record_span(stage, name, started, time.time() - started, counts["bytes"], counts["intervals"], failed)
+
+
+def spool_finished(conn, path):
+    """ True once nothing appends to a spool file any more, its run has finished or the process writing it is gone """
+    run_id, pid = os.path.basename(path)[:-len(".jsonl")].rsplit("_", 1)
+    finished = conn.execute("SELECT FINISHED from RUNS WHERE RUNID=?", (run_id,)).fetchone()
+    if finished is not None and finished[0] is not None:
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:  # alive, owned by another user
+        pass
+    return False
+
+
+def load_spans(conn):
+    """ moves spooled spans into STAGE_TIMINGS, also picks up the spans of runs that were
+    interrupted. The spool files of runs still going are left for when they finish
+    """
+    for path in glob.glob(os.path.join(config.TIMINGS_FOLDER, "*.jsonl")):
+        if not spool_finished(conn, path):
+            continue
+        # a span appended after the rename starts a new spool file rather than being lost with this one
+        try:
+            os.replace(path, path + ".loading")
+        except FileNotFoundError:  # taken by another process
+            continue
+    # includes files left by a load that was interrupted
+    for path in glob.glob(os.path.join(config.TIMINGS_FOLDER, "*.jsonl.loading")):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.endswith("\n")]
+        conn.executemany("INSERT INTO STAGE_TIMINGS ({}) VALUES ({})".format(", ".join(SPAN_COLUMNS), ", ".join(["?"]*len(SPAN_COLUMNS))), rows)
+        conn.commit()
+        os.remove(path)
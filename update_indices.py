@@ -2,17 +2,73 @@ from config import config
 import pandas as pd
 import subprocess
 from setup_indices import *
-import sqlite3
+import catalog
 import glob
 import os
 import shutil
+from query_cache import bump_index_version
+from compaction import compact_all
+from manifest import plan_update, plan_cost, retire_files, record_manifest
+from timings import start_run, finish_run
+from interval_engine import remove_index
+from clize import run
 
 config = config
 
-def update_ucscGenomes(genomes, conn):
+def add_delta_indices(project_id, source, project, genome, new_files, metadata, conn):
+    """ indexes the new files of a project into delta indices numbered after its
+    existing indices, queries read them alongside the rest of the project until
+    compaction.py merges them
+    """
+    last_iter = [i[0] for i in conn.execute("select MAX(ITER) from INDICES where PROJECTID=?", (project_id,))][0]
+    download_cluster_index(project_id, source, project, genome, new_files, metadata, conn, current_index_num=(last_iter or 0) + 1, delta=True)
+
+def update_project(project_id, source, project, genome, scrapped_files, conn, metadata_function, metadata_required=True, dry_run=False):
+    """ plans the update of a project from its manifest: new and changed files
+    are indexed into delta indices, changed and removed files are retired
+    Parameters
+    ----------
+    scrapped_files: dict
+        {track: file info} found at the source
+    metadata_function: function
+        returns the metadata of the project, only called when files are indexed
+    metadata_required: bool
+        only index files that have metadata
+    dry_run: bool
+        print the plan and its estimated cost without applying it
+    """
+    # the plan is made and applied under the project lock, compaction waits until it is committed
+    with catalog.project_lock(project_id):
+        plan = plan_update(conn, project_id, scrapped_files)
+        print("Update plan", project_id, plan_cost(plan, scrapped_files))
+        if dry_run:
+            for state in ["new", "changed", "removed"]:
+                if len(plan[state]) > 0:
+                    print("  {}: {}".format(state, ", ".join(plan[state]["FILEID"])))
+            return plan
+
+        retire_files(conn, project_id, pd.concat([plan["changed"], plan["removed"]]))
+        # changed files are fetched again instead of being taken from the blob cache
+        for f in plan["changed"]["FILEID"]:
+            scrapped_files[f]["download_params"]["refresh"] = True
+        new_files = {f: scrapped_files[f] for f in pd.concat([plan["new"]["FILEID"], plan["changed"]["FILEID"]])}
+        if len(new_files) > 0:
+            metadata = metadata_function()
+            # only setup files that have metadata, take intersection of metadata & files_info
+            if metadata_required:
+                new_files = {key: new_files[key] for key in new_files if key in set(metadata['file_name'].to_numpy())}
+            if len(new_files) > 0:
+                add_delta_indices(project_id, source, project, genome, new_files, metadata, conn)
+        if len(plan["changed"]) + len(plan["removed"]) > 0:
+            bump_index_version(conn)
+        record_manifest(conn, project_id, plan["fingerprints"])
+        conn.commit()
+    return plan
+
+def update_ucscGenomes(genomes, conn, dry_run=False):
     print(genomes)
     # check if project has already been setup, else setup
-    setup_projects = [i[0] for i in conn.execute("select DISTINCT PROJECTID from PROJECTS  where DSOURCE='ucscGenomes'")]
+    setup_projects = [i[0] for i in conn.execute("select DISTINCT PROJECTID from PROJECTS where DSOURCE=?", ("ucscGenomes",))]
     config_projects = ["ucscGenomes_" + g.replace(" ","-") for g in genomes]
     print("HERE", config_projects, setup_projects)
     for genome in genomes:
@@ -23,59 +79,47 @@ def update_ucscGenomes(genomes, conn):
             if isinstance(scrapped_files, str):  # 404 not found on API
                 print("Unable to collect file info from UCSC for {} ref genome".format(genome))
                 continue
-            # collect files that have been indexed
-            setup_files = [i[0] for i in conn.execute("select FILEID from FILES where PROJECTID='{}'".format(project_id))]
-            # scan for new files
-            new_files = {}
-            for f in scrapped_files.keys():
-                if f not in setup_files:
-                    new_files[f] = scrapped_files[f]
-            # if no new files are found then move to next genome
-            if len(new_files) == 0:
-                continue
-            # if new files then find an unfilled index
-            unfull_index_iter = [i[0] for i in conn.execute("select MIN(ITER) from INDICES where PROJECTID='{}' and FULL=0".format(project_id))][0]
-            unfull_files = [i[0] for i in conn.execute("select FILEID from FILES as f left join INDICES as i on f.INDEXID=i.INDEXID where f.PROJECTID='{}' and i.FULL=0".format(project_id))]
-            # create list of files being indexed
-            for f in unfull_files:
-                new_files[f] = scrapped_files[f]
-            # collect metadata for files
-            metadata = UCSC_metadata(genome)
-            # only setup files that have metadata, take intersection of metadata & files_info
-            new_files = {key: new_files[key] for key in list(set(new_files.keys()) & set(metadata['file_name'].to_numpy()))}
-            if len(new_files)==0:
-                continue
-            # delete SQL records for indicies being reindexed
-            conn.execute("DELETE from INDICES where PROJECTID='{}' and FULL=0".format(project_id))
-            conn.execute("DELETE from FILES where INDEXID IN (select INDEXID from INDICES where PROJECTID='{}' and FULL=0)".format(project_id))
-            download_cluster_index(project_id, "ucscGenomes", genome.replace(" ","-"), genome, new_files, metadata, conn, current_index_num=unfull_index_iter)
+            update_project(project_id, "ucscGenomes", genome.replace(" ","-"), genome, scrapped_files, conn,
+                           partial(UCSC_metadata, genome), dry_run=dry_run)
 
         elif project_id not in setup_projects: # project has not been setup
+            if dry_run:
+                print("Update plan", project_id, "new project")
+                continue
             setup_ucscGenomes([genome], conn)
 
     # if project is no longer in config then delete
     for setup_id in setup_projects:
         genome = setup_id.split("_",1)[-1]
         if setup_id not in config_projects:
+            if dry_run:
+                print("Update plan", setup_id, "removed project")
+                continue
             # delete indices
-            files = [i[0] for i in conn.execute("select INDEXID from INDICES where PROJECTID='{}'".format(setup_id))]
+            files = [i[0] for i in conn.execute("select INDEXID from INDICES where PROJECTID=?", (setup_id,))]
             for f in files:
-                shutil.rmtree("indices/{}.d".format(f))
+                remove_index(f)
+                shutil.rmtree(os.path.join(config.DELTA_FOLDER, f), ignore_errors=True)
+            bump_index_version(conn)
 
             # delete sql metadata
-            conn.execute("DELETE FROM PROJECTS WHERE PROJECTID = '{}'".format(setup_id))
-            conn.execute("DELETE FROM INDICES WHERE PROJECTID = '{}'".format(setup_id))
-            conn.execute("DELETE FROM FILES WHERE PROJECTID = '{}'".format(setup_id))
+            conn.execute("DELETE FROM PROJECTS WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM EXTENTS WHERE INDEXID IN (SELECT INDEXID FROM INDICES WHERE PROJECTID = ?)", (setup_id,))
+            conn.execute("DELETE FROM TOMBSTONES WHERE INDEXID IN (SELECT INDEXID FROM INDICES WHERE PROJECTID = ?)", (setup_id,))
+            conn.execute("DELETE FROM MANIFEST WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM INDICES WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM DELTAS WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM FILES WHERE PROJECTID = ?", (setup_id,))
 
             # delete genome if there is no other project with that genome
-            cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = '{}' LIMIT 1".format(genome))
+            cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = ? LIMIT 1", (genome,))
             df = pd.DataFrame(cursor.fetchall())
             if df.empty:
-                conn.execute("DELETE FROM GENOMES WHERE GENOME = '{}'".format(genome))
+                conn.execute("DELETE FROM GENOMES WHERE GENOME = ?", (genome,))
 
-def update_ucscHubs(hub_names, conn):
+def update_ucscHubs(hub_names, conn, dry_run=False):
     # check if project has already been setup, else setup
-    setup_projects = [i[0] for i in conn.execute("select DISTINCT PROJECTID from PROJECTS where DSOURCE='ucscHubs'")]
+    setup_projects = [i[0] for i in conn.execute("select DISTINCT PROJECTID from PROJECTS where DSOURCE=?", ("ucscHubs",))]
     config_projects = []
     print(hub_names, setup_projects)
     hubs = collect_ucscHubs(hub_names)
@@ -93,35 +137,14 @@ def update_ucscHubs(hub_names, conn):
                 if isinstance(scrapped_files, str):  # 404 not found on API
                     print("Unable to collect file info from ucscHub {}".format(project_id))
                     continue
-                # collect files that have been indexed
-                setup_files = [i[0] for i in conn.execute("select FILEID from FILES where PROJECTID='{}'".format(project_id))]
-                # scan for new files
-                new_files = {}
-                for f in scrapped_files.keys():
-                    if f not in setup_files:
-                        new_files[f] = scrapped_files[f]
-                # if no new files are found then move to next genome
-                if len(new_files) == 0:
-                    print("no files")
-                    continue
-                # if new files then find an unfilled index
-                unfull_index_iter = [i[0] for i in conn.execute("select MIN(ITER) from INDICES where PROJECTID='{}' and FULL=0".format(project_id))][0]
-                unfull_files = [i[0] for i in conn.execute("select FILEID from FILES as f left join INDICES as i on f.INDEXID=i.INDEXID where f.PROJECTID='{}' and i.FULL=0".format(project_id))]
-                # delete SQL records for indicies being reindexed
-                conn.execute("DELETE from INDICES where PROJECTID='{}' and FULL=0".format(project_id))
-                conn.execute("DELETE from FILES where INDEXID IN (select INDEXID from INDICES where PROJECTID='{}' and FULL=0)".format(project_id))
-                # create list of files being indexed
-                for f in unfull_files:
-                    new_files[f] = scrapped_files[f]
-                print("HERE", new_files)
-
-                # collect metadata for files
-                metadata = UCSC_hubs_metadata(hub, genome)
-
-                download_cluster_index(project_id, "ucscHubs", hub["hub_short_label"], genome, new_files, metadata, conn)
+                update_project(project_id, "ucscHubs", hub["hub_short_label"], genome, scrapped_files, conn,
+                               partial(UCSC_hubs_metadata, hub, genome), metadata_required=False, dry_run=dry_run)
 
             elif project_id not in setup_projects: # project has not been setup
                 print("NEW INDEX")
+                if dry_run:
+                    print("Update plan", project_id, "new project")
+                    continue
                 setup_ucscHubs([hub["hub_short_label"]], conn)
                 break
 
@@ -129,26 +152,35 @@ def update_ucscHubs(hub_names, conn):
     for setup_id in setup_projects:
         genome = setup_id.split("_",1)[-1]
         if setup_id not in config_projects:
+            if dry_run:
+                print("Update plan", setup_id, "removed project")
+                continue
             # delete indices
-            files = [i[0] for i in conn.execute("select INDEXID from INDICES where PROJECTID='{}'".format(setup_id))]
+            files = [i[0] for i in conn.execute("select INDEXID from INDICES where PROJECTID=?", (setup_id,))]
             for f in files:
-                shutil.rmtree("indices/{}.d".format(f))
+                remove_index(f)
+                shutil.rmtree(os.path.join(config.DELTA_FOLDER, f), ignore_errors=True)
+            bump_index_version(conn)
 
             # delete sql metadata
-            conn.execute("DELETE FROM PROJECTS WHERE PROJECTID = '{}'".format(setup_id))
-            conn.execute("DELETE FROM INDICES WHERE PROJECTID = '{}'".format(setup_id))
-            conn.execute("DELETE FROM FILES WHERE PROJECTID = '{}'".format(setup_id))
+            conn.execute("DELETE FROM PROJECTS WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM EXTENTS WHERE INDEXID IN (SELECT INDEXID FROM INDICES WHERE PROJECTID = ?)", (setup_id,))
+            conn.execute("DELETE FROM TOMBSTONES WHERE INDEXID IN (SELECT INDEXID FROM INDICES WHERE PROJECTID = ?)", (setup_id,))
+            conn.execute("DELETE FROM MANIFEST WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM INDICES WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM DELTAS WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM FILES WHERE PROJECTID = ?", (setup_id,))
 
             # delete genome if there is no other project with that genome
-            cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = '{}' LIMIT 1".format(genome))
+            cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = ? LIMIT 1", (genome,))
             df = pd.DataFrame(cursor.fetchall())
             if df.empty:
-                conn.execute("DELETE FROM GENOMES WHERE GENOME = '{}'".format(genome))
+                conn.execute("DELETE FROM GENOMES WHERE GENOME = ?", (genome,))
 
 
-def update_local(projects, conn):
+def update_local(projects, conn, dry_run=False):
     # check if project has already been setup, else setup
-    setup_projects = [i[0] for i in conn.execute("select DISTINCT PROJECTID from PROJECTS where DSOURCE='local'")]
+    setup_projects = [i[0] for i in conn.execute("select DISTINCT PROJECTID from PROJECTS where DSOURCE=?", ("local",))]
     config_projects = ["local_{}_{}".format(p["project_name"].replace(" ","-"), p["reference_genome"].replace(" ","-")) for p in projects]
 
     for project in projects:
@@ -159,68 +191,74 @@ def update_local(projects, conn):
             if isinstance(scrapped_files, str):  # 404 not found on API
                 print("Unable to collect file info from local for {} project".format(project["project_name"]))
                 continue
-            # collect files that have been indexed
-            setup_files = [i[0] for i in conn.execute("select FILEID from FILES where PROJECTID='{}'".format(project_id))]
-            # scan for new files
-            new_files = {}
-            for f in scrapped_files.keys():
-                if f not in setup_files:
-                    new_files[f] = scrapped_files[f]
-            # if no new files are found then move to next genome
-            if len(new_files) == 0:
-                continue
-            # if new files then find an unfilled index
-            unfull_index_iter = [i[0] for i in conn.execute("select MIN(ITER) from INDICES where PROJECTID='{}' and FULL=0".format(project_id))][0]
-            unfull_files = [i[0] for i in conn.execute("select FILEID from FILES as f left join INDICES as i on f.INDEXID=i.INDEXID where f.PROJECTID='{}' and i.FULL=0".format(project_id))]
-            # create list of files being indexed
-            for f in unfull_files:
-                new_files[f] = scrapped_files[f]
-            # collect metadata for files
-            metadata = UCSC_metadata(genome)
-            # only setup files that have metadata, take intersection of metadata & files_info
-            new_files = {key: new_files[key] for key in list(set(new_files.keys()) & set(metadata['file_name'].to_numpy()))}
-            if len(new_files)==0:
-                continue
-            # delete SQL records for indicies being reindexed
-            conn.execute("DELETE from INDICES where PROJECTID='{}' and FULL=0".format(project_id))
-            conn.execute("DELETE from FILES where INDEXID IN (select INDEXID from INDICES where PROJECTID='{}' and FULL=0)".format(project_id))
-            download_cluster_index(project_id, "local", project["project_name"], project["reference_genome"], new_files, metadata, conn, current_index_num=unfull_index_iter)
+            update_project(project_id, "local", project["project_name"], project["reference_genome"], scrapped_files, conn,
+                           partial(local_metadata, project["metadata_path"]), metadata_required=False, dry_run=dry_run)
 
         elif project_id not in setup_projects: # project has not been setup
+            if dry_run:
+                print("Update plan", project_id, "new project")
+                continue
             setup_local([project], conn)
 
     # if project is no longer in config then delete
     for setup_id in setup_projects:
         genome = setup_id.split("_",1)[-1]
         if setup_id not in config_projects:
+            if dry_run:
+                print("Update plan", setup_id, "removed project")
+                continue
             # delete indices
-            files = [i[0] for i in conn.execute("select INDEXID from INDICES where PROJECTID='{}'".format(setup_id))]
+            files = [i[0] for i in conn.execute("select INDEXID from INDICES where PROJECTID=?", (setup_id,))]
             for f in files:
-                shutil.rmtree("indices/{}.d".format(f))
+                remove_index(f)
+                shutil.rmtree(os.path.join(config.DELTA_FOLDER, f), ignore_errors=True)
+            bump_index_version(conn)
 
             # delete sql metadata
-            conn.execute("DELETE FROM PROJECTS WHERE PROJECTID = '{}'".format(setup_id))
-            conn.execute("DELETE FROM INDICES WHERE PROJECTID = '{}'".format(setup_id))
-            conn.execute("DELETE FROM FILES WHERE PROJECTID = '{}'".format(setup_id))
+            conn.execute("DELETE FROM PROJECTS WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM EXTENTS WHERE INDEXID IN (SELECT INDEXID FROM INDICES WHERE PROJECTID = ?)", (setup_id,))
+            conn.execute("DELETE FROM TOMBSTONES WHERE INDEXID IN (SELECT INDEXID FROM INDICES WHERE PROJECTID = ?)", (setup_id,))
+            conn.execute("DELETE FROM MANIFEST WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM INDICES WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM DELTAS WHERE PROJECTID = ?", (setup_id,))
+            conn.execute("DELETE FROM FILES WHERE PROJECTID = ?", (setup_id,))
 
             # delete genome if there is no other project with that genome
-            cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = '{}' LIMIT 1".format(genome))
+            cursor = conn.execute("SELECT GENOME from GENOMES WHERE GENOMES.GENOME = ? LIMIT 1", (genome,))
             df = pd.DataFrame(cursor.fetchall())
             if df.empty:
-                conn.execute("DELETE FROM GENOMES WHERE GENOME = '{}'".format(genome))
+                conn.execute("DELETE FROM GENOMES WHERE GENOME = ?", (genome,))
 
 
-if __name__ == "__main__":
-    conn = sqlite3.connect(config.DB)
+def UPDATE(*, dry_run=False):
+    """ updates every project in config.py from its source
+
+    :param dry_run: print the new, changed and removed files of each project and the estimated cost without changing anything
+    """
+    conn = catalog.connect(config.DB)
+    if not dry_run:  # a dry run leaves the catalog as it is, RUNS included
+        start_run(conn, "update")
 
-    update_ucscGenomes(config.UCSC_GENOMES, conn)
-    update_ucscHubs(config.UCSC_HUBS[:-1], conn)
-    update_local(config.LOCAL_GENOMES, conn)
+    update_ucscGenomes(config.UCSC_GENOMES, conn, dry_run)
+    update_ucscHubs(config.UCSC_HUBS[:-1], conn, dry_run)
+    update_local(config.LOCAL_GENOMES, conn, dry_run)
+    if dry_run:
+        conn.close()
+        return
 
     # delete any projects that are maintained but no longer listed in the config
     conn.commit()
+    # merge delta indices whose size tier is due, compaction.py --watch does this in the background
+    print("Compacted", compact_all(conn))
+    print("Worker pool", get_pool().stats())
+    close_pool()
+    finish_run(conn)
     conn.close()
 
     proc = subprocess.check_output("python3 query_indices.py -g outputs/genomes.csv",
                                     stderr=None,
-                                    shell=True)
\ No newline at end of file
+                                    shell=True)
+
+
+if __name__ == "__main__":
+    run(UPDATE)
@@ -0,0 +1,108 @@
+from config import config
+import time
+import atexit
+import threading
+from functools import partial
+from multiprocessing.pool import Pool
+
+config = config
+
+
+def timed_call(func, submitted, arg):
+    started = time.time()
+    try:
+        result = func(arg)
+        error = None
+    except Exception as e:
+        result = None
+        error = e
+    return result, error, started - submitted, time.time() - started
+
+###############
+# WORKER POOL #
+###############
+
+class WorkerPool:
+    """ Process pool that stays alive for the life of the process and is shared by
+    the query and setup functions, it keeps counts of the tasks it has run
+    """
+    def __init__(self, processes=config.AVAILABLE_PROCCESSES):
+        self.processes = processes
+        self.pool = Pool(processes)
+        self.created = time.time()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0
+        self.busy_time = 0
+
+    def imap(self, func, iterable, ordered=True):
+        """ yields func(item) for each item, in order of iterable or in order of completion """
+        items = list(iterable)
+        with self.lock:
+            self.submitted += len(items)
+        call = partial(timed_call, func, time.time())
+        results = self.pool.imap(call, items) if ordered else self.pool.imap_unordered(call, items)
+        for result, error, wait, busy in results:
+            yield self.record(result, error, wait, busy)
+
+    def imap_unordered(self, func, iterable):
+        return self.imap(func, iterable, ordered=False)
+
+    def submit(self, func, arg):
+        """ starts func(arg) without waiting for it, returns a function that waits for and returns its result """
+        with self.lock:
+            self.submitted += 1
+        pending = self.pool.apply_async(timed_call, (func, time.time(), arg))
+        return lambda: self.record(*pending.get())
+
+    def record(self, result, error, wait, busy):
+        with self.lock:
+            self.completed += 1
+            self.failed += 0 if error is None else 1
+            self.wait_time += wait
+            self.busy_time += busy
+        if error is not None:
+            raise error
+        return result
+
+    def map(self, func, iterable):
+        return list(self.imap(func, iterable))
+
+    def stats(self):
+        with self.lock:
+            in_flight = self.submitted - self.completed
+            uptime = time.time() - self.created
+            return {"processes": self.processes,
+                    "submitted": self.submitted,
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "queue_depth": max(0, in_flight - self.processes),
+                    "running": min(in_flight, self.processes),
+                    "mean_queue_wait": self.wait_time/self.completed if self.completed > 0 else 0,
+                    "utilisation": self.busy_time/(self.processes*uptime) if uptime > 0 else 0,
+                    "uptime": uptime}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+shared_pool = None
+
+
+def get_pool(processes=config.AVAILABLE_PROCCESSES):
+    """ returns the process wide WorkerPool, started on first use """
+    global shared_pool
+    if shared_pool is None:
+        shared_pool = WorkerPool(processes)
+        atexit.register(close_pool)
+    return shared_pool
+
+
+def close_pool():
+    global shared_pool
+    if shared_pool is not None:
+        shared_pool.close()
+        shared_pool = None